@@ -0,0 +1,209 @@
+################################################################################
+# Authors: Brian Schott (Sir Alaran)
+# Copyright: Brian Schott (Sir Alaran)
+# Date: Oct 20 2009
+# License:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+"""
+Packs tileset images into a few large surfaces so that drawing a map does not
+have to switch between many small source images.
+"""
+
+__docformat__ = "epytext"
+
+import logging
+
+import cairo
+
+log = logging.getLogger("atlas")
+
+# Width and maximum height of an atlas page in pixels. Images that are larger
+# than this get a page of their own.
+PAGE_SIZE = 2048
+
+# Transparent space left around each image so that filtering never picks up
+# pixels from its neighbours
+PADDING = 1
+
+
+class ShelfPacker(object):
+	"""
+	Places rectangles on horizontal shelves. Each rectangle goes on the
+	lowest shelf that is tall enough and has room left, otherwise a new shelf
+	is started below the others.
+	"""
+	def __init__(self, width, height):
+		"""
+		@type width: int
+		@param width: width of the area to pack into
+		@type height: int
+		@param height: height of the area to pack into
+		"""
+		self.width = width
+		self.height = height
+		# List of [y, height, used width]
+		self.__shelves = []
+		# Bottom edge of the lowest shelf
+		self.bottom = 0
+
+	def insert(self, width, height):
+		"""
+		@type width: int
+		@param width: width of the rectangle
+		@type height: int
+		@param height: height of the rectangle
+		@rtype: (int, int)
+		@return: the position of the rectangle, or None if it does not fit
+		"""
+		if width > self.width:
+			return None
+		best = None
+		for shelf in self.__shelves:
+			if shelf[1] >= height and self.width - shelf[2] >= width:
+				if best is None or shelf[1] < best[1]:
+					best = shelf
+		if best is None:
+			if self.bottom + height > self.height:
+				return None
+			best = [self.bottom, height, 0]
+			self.__shelves.append(best)
+			self.bottom += height
+		x = best[2]
+		best[2] += width
+		return x, best[0]
+
+
+class AtlasPage(object):
+	"""
+	A single atlas surface. Render jobs read the surface from worker threads,
+	so it is never drawn on once it has been handed out. Adding an image
+	replaces it with a copy that has the image on it, and that is taller if
+	the image needs the room.
+	"""
+	def __init__(self, width, height):
+		self.packer = ShelfPacker(width, height)
+		self.surface = None
+
+	def add(self, image):
+		"""
+		@type image: cairo.ImageSurface
+		@param image: the image to copy onto the page
+		@rtype: (int, int)
+		@return: the position of the image on the page, or None if there is no
+			room for it
+		"""
+		width = image.get_width()
+		height = image.get_height()
+		position = self.packer.insert(width + PADDING * 2,
+			height + PADDING * 2)
+		if position is None:
+			return None
+		x = position[0] + PADDING
+		y = position[1] + PADDING
+		surface = self.__copy(self.packer.bottom)
+		context = cairo.Context(surface)
+		context.set_source_surface(image, x, y)
+		context.rectangle(x, y, width, height)
+		context.set_operator(cairo.OPERATOR_SOURCE)
+		context.fill()
+		self.surface = surface
+		return x, y
+
+	def __copy(self, height):
+		"""
+		@type height: int
+		@param height: the height that the page needs to be
+		@rtype: cairo.ImageSurface
+		@return: a new surface with the contents of the page on it
+		"""
+		newHeight = height
+		if self.surface is not None:
+			newHeight = self.surface.get_height()
+			if newHeight < height:
+				newHeight = min(max(height, newHeight * 2),
+					self.packer.height)
+		surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.packer.width,
+			newHeight)
+		if self.surface is not None:
+			context = cairo.Context(surface)
+			context.set_source_surface(self.surface, 0, 0)
+			context.set_operator(cairo.OPERATOR_SOURCE)
+			context.paint()
+		return surface
+
+
+class TileAtlas(object):
+	"""
+	Packs tilesets onto atlas pages. Adding a tileset only copies that image;
+	the ones that are already on a page stay where they are.
+	"""
+	def __init__(self):
+		self.pages = []
+		# (page index, x, y) by image index, or None for images that were
+		# never added
+		self.__placements = []
+
+	def addImage(self, index, image):
+		"""
+		@type index: int
+		@param index: image index of the tileset
+		@type image: cairo.ImageSurface
+		@param image: the tileset
+		"""
+		placement = None
+		for pageIndex, page in enumerate(self.pages):
+			position = page.add(image)
+			if position is not None:
+				placement = (pageIndex, position[0], position[1])
+				break
+		if placement is None:
+			page = AtlasPage(max(PAGE_SIZE, image.get_width() + PADDING * 2),
+				max(PAGE_SIZE, image.get_height() + PADDING * 2))
+			position = page.add(image)
+			self.pages.append(page)
+			placement = (len(self.pages) - 1, position[0], position[1])
+			log.debug("Started atlas page %d" % placement[0])
+
+		while index > len(self.__placements) - 1:
+			self.__placements.append(None)
+		self.__placements[index] = (placement, image.get_width(),
+			image.get_height())
+
+	def locate(self, index, x, y, width, height):
+		"""
+		@type index: int
+		@param index: image index
+		@type x: int
+		@param x: left edge of an area of the image
+		@type y: int
+		@param y: top edge of an area of the image
+		@type width: int
+		@param width: width of the area
+		@type height: int
+		@param height: height of the area
+		@rtype: (cairo.ImageSurface, int, int)
+		@return: the page surface and the position of the area on it, or None
+			if the image is not in the atlas or the area is outside of it
+		"""
+		if index >= len(self.__placements) or self.__placements[index] is None:
+			return None
+		placement, imageWidth, imageHeight = self.__placements[index]
+		if x < 0 or y < 0 or x + width > imageWidth \
+			or y + height > imageHeight:
+			return None
+		page, px, py = placement
+		return self.pages[page].surface, px + x, py + y
@@ -0,0 +1,425 @@
+################################################################################
+# Authors: Brian Schott (Sir Alaran)
+# Copyright: Brian Schott (Sir Alaran)
+# Date: Oct 20 2009
+# License:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+"""
+Rule based automatic tiling. A terrain is a set of tiles from one tileset,
+each of which is drawn for a particular arrangement of neighbouring tiles of
+the same terrain. After tiles are drawn, the tiles of every terrain around
+them are replaced with the ones that fit their new neighbours.
+"""
+
+__docformat__ = "epytext"
+
+import os
+import json
+import array
+import random
+import time
+import logging
+
+import tilemap
+
+log = logging.getLogger("autotile")
+
+# Neighbour bits of a rule mask, clockwise from the top
+NORTH = 1
+NORTH_EAST = 2
+EAST = 4
+SOUTH_EAST = 8
+SOUTH = 16
+SOUTH_WEST = 32
+WEST = 64
+NORTH_WEST = 128
+
+EDGES = NORTH | EAST | SOUTH | WEST
+CORNERS = NORTH_EAST | SOUTH_EAST | SOUTH_WEST | NORTH_WEST
+
+# The two edges that each corner lies between
+CORNER_EDGES = {NORTH_EAST: NORTH | EAST, SOUTH_EAST: SOUTH | EAST,
+	SOUTH_WEST: SOUTH | WEST, NORTH_WEST: NORTH | WEST}
+
+# Extension of the files that declare the terrains of a tileset
+TERRAIN_EXTENSION = ".terrain"
+
+# Terrain value of the area outside of the map. It counts as every terrain,
+# so that terrains continue past the edges of the map.
+_OUTSIDE = 255
+
+# Most terrains that a map can have
+MAX_TERRAINS = _OUTSIDE - 1
+
+
+def _bitCount(value):
+	return bin(value).count("1")
+
+
+def normalizeMask(mask):
+	"""
+	Removes the corner bits of a mask that do not change which tile fits.
+	A corner neighbour only matters if both of the edge neighbours next to
+	it are of the same terrain.
+	@type mask: int
+	@param mask: neighbour mask
+	@rtype: int
+	@return: the normalized mask
+	"""
+	for corner, edges in CORNER_EDGES.iteritems():
+		if mask & edges != edges:
+			mask &= ~corner
+	return mask
+
+
+class Terrain(object):
+	"""
+	Tiles of a tileset that are chosen automatically from their neighbours
+	"""
+	def __init__(self, name, image):
+		"""
+		@type name: str
+		@param name: name of the terrain
+		@type image: int
+		@param image: image index of the tileset
+		"""
+		self.name = name
+		self.image = image
+		# Dictionary of neighbour mask to (ix, iy)
+		self.rules = {}
+
+	def addRule(self, mask, ix, iy):
+		"""
+		@type mask: int
+		@param mask: the neighbours of the same terrain that the tile is for,
+			as a combination of the NORTH, NORTH_EAST, ... bits
+		@type ix: int
+		@param ix: image x-coordinate of the tile
+		@type iy: int
+		@param iy: image y-coordinate of the tile
+		"""
+		if mask < 0 or mask > 255:
+			raise ValueError("Neighbour masks must be between 0 and 255")
+		self.rules[mask] = (ix, iy)
+
+	def buildLookup(self):
+		"""
+		Chooses a tile for every possible arrangement of neighbours. Masks
+		that have a rule use it. Others use the rule that differs from the
+		normalized mask in the fewest edges, then in the fewest corners.
+		@rtype: [(int, int)]
+		@return: the image coordinates of the tile for each of the 256 masks
+		"""
+		if len(self.rules) == 0:
+			return [None] * 256
+		ruleMasks = sorted(self.rules)
+		lookup = []
+		for mask in range(256):
+			if mask in self.rules:
+				lookup.append(self.rules[mask])
+				continue
+			normalized = normalizeMask(mask)
+			best = None
+			bestCost = None
+			for ruleMask in ruleMasks:
+				difference = ruleMask ^ normalized
+				cost = _bitCount(difference & EDGES) * 4 \
+					+ _bitCount(difference & CORNERS)
+				if bestCost is None or cost < bestCost:
+					best = ruleMask
+					bestCost = cost
+			lookup.append(self.rules[best])
+		return lookup
+
+	def toDictionary(self):
+		"""
+		@rtype: {}
+		@return: the terrain in the form that is saved in level files
+		"""
+		return {"name": self.name, "image": self.image,
+			"rules": [[mask, ix, iy] for mask, (ix, iy)
+			in sorted(self.rules.iteritems())]}
+
+	@staticmethod
+	def fromDictionary(d, image = None):
+		"""
+		@type d: {}
+		@param d: dictionary with "name", "rules" and, unless image is given,
+			"image"
+		@type image: int
+		@param image: image index to use instead of the one in d
+		@rtype: Terrain
+		@return: the terrain
+		"""
+		if image is None:
+			image = d["image"]
+		terrain = Terrain(d.get("name", "Terrain"), image)
+		for mask, ix, iy in d["rules"]:
+			terrain.addRule(mask, ix, iy)
+		return terrain
+
+
+def readTerrainFile(fileName, image):
+	"""
+	Reads the terrains that a tileset declares. These are kept in a JSON file
+	next to the tileset image, with the same name and a .terrain extension,
+	of the form {"terrains": [{"name": ..., "rules": [[mask, ix, iy], ...]}]}
+	@type fileName: str
+	@param fileName: file name of the tileset image
+	@type image: int
+	@param image: image index of the tileset
+	@rtype: [Terrain]
+	@return: the terrains of the tileset. This is empty if the tileset does
+		not have a terrain file or the file can't be read.
+	"""
+	terrainFile = os.path.splitext(fileName)[0] + TERRAIN_EXTENSION
+	if not os.path.exists(terrainFile):
+		return []
+	try:
+		f = open(terrainFile, "r")
+		try:
+			d = json.load(f)
+		finally:
+			f.close()
+		return [Terrain.fromDictionary(t, image) for t in d["terrains"]]
+	except (IOError, ValueError, KeyError, TypeError) as e:
+		log.error("Could not read terrain file %s: %s" % (terrainFile, e))
+		return []
+
+
+def _toInt(s):
+	return int(s.encode("hex"), 16)
+
+
+class AutoTiler(object):
+	"""
+	Replaces terrain tiles in a layer with the ones that fit their
+	neighbours. The tile for every arrangement of neighbours is looked up in
+	a table that is built once per terrain, and the neighbour masks of a
+	whole row are worked out together.
+	"""
+	def __init__(self, tileTable, terrains):
+		"""
+		@type tileTable: tilemap.TileTable
+		@param tileTable: the tile table of the map
+		@type terrains: [Terrain]
+		@param terrains: the terrains of the map
+		"""
+		if len(terrains) > MAX_TERRAINS:
+			raise ValueError("A map can't have more than %d terrains"
+				% MAX_TERRAINS)
+		self.__tileTable = tileTable
+		# Terrain number (index + 1) by tile id, 0 for tiles of no terrain
+		self.__terrainOf = array.array("B")
+		# Tile id for each neighbour mask, by terrain number
+		self.__lookups = [None]
+		# Translation tables that turn terrain numbers into 1 for the terrain
+		# (or the outside of the map) and 0 for anything else
+		self.__tables = [None]
+		members = {}
+		for number, terrain in enumerate(terrains):
+			number += 1
+			ids = []
+			for info in terrain.buildLookup():
+				if info is None:
+					ids.append(0)
+				else:
+					tile = tileTable.intern(terrain.image, info[0], info[1])
+					ids.append(tileTable.getId(tile))
+			for ix, iy in terrain.rules.itervalues():
+				tileId = tileTable.getId(tileTable.intern(terrain.image, ix,
+					iy))
+				members.setdefault(tileId, number)
+			self.__lookups.append(array.array("H", ids))
+			self.__tables.append("".join([chr(int(i == number
+				or i == _OUTSIDE)) for i in range(256)]))
+		self.__members = members
+
+	def __updateTerrains(self):
+		# Ids given out since the last update are not terrain tiles, unless
+		# they were interned for a rule above
+		terrainOf = self.__terrainOf
+		for tileId in range(len(terrainOf), len(self.__tileTable)):
+			terrainOf.append(self.__members.get(tileId, 0))
+
+	def terrainOf(self, tileId):
+		"""
+		@type tileId: int
+		@param tileId: a tile id
+		@rtype: int
+		@return: the index of the terrain that the tile belongs to, or -1
+		"""
+		self.__updateTerrains()
+		if tileId >= len(self.__terrainOf):
+			return -1
+		return self.__terrainOf[tileId] - 1
+
+	def retile(self, layer, x1, y1, x2, y2):
+		"""
+		Replaces the terrain tiles in and around an area with the tiles that
+		fit their neighbours. Only the area and the tiles next to it are
+		looked at, since no other tile has a neighbour that changed.
+		@type layer: tilemap.Layer
+		@param layer: the layer to change
+		@type x1: int
+		@param x1: left edge of the changed area
+		@type y1: int
+		@param y1: top edge of the changed area
+		@type x2: int
+		@param x2: right edge of the changed area
+		@type y2: int
+		@param y2: bottom edge of the changed area
+		@rtype: [(int, int, int, int)]
+		@return: the x-coordinate, y-coordinate, old tile id and new tile id
+			of every tile that was changed
+		"""
+		self.__updateTerrains()
+		# Tiles that are looked at
+		left = max(min(x1, x2) - 1, 0)
+		right = min(max(x1, x2) + 1, layer.width - 1)
+		top = max(min(y1, y2) - 1, 0)
+		bottom = min(max(y1, y2) + 1, layer.height - 1)
+		if left > right or top > bottom:
+			return []
+		width = right - left + 1
+
+		# Terrain numbers of the tiles that are looked at and of the tiles
+		# around them, with the outside of the map marked as such
+		outside = chr(_OUTSIDE)
+		padLeft = outside if left == 0 else ""
+		padRight = outside if right == layer.width - 1 else ""
+		start = left - 1 + len(padLeft)
+		end = right + 2 - len(padRight)
+		terrainOf = self.__terrainOf.__getitem__
+		ids = layer.getRows(top - 1, bottom + 2)
+		if top == 0:
+			ids.insert(0, None)
+		terrains = []
+		for row in ids:
+			if row is None:
+				terrains.append(outside * (width + 2))
+			else:
+				terrains.append(padLeft + str(bytearray(map(terrainOf,
+					row[start:end]))) + padRight)
+		if bottom == layer.height - 1:
+			terrains.append(outside * (width + 2))
+			ids.append(None)
+
+		changes = []
+		for i in range(1, len(terrains) - 1):
+			centre = terrains[i][1:-1]
+			y = top + i - 1
+			row = ids[i]
+			newRow = None
+			for number in set(bytearray(centre)):
+				if number == 0 or number == _OUTSIDE:
+					continue
+				masks = self.__masks(number, terrains[i - 1], terrains[i],
+					terrains[i + 1], width)
+				lookup = self.__lookups[number]
+				code = chr(number)
+				x = centre.find(code)
+				while x != -1:
+					old = row[left + x]
+					new = lookup[ord(masks[x])]
+					if new != old and new != 0:
+						if newRow is None:
+							newRow = row[left:left + width]
+						newRow[x] = new
+						changes.append((left + x, y, old, new))
+					x = centre.find(code, x + 1)
+			if newRow is not None:
+				runs = array.array("i", [y, left, right])
+				layer.fillRuns(runs, [newRow], left, y)
+		return changes
+
+	def __masks(self, number, above, row, below, width):
+		"""
+		@rtype: str
+		@return: the neighbour mask of each tile of a row for one terrain
+		"""
+		table = self.__tables[number]
+		above = above.translate(table)
+		row = row.translate(table)
+		below = below.translate(table)
+		# Each neighbour is a string of 0 and 1 bytes. Shifting the numbers
+		# that they spell puts each neighbour at its own bit of every byte.
+		mask = _toInt(above[1:width + 1]) \
+			| _toInt(above[2:]) << 1 \
+			| _toInt(row[2:]) << 2 \
+			| _toInt(below[2:]) << 3 \
+			| _toInt(below[1:width + 1]) << 4 \
+			| _toInt(below[:width]) << 5 \
+			| _toInt(row[:width]) << 6 \
+			| _toInt(above[:width]) << 7
+		return ("%x" % mask).zfill(width * 2).decode("hex")
+
+
+def benchmark(width = 1000, height = 1000):
+	"""
+	Prints the time taken to retile a whole layer of a synthetic map and to
+	retile the area around a single drawn tile
+	@type width: int
+	@param width: width of the test map in tiles
+	@type height: int
+	@param height: height of the test map in tiles
+	"""
+	random.seed(0)
+	tileMap = tilemap.TileMap.createMap(32, width, height)
+	tileMap.addImage("terrain.png", 0)
+	terrain = Terrain("benchmark", 0)
+	masks = sorted(set([normalizeMask(mask) for mask in range(256)]))
+	for i, mask in enumerate(masks):
+		terrain.addRule(mask, i % 8, i // 8)
+	tileMap.terrains.append(terrain)
+	layer = tileMap.layers[0]
+	tile = tileMap.tileTable.intern(0, 0, 0)
+	# Blobs of terrain on an empty layer
+	for i in range(width * height // 64):
+		x = random.randrange(width)
+		y = random.randrange(height)
+		for dx in range(4):
+			for dy in range(4):
+				layer.addTile(tile, x + dx, y + dy)
+
+	start = time.time()
+	autoTiler = AutoTiler(tileMap.tileTable, tileMap.terrains)
+	print("%-24s %10.3f" % ("build lookup (s)", time.time() - start))
+
+	start = time.time()
+	changes = autoTiler.retile(layer, 0, 0, width - 1, height - 1)
+	print("%-24s %10.3f (%d tiles changed)" % ("retile layer (s)",
+		time.time() - start, len(changes)))
+
+	start = time.time()
+	changes = autoTiler.retile(layer, 0, 0, width - 1, height - 1)
+	print("%-24s %10.3f (%d tiles changed)" % ("retile unchanged (s)",
+		time.time() - start, len(changes)))
+
+	start = time.time()
+	count = 1000
+	for i in range(count):
+		x = random.randrange(width)
+		y = random.randrange(height)
+		layer.addTile(tile, x, y)
+		autoTiler.retile(layer, x, y, x, y)
+	print("%-24s %10.6f" % ("retile one edit (s)",
+		(time.time() - start) / count))
+
+
+if __name__ == "__main__":
+	benchmark()
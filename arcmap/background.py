@@ -34,6 +34,8 @@ class Background(object):
 	def __init__(self):
 		self.parallaxes = []
 		self.bgColor = graphics.RGBA()
+		# True if the background has changed since it was last saved
+		self.dirty = True
 
 	def getParallaxes(self):
 		"""
@@ -48,6 +50,7 @@ class Background(object):
 		@param parallaxes: the layers for the background
 		"""
 		self.parallaxes = parallaxes
+		self.dirty = True
 
 	def getBGColor(self):
 		"""
@@ -62,6 +65,7 @@ class Background(object):
 		@param color: the new background color
 		"""
 		self.bgColor = color
+		self.dirty = True
 
 
 class ParallaxLayer(object):
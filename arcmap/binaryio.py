@@ -0,0 +1,638 @@
+################################################################################
+# Authors: Brian Schott (Sir Alaran)
+# Copyright: Brian Schott (Sir Alaran)
+# Date: Oct 20 2009
+# License:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+"""
+Binary level format. The file starts with a fixed size header, followed by the
+blocking information (one byte per tile, column by column) and the chunks of
+every layer. Each chunk is CHUNK_SIZE * CHUNK_SIZE unsigned 16-bit numbers,
+stored row by row. These are the tile ids of the map's tilemap.TileTable, so
+chunks are loaded and saved without any conversion. Zero means that there is
+no tile. The tile table (as the palette), the layer chunk tables, the physics
+world and the background are stored as JSON at the end of the file.
+
+Files are memory mapped when they are read, and chunks are only decoded when
+a layer needs them. Saving to the file that a level was loaded from only
+writes the chunks that were modified.
+"""
+
+__docformat__ = "epytext"
+
+import os
+import sys
+import json
+import mmap
+import array
+import struct
+import logging
+import tempfile
+import collections
+
+import preferences
+import tilemap
+import mapio
+import worldio
+import backgroundio
+
+log = logging.getLogger("binaryio")
+
+# File name extension for binary levels
+EXTENSION = ".arcl"
+
+MAGIC = "ARCL"
+VERSION = 1
+
+# Magic, version, chunk size, metadata offset, metadata length
+HEADER_FORMAT = "<4sHHQQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# Number of bytes used to store a single chunk
+CHUNK_BYTES = tilemap.CHUNK_SIZE * tilemap.CHUNK_SIZE * 2
+
+# Files are compacted when saving in place if more than this fraction of their
+# data is no longer used by the level
+GARBAGE_RATIO = 0.5
+
+
+def isBinaryName(fileName):
+	"""
+	@type fileName: str
+	@param fileName: a file name
+	@rtype: bool
+	@return: True if levels saved with the given file name should use the
+		binary format
+	"""
+	return fileName.lower().endswith(EXTENSION)
+
+
+def write(fileName, tileMap, world, background):
+	"""
+	Saves a level in the binary format. If the level was loaded from the same
+	file, only the modified chunks are written. Otherwise (or if too much of
+	the file is unused) the whole file is written again.
+	@type fileName: str
+	@param fileName: the path of the file to save to
+	"""
+	levelFile = tileMap.levelFile
+	if levelFile is not None and levelFile.fileName == os.path.abspath(
+		fileName) and levelFile.canWriteInPlace(tileMap):
+		levelFile.writeBack(tileMap, world, background)
+		return
+
+	directory = os.path.dirname(os.path.abspath(fileName))
+	fd, tempName = tempfile.mkstemp(EXTENSION, dir=directory)
+	f = os.fdopen(fd, "wb")
+	try:
+		offsets = _writeFull(f, tileMap, world, background)
+	except:
+		f.close()
+		os.remove(tempName)
+		raise
+	f.close()
+
+	# Layers that are no longer part of the map still need their chunks once
+	# the old file goes away
+	if levelFile is not None:
+		levelFile.close(tileMap.layers)
+	if os.path.exists(fileName):
+		os.remove(fileName)
+	os.rename(tempName, fileName)
+
+	LevelFile(fileName).adopt(tileMap, offsets)
+
+
+def _writeFull(f, tileMap, world, background):
+	"""
+	@type f: file
+	@param f: the file to write the whole level to
+	@rtype: [{(int, int): int}]
+	@return: the file offsets of the chunks of each layer
+	"""
+	f.write("\0" * HEADER_SIZE)
+	position = HEADER_SIZE
+	blockingOffset = position
+	f.write(_encodeBlocking(tileMap.blocking))
+	position += tileMap.width * tileMap.height
+
+	offsets = []
+	for layer in tileMap.layers:
+		layerOffsets = {}
+		for key in sorted(layer.chunkKeys()):
+			chunk = layer.getChunk(key)
+			if chunk is None or not any(chunk):
+				continue
+			f.write(_encodeChunk(chunk))
+			layerOffsets[key] = position
+			position += CHUNK_BYTES
+		offsets.append(layerOffsets)
+
+	metadata = _encodeMetadata(tileMap, world, background, blockingOffset,
+		offsets)
+	f.write(metadata)
+	f.seek(0)
+	f.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, tilemap.CHUNK_SIZE,
+		position, len(metadata)))
+	return offsets
+
+
+def _encodeBlocking(blocking):
+	"""
+	@type blocking: [[int]]
+	@param blocking: blocking information of a map, column by column
+	@rtype: str
+	@return: the blocking information with one byte for each tile
+	"""
+	return "".join([array.array("B", column).tostring()
+		for column in blocking])
+
+
+def _encodeChunk(chunk):
+	"""
+	@type chunk: array.array
+	@param chunk: the tile ids of a chunk
+	@rtype: str
+	@return: the chunk in its binary (little endian) form
+	"""
+	if sys.byteorder == "big":
+		chunk = array.array("H", chunk)
+		chunk.byteswap()
+	return chunk.tostring()
+
+
+def _encodeMetadata(tileMap, world, background, blockingOffset, offsets):
+	"""
+	@rtype: str
+	@return: the JSON metadata that goes at the end of the file
+	"""
+	mw = mapio.MapWriter(tileMap)
+	mapDictionary = mw.headerDictionary()
+	mapDictionary["blocking"] = blockingOffset
+	mapDictionary["palette"] = tileMap.tileTable.entries()
+	mapDictionary["layers"] = []
+	for index, layer in enumerate(tileMap.layers):
+		chunks = [[key[0], key[1], offset] for key, offset
+			in sorted(offsets[index].iteritems())]
+		mapDictionary["layers"].append({"index": index, "name": layer.name,
+			"visible": layer.visible, "chunks": chunks})
+
+	dictionary = {"tileMap": mapDictionary, "background": None,
+		"blazeWorld": None}
+	if background is not None:
+		dictionary["background"] = backgroundio.BackgroundWriter(
+			background).writed()
+	if world is not None:
+		dictionary["blazeWorld"] = worldio.WorldWriter(world).writed()
+	return json.dumps(dictionary)
+
+
+def read(fileName):
+	"""
+	@type fileName: str
+	@param fileName: the path of the file to load from
+	@rtype: (background, BlazeWorld, TileMap)
+	@return: the background (or None), the blaze world (or None), and the
+		tile map. The layers of the tile map load their chunks from the file
+		when they are first used.
+	This function will raise a LevelFileError on failure.
+	"""
+	levelFile = LevelFile(fileName)
+	try:
+		return levelFile.readLevel()
+	except:
+		levelFile.close()
+		raise
+
+
+class LevelFile(object):
+	"""
+	A memory mapped binary level. This is the chunk source for the layers that
+	were loaded from it. It keeps track of which chunks are in memory, and
+	drops the least recently used unmodified chunks once there are more than
+	preferences.performance["resident_chunks"] of them.
+	"""
+	def __init__(self, fileName):
+		"""
+		@type fileName: str
+		@param fileName: the binary level file to map
+		"""
+		self.fileName = os.path.abspath(fileName)
+		# Dictionary of tilemap.Layer to {(chunk x, chunk y): file offset}
+		self.__offsets = {}
+		# (layer, key) of the unmodified chunks that are in memory, least
+		# recently used first
+		self.__resident = collections.OrderedDict()
+		self.__file = None
+		self.__map = None
+		self.__mapFile()
+
+		header = self.__map[:HEADER_SIZE]
+		if len(header) < HEADER_SIZE:
+			self.close()
+			raise LevelFileError("The file is too short to be a level")
+		magic, version, chunkSize, metaOffset, metaLength = struct.unpack(
+			HEADER_FORMAT, header)
+		if magic != MAGIC:
+			self.close()
+			raise LevelFileError("The file is not a binary level")
+		if version != VERSION:
+			self.close()
+			raise LevelFileError("Unsupported binary level version %d" %
+				version)
+		if chunkSize != tilemap.CHUNK_SIZE:
+			self.close()
+			raise LevelFileError("Unsupported chunk size %d" % chunkSize)
+
+		if metaOffset < HEADER_SIZE \
+				or metaOffset + metaLength > len(self.__map):
+			self.close()
+			raise LevelFileError("The file is too short for its metadata")
+		try:
+			self.__metadata = json.loads(self.__map[metaOffset:
+				metaOffset + metaLength])
+		except ValueError as e:
+			self.close()
+			raise LevelFileError("The level metadata is damaged: %s" % e)
+		# Chunks and blocking information end where the metadata starts
+		self.__end = metaOffset
+		self.__metaLength = metaLength
+		mapDictionary = self.__metadata["tileMap"]
+		# Tile table of the map that the chunks belong to
+		self.__tileTable = None
+		self.__blockingOffset = mapDictionary["blocking"]
+		self.__blockingSize = mapDictionary["width"] * mapDictionary["height"]
+		if not self.__inFile(self.__blockingOffset, self.__blockingSize):
+			self.close()
+			raise LevelFileError("The file is too short for its blocking"
+				" information")
+
+	def __inFile(self, offset, length):
+		"""
+		@rtype: bool
+		@return: True if the bytes from offset to offset + length are part of
+			the file, before the metadata
+		"""
+		return HEADER_SIZE <= offset and offset + length <= self.__end
+
+	def __mapFile(self):
+		try:
+			self.__file = open(self.fileName, "rb")
+			self.__map = mmap.mmap(self.__file.fileno(), 0,
+				access=mmap.ACCESS_READ)
+		except (EnvironmentError, ValueError) as e:
+			if self.__file is not None:
+				self.__file.close()
+				self.__file = None
+			raise LevelFileError(str(e))
+
+	def __unmapFile(self):
+		if self.__map is not None:
+			self.__map.close()
+			self.__map = None
+		if self.__file is not None:
+			self.__file.close()
+			self.__file = None
+
+	def readLevel(self):
+		"""
+		Creates the level objects from the file metadata
+		@rtype: (background, BlazeWorld, TileMap)
+		@return: the background (or None), the blaze world (or None), and the
+			tile map
+		"""
+		d = self.__metadata
+		background = None
+		world = None
+		if d.get("background") is not None:
+			background = backgroundio.BackgroundReader().readd(
+				d["background"])
+		if d.get("blazeWorld") is not None:
+			world = worldio.WorldReader().readd(d["blazeWorld"])
+
+		mapDictionary = dict(d["tileMap"])
+		layers = mapDictionary["layers"]
+		# The map reader only needs to create the layers. Their tiles are
+		# loaded from the chunks later.
+		mapDictionary["layers"] = [{"name": layer["name"],
+			"visible": layer["visible"], "tiles": []} for layer in layers]
+		del mapDictionary["blocking"]
+		try:
+			tileMap = mapio.MapReader().readd(mapDictionary)
+		except mapio.MapLoadException as e:
+			raise LevelFileError(str(e))
+		if tileMap is None:
+			raise LevelFileError("The tile map in the level is incomplete")
+
+		tileMap.blocking = self.__readBlocking(tileMap.width, tileMap.height)
+		tileMap.blockingDirty = True
+		# Interning the palette in order gives every tile the same id that it
+		# has in the chunks
+		palette = d["tileMap"].get("palette", [])
+		for ix, iy, ii in palette:
+			tileMap.tileTable.intern(ii, ix, iy)
+		if len(tileMap.tileTable) != len(palette) + 1:
+			raise LevelFileError("The tile palette contains duplicates")
+
+		offsets = []
+		for layerDictionary in layers:
+			layerOffsets = {}
+			for cx, cy, offset in layerDictionary["chunks"]:
+				# Checked here so that a damaged file fails to open instead
+				# of failing when the chunk is first drawn
+				if not self.__inFile(offset, CHUNK_BYTES):
+					raise LevelFileError("A chunk is outside of the file")
+				layerOffsets[(cx, cy)] = offset
+			offsets.append(layerOffsets)
+		self.adopt(tileMap, offsets)
+		return background, world, tileMap
+
+	def __readBlocking(self, width, height):
+		start = self.__blockingOffset
+		blocking = []
+		for x in range(width):
+			column = array.array("B")
+			column.fromstring(self.__map[start + x * height:
+				start + (x + 1) * height])
+			blocking.append(column.tolist())
+		return blocking
+
+	def adopt(self, tileMap, offsets):
+		"""
+		Makes this the file that the layers of a map load their chunks from
+		@type tileMap: tilemap.TileMap
+		@param tileMap: the map
+		@type offsets: [{(int, int): int}]
+		@param offsets: the file offsets of the chunks of each layer, whose
+			contents are all saved in this file
+		"""
+		self.__tileTable = tileMap.tileTable
+		tileMap.levelFile = self
+		for layer, layerOffsets in zip(tileMap.layers, offsets):
+			self.attach(layer, layerOffsets)
+			layer.markChunksSaved()
+			self.register(layer)
+
+	def attach(self, layer, offsets):
+		"""
+		Makes a layer load its chunks from this file
+		@type layer: tilemap.Layer
+		@param layer: the layer
+		@type offsets: {(int, int): int}
+		@param offsets: the file offset of each of the layer's chunks
+		"""
+		self.__offsets[layer] = offsets
+		layer.attachSource(self, offsets.keys())
+
+	def register(self, layer):
+		"""
+		Starts tracking the chunks of a layer that are already in memory so
+		that they can be dropped later
+		@type layer: tilemap.Layer
+		@param layer: a layer attached to this file
+		"""
+		for key in layer.residentChunks():
+			self.__resident[(layer, key)] = None
+		self.__evict()
+
+	def loadChunk(self, layer, key):
+		"""
+		@type layer: tilemap.Layer
+		@param layer: the layer that the chunk belongs to
+		@type key: (int, int)
+		@param key: the chunk coordinates
+		@rtype: array.array
+		@return: the tile ids of the chunk
+		"""
+		offset = self.__offsets[layer][key]
+		chunk = array.array("H")
+		chunk.fromstring(self.__map[offset:offset + CHUNK_BYTES])
+		if sys.byteorder == "big":
+			chunk.byteswap()
+		if max(chunk) >= len(self.__tileTable):
+			raise LevelFileError("A chunk refers to a tile that is not in the"
+				" palette")
+		self.__resident[(layer, key)] = None
+		self.__evict()
+		return chunk
+
+	def touch(self, layer, key):
+		"""
+		Marks a chunk as recently used
+		"""
+		k = (layer, key)
+		if k in self.__resident:
+			del self.__resident[k]
+			self.__resident[k] = None
+
+	def residentChunks(self):
+		"""
+		@rtype: int
+		@return: the number of chunks from this file that may be dropped
+		"""
+		return len(self.__resident)
+
+	def __evict(self):
+		limit = max(1, preferences.performance["resident_chunks"])
+		if len(self.__resident) <= limit:
+			return
+		for k in list(self.__resident):
+			if len(self.__resident) <= limit:
+				break
+			# Chunks that can't be dropped because they were modified are
+			# registered again after they are saved
+			k[0].dropChunk(k[1])
+			del self.__resident[k]
+
+	def canWriteInPlace(self, tileMap):
+		"""
+		@type tileMap: tilemap.TileMap
+		@param tileMap: the level's tile map
+		@rtype: bool
+		@return: True if the level can be saved by updating this file, False
+			if the whole file should be written again
+		"""
+		if self.__map is None:
+			return False
+		live = tileMap.width * tileMap.height
+		for layer in tileMap.layers:
+			source = layer.getSource()
+			if source is not None and source is not self:
+				return False
+			live += len(layer.chunkKeys()) * CHUNK_BYTES
+		used = self.__end - HEADER_SIZE
+		return used - live <= used * GARBAGE_RATIO
+
+	def writeBack(self, tileMap, world, background):
+		"""
+		Saves the level to this file, writing only the chunks that were
+		modified and appending the ones that are new. New chunks and the new
+		metadata go after the old metadata, and the header only points to
+		them once they are on the disk. If the save is interrupted, the file
+		still opens with the old metadata.
+		"""
+		self.__unmapFile()
+		allOffsets = []
+		try:
+			f = open(self.fileName, "r+b")
+		except IOError as e:
+			self.__mapFile()
+			raise LevelFileError(str(e))
+		try:
+			end = self.__end + self.__metaLength
+			for layer in tileMap.layers:
+				if layer.getSource() is self:
+					offsets = dict(self.__offsets[layer])
+					keys = layer.modifiedChunks()
+				else:
+					# New layers, and layers that were rebuilt by a resize
+					offsets = {}
+					keys = layer.chunkKeys()
+				for key in sorted(keys):
+					chunk = layer.getChunk(key)
+					if chunk is None:
+						continue
+					if key in offsets:
+						f.seek(offsets[key])
+					elif not any(chunk):
+						continue
+					else:
+						offsets[key] = end
+						f.seek(end)
+						end += CHUNK_BYTES
+					f.write(_encodeChunk(chunk))
+				allOffsets.append(offsets)
+
+			if tileMap.width * tileMap.height != self.__blockingSize:
+				self.__blockingOffset = end
+				self.__blockingSize = tileMap.width * tileMap.height
+				end += self.__blockingSize
+			f.seek(self.__blockingOffset)
+			f.write(_encodeBlocking(tileMap.blocking))
+
+			metadata = _encodeMetadata(tileMap, world, background,
+				self.__blockingOffset, allOffsets)
+			f.seek(end)
+			f.write(metadata)
+			f.truncate()
+			f.flush()
+			os.fsync(f.fileno())
+			f.seek(0)
+			f.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION,
+				tilemap.CHUNK_SIZE, end, len(metadata)))
+			f.flush()
+			os.fsync(f.fileno())
+			self.__end = end
+			self.__metaLength = len(metadata)
+		finally:
+			f.close()
+			self.__mapFile()
+
+		self.adopt(tileMap, allOffsets)
+
+	def close(self, keep = ()):
+		"""
+		Unmaps the file. Layers that use this file and are not in keep load
+		all of their chunks into memory first.
+		@type keep: [tilemap.Layer]
+		@param keep: layers that will not need this file any more
+		"""
+		if self.__map is not None:
+			for layer in self.__offsets:
+				if layer.getSource() is self and layer not in keep:
+					layer.detachSource()
+		self.__offsets = {}
+		self.__resident = collections.OrderedDict()
+		self.__unmapFile()
+
+
+class LevelFileError(Exception):
+	def __init__(self, message):
+		self.msg = message
+
+	def __str__(self):
+		return self.msg
+
+
+def unittest():
+	"""
+	Checks that a binary level keeps every edit when its chunks are dropped
+	from memory while it is edited, and that it is the same when it is saved
+	in place and loaded again
+	"""
+	limit = preferences.performance["resident_chunks"]
+	directory = tempfile.mkdtemp()
+	fileName = os.path.join(directory, "test" + EXTENSION)
+	try:
+		# Far fewer chunks may be in memory than a fill touches
+		preferences.performance["resident_chunks"] = 2
+		cs = tilemap.CHUNK_SIZE
+		width = 8 * cs
+		height = 2 * cs
+		tileMap = tilemap.TileMap.createMap(32, width, height)
+		table = tileMap.tileTable
+		first = table.getId(table.intern(0, 0, 0))
+		second = table.getId(table.intern(0, 1, 0))
+		layer = tileMap.layers[0]
+		# Every chunk is saved in the file, so every chunk can be dropped
+		for cx in range(width // cs):
+			for cy in range(height // cs):
+				layer.setTileId(cx * cs, cy * cs, first)
+		write(fileName, tileMap, None, None)
+		tileMap.levelFile.close()
+
+		background, world, tileMap = read(fileName)
+		layer = tileMap.layers[0]
+		runs = array.array("i")
+		for y in range(height):
+			runs.extend([y, 0, width - 1])
+		layer.fillRuns(runs, [[second]], 0, 0)
+		for y in range(height):
+			for x in range(width):
+				assert layer.getTileId(x, y) == second, (x, y)
+		layer.buildIndex()
+		assert layer.countTile(second) == width * height
+		assert layer.countTile(first) == 0
+
+		write(fileName, tileMap, None, None)
+		tileMap.levelFile.close()
+		background, world, tileMap = read(fileName)
+		layer = tileMap.layers[0]
+		for y in range(height):
+			for x in range(width):
+				assert layer.getTileId(x, y) == second, (x, y)
+		tileMap.levelFile.close()
+
+		# A file cut short must be refused when it is opened
+		f = open(fileName, "r+b")
+		f.truncate(os.path.getsize(fileName) // 2)
+		f.close()
+		try:
+			read(fileName)
+		except LevelFileError:
+			pass
+		else:
+			assert False, "a truncated file was read"
+	finally:
+		preferences.performance["resident_chunks"] = limit
+		if os.path.exists(fileName):
+			os.remove(fileName)
+		os.rmdir(directory)
+
+
+if __name__ == "__main__":
+	unittest()
@@ -30,6 +30,12 @@ class BlazeWorld(object):
 		self.gravityX = 0
 		# Units are meters per second per second
 		self.gravityY = -9.8
+		# True if the world has changed since it was last saved
+		self.dirty = True
+		# True to save concave polygons as their convex pieces, for physics
+		# engines that only handle convex shapes. The original polygons are
+		# not kept in the file.
+		self.splitConcave = False
 
 	def addShape(self, s):
 		"""
@@ -38,6 +44,7 @@ class BlazeWorld(object):
 		@param s: Placeholder
 		"""
 		self.__shapes.append(s)
+		self.dirty = True
 
 	def delShape(self, s):
 		"""
@@ -46,6 +53,20 @@ class BlazeWorld(object):
 		"""
 		if s in self.__shapes:
 			self.__shapes.remove(s)
+			self.dirty = True
+
+	def replaceShapes(self, old, new):
+		"""
+		Removes some shapes and adds others in one pass over the shape list
+		@type old: shapes.Shape[]
+		@param old: the shapes to remove
+		@type new: shapes.Shape[]
+		@param new: the shapes to add
+		"""
+		removed = set([id(s) for s in old])
+		self.__shapes = [s for s in self.__shapes if id(s) not in removed]
+		self.__shapes.extend(new)
+		self.dirty = True
 
 	def getShapes(self):
 		"""
@@ -65,6 +86,7 @@ class BlazeWorld(object):
 		@type yOffset: int
 		@param yOffset: y-offset in pixels
 		"""
+		self.dirty = True
 		for s in self.__shapes:
 			s.shift(xOffset, yOffset)
 
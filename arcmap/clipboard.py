@@ -0,0 +1,173 @@
+################################################################################
+# Authors: Brian Schott (Sir Alaran)
+# Copyright: Brian Schott (Sir Alaran)
+# Date: Oct 20 2009
+# License:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+"""
+Holds regions of the map that have been copied so that they can be pasted
+somewhere else, possibly in another map.
+"""
+
+__docformat__ = "epytext"
+
+import array
+import copy
+import logging
+
+log = logging.getLogger("clipboard")
+
+
+class Region(object):
+	"""
+	A rectangle of the map. Tiles are kept as one array of tile ids per layer
+	rather than as Tile objects, so even large regions take little memory and
+	can be copied with a few slices per row.
+	"""
+	def __init__(self, x, y, width, height, tileSize):
+		"""
+		@type x: int
+		@param x: left edge of the region in the map it came from, in tiles
+		@type y: int
+		@param y: top edge of the region in the map it came from, in tiles
+		@type width: int
+		@param width: width in tiles
+		@type height: int
+		@param height: height in tiles
+		@type tileSize: int
+		@param tileSize: size of a tile in pixels
+		"""
+		self.x = x
+		self.y = y
+		self.width = width
+		self.height = height
+		self.tileSize = tileSize
+		# Layer index and array of tile ids, row by row, for each layer
+		self.layers = []
+		# Image information (ix, iy, index) of each tile id used in the layers,
+		# as it was in the tile table of the map that the region came from.
+		# Entry 0 is None.
+		self.images = [None]
+		# File name of the tileset for each image index, as it was in the map
+		# that the region came from. Pasting into another map uses them to
+		# find the same tilesets there.
+		self.tilesets = []
+		# Blocking directions, column by column, or None if the region does
+		# not include blocking
+		self.blocking = None
+		# Shapes inside the region, relative to its top-left corner
+		self.shapes = []
+
+	def getLayerIndices(self):
+		"""
+		@rtype: [int]
+		@return: the indices of the layers in the region
+		"""
+		return [z for z, cells in self.layers]
+
+	def getRows(self, cells, left, top, right, bottom):
+		"""
+		@type cells: array.array
+		@param cells: the tile ids of one of the layers of the region
+		@type left: int
+		@param left: left edge of the part to get, relative to the region
+		@type top: int
+		@param top: top edge of the part to get, relative to the region
+		@type right: int
+		@param right: right edge of the part to get, exclusive
+		@type bottom: int
+		@param bottom: bottom edge of the part to get, exclusive
+		@rtype: [array.array]
+		@return: the tile ids of each row of the part
+		"""
+		w = self.width
+		return [cells[y * w + left:y * w + right] for y in range(top, bottom)]
+
+	def getImageIndices(self):
+		"""
+		@rtype: set
+		@return: the image indices of the tiles used in the layers
+		"""
+		used = set()
+		for z, cells in self.layers:
+			used.update(cells)
+		used.discard(0)
+		return set([self.images[i][2] for i in used])
+
+	def getColumns(self, left, top, right, bottom):
+		"""
+		@rtype: [array.array]
+		@return: the blocking of each column of a part of the region. See
+			getRows for the parameters.
+		"""
+		h = self.height
+		return [self.blocking[x * h + top:x * h + bottom]
+			for x in range(left, right)]
+
+	def placeShapes(self, x, y):
+		"""
+		@type x: int
+		@param x: x-coordinate to place the region at, in pixels
+		@type y: int
+		@param y: y-coordinate to place the region at, in pixels
+		@rtype: [shapes.Shape]
+		@return: new copies of the shapes of the region, moved to the place
+		"""
+		placed = []
+		for shape in self.shapes:
+			shape = copy.deepcopy(shape)
+			shape.shift(x, y)
+			placed.append(shape)
+		return placed
+
+	def empty(self):
+		"""
+		@rtype: Region
+		@return: a region at the same place with the same layers that has no
+			tiles, blocking or shapes
+		"""
+		region = Region(self.x, self.y, self.width, self.height,
+			self.tileSize)
+		region.tilesets = self.tilesets
+		blank = array.array("H", [0]) * (self.width * self.height)
+		region.layers = [(z, blank) for z in self.getLayerIndices()]
+		if self.blocking is not None:
+			region.blocking = array.array("B", [0]) * len(self.blocking)
+		return region
+
+
+# The region that was copied last, or None
+_contents = None
+
+
+def setContents(region):
+	"""
+	@type region: Region
+	@param region: the region to put on the clipboard
+	"""
+	global _contents
+	_contents = region
+	log.debug("Copied a %dx%d region of %d layers" % (region.width,
+		region.height, len(region.layers)))
+
+
+def getContents():
+	"""
+	@rtype: Region
+	@return: the region on the clipboard, or None
+	"""
+	return _contents
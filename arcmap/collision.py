@@ -0,0 +1,379 @@
+################################################################################
+# Authors: Brian Schott (Sir Alaran)
+# Copyright: Brian Schott (Sir Alaran)
+# Date: Oct 20 2009
+# License:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+"""
+Generates physics shapes that cover the solid cells of a map.
+
+Solid areas are made of whole grid cells, so every convex piece of an exact
+cover is a rectangle. The fewest rectangles are found by cutting the areas
+at their concave corners: first along as many non-crossing chords between
+two concave corners as possible, then once more at each concave corner that
+is left. The pieces are then collected by merging the runs of solid cells in
+each row with the runs below them.
+"""
+
+__docformat__ = "epytext"
+
+import logging
+import operator
+import re
+
+import shapes
+
+log = logging.getLogger("collision")
+
+SOLID = "\1"
+EMPTY = "\0"
+
+_runPattern = re.compile(SOLID + "+")
+
+# Translation table that turns any non-zero byte into a solid cell
+_SOLID_TABLE = EMPTY + SOLID * 255
+
+
+def solidRowsFromBlocking(blocking, width, height):
+	"""
+	A cell is solid if any of its edges are blocked
+	@type blocking: [[int]]
+	@param blocking: the blocking information of the map, by column
+	@type width: int
+	@param width: width of the map in tiles
+	@type height: int
+	@param height: height of the map in tiles
+	@rtype: [str]
+	@return: a string for each row with a SOLID byte for each solid cell and
+		an EMPTY byte for the others
+	"""
+	rows = []
+	for y in range(height):
+		row = str(bytearray(map(operator.itemgetter(y), blocking[:width])))
+		rows.append(row.translate(_SOLID_TABLE))
+	return rows
+
+
+def solidRowsFromLayer(layer):
+	"""
+	A cell is solid if the layer has a tile there
+	@type layer: tilemap.Layer
+	@param layer: the layer to read
+	@rtype: [str]
+	@return: a string for each row with a SOLID byte for each solid cell and
+		an EMPTY byte for the others
+	"""
+	return [str(bytearray(map(bool, ids))) for ids in
+		layer.getRows(0, layer.height)]
+
+
+def _runs(row):
+	"""
+	@return: the first and one past the last x-coordinate of each run of
+		solid cells in the row
+	"""
+	return [m.span() for m in _runPattern.finditer(row)]
+
+
+def _cell(rows, x, y):
+	"""
+	@return: True if the cell at (x, y) is solid. Cells outside of the grid
+		are empty.
+	"""
+	if y < 0 or y >= len(rows) or x < 0 or x >= len(rows[y]):
+		return False
+	return rows[y][x] == SOLID
+
+
+def findConcaveCorners(rows, width):
+	"""
+	Finds the grid points at which the outline of the solid cells turns
+	inwards. Three of the four cells around such a point are solid.
+	@type rows: [str]
+	@param rows: solid cells, as returned by solidRowsFromBlocking
+	@type width: int
+	@param width: the number of cells in each row
+	@rtype: [(int, int, int, int)]
+	@return: x, y, horizontal and vertical direction of each corner. The
+		directions are 1 or -1 and point along the two edges of the corner
+		that lie inside the solid area.
+	"""
+	corners = []
+	empty = EMPTY * width
+	for y in range(len(rows) + 1):
+		above = rows[y - 1] if y > 0 else empty
+		below = rows[y] if y < len(rows) else empty
+		if above == below and (above == empty or above.find(EMPTY) == -1):
+			continue
+		# Corners can only be found at the ends of runs
+		candidates = set()
+		for row in (above, below):
+			for start, end in _runs(row):
+				candidates.add(start)
+				candidates.add(end)
+		for x in sorted(candidates):
+			topLeft = x > 0 and above[x - 1] == SOLID
+			topRight = x < width and above[x] == SOLID
+			bottomLeft = x > 0 and below[x - 1] == SOLID
+			bottomRight = x < width and below[x] == SOLID
+			if topLeft + topRight + bottomLeft + bottomRight != 3:
+				continue
+			horizontal = 1 if not (topLeft and bottomLeft) else -1
+			vertical = 1 if not (topLeft and topRight) else -1
+			corners.append((x, y, horizontal, vertical))
+	return corners
+
+
+def _findChords(rows, corners):
+	"""
+	Finds the straight lines between two concave corners that run through
+	the inside of a solid area
+	@return: the horizontal chords as (y, x1, x2) and the vertical chords as
+		(x, y1, y2)
+	"""
+	byRow = {}
+	byColumn = {}
+	for x, y, h, v in corners:
+		byRow.setdefault(y, []).append((x, h))
+		byColumn.setdefault(x, []).append((y, v))
+
+	horizontal = []
+	for y, points in byRow.iteritems():
+		if y == 0 or y == len(rows):
+			continue
+		points.sort()
+		above = rows[y - 1]
+		below = rows[y]
+		for (x1, h1), (x2, h2) in zip(points, points[1:]):
+			if h1 == 1 and h2 == -1 and above.find(EMPTY, x1, x2) == -1 \
+				and below.find(EMPTY, x1, x2) == -1:
+				horizontal.append((y, x1, x2))
+
+	vertical = []
+	for x, points in byColumn.iteritems():
+		points.sort()
+		for (y1, v1), (y2, v2) in zip(points, points[1:]):
+			if v1 != 1 or v2 != -1:
+				continue
+			for y in range(y1, y2):
+				if rows[y][x - 1] != SOLID or rows[y][x] != SOLID:
+					break
+			else:
+				vertical.append((x, y1, y2))
+	return horizontal, vertical
+
+
+def _augment(start, edges, matchLeft, matchRight, visited):
+	"""
+	Looks for an augmenting path from the unmatched left vertex start and
+	flips the matching along it
+	@rtype: bool
+	@return: True if a path was found
+	"""
+	stack = [start]
+	iterators = [iter(edges[start])]
+	through = []
+	while stack:
+		for right in iterators[-1]:
+			if right not in visited:
+				break
+		else:
+			stack.pop()
+			iterators.pop()
+			if through:
+				through.pop()
+			continue
+		visited.add(right)
+		through.append(right)
+		left = matchRight.get(right)
+		if left is None:
+			for left, right in zip(stack, through):
+				matchLeft[left] = right
+				matchRight[right] = left
+			return True
+		stack.append(left)
+		iterators.append(iter(edges[left]))
+	return False
+
+
+def _independentChords(horizontal, vertical):
+	"""
+	Finds the largest set of chords in which no two chords cross or touch.
+	Chords of the same direction never cross, so this is the largest
+	independent set of a bipartite graph. It is found from a maximum
+	matching using Konig's theorem.
+	@return: the indices of the chosen horizontal and vertical chords
+	"""
+	byRow = {}
+	for i, (y, x1, x2) in enumerate(horizontal):
+		byRow.setdefault(y, []).append(i)
+	edges = [[] for h in horizontal]
+	for j, (x, y1, y2) in enumerate(vertical):
+		for y in range(y1, y2 + 1):
+			for i in byRow.get(y, ()):
+				if horizontal[i][1] <= x <= horizontal[i][2]:
+					edges[i].append(j)
+
+	matchLeft = {}
+	matchRight = {}
+	for i in range(len(horizontal)):
+		if edges[i]:
+			_augment(i, edges, matchLeft, matchRight, set())
+
+	# Vertices reachable from unmatched horizontal chords along alternating
+	# paths
+	reachedLeft = set([i for i in range(len(horizontal))
+		if i not in matchLeft])
+	reachedRight = set()
+	stack = list(reachedLeft)
+	while stack:
+		i = stack.pop()
+		for j in edges[i]:
+			if j in reachedRight:
+				continue
+			reachedRight.add(j)
+			k = matchRight.get(j)
+			if k is not None and k not in reachedLeft:
+				reachedLeft.add(k)
+				stack.append(k)
+	return sorted(reachedLeft), [j for j in range(len(vertical))
+		if j not in reachedRight]
+
+
+def _extend(rows, width, x, y, direction, hCuts, vCuts):
+	"""
+	Cuts horizontally from a concave corner into the solid area until the
+	cut reaches the outline or another cut
+	@return: the x-coordinate at which the cut stops
+	"""
+	above = rows[y - 1]
+	below = rows[y]
+	while True:
+		edge = x if direction == 1 else x - 1
+		hCuts.add((edge, y))
+		x += direction
+		if (x, y - 1) in vCuts or (x, y) in vCuts:
+			return x
+		nextEdge = x if direction == 1 else x - 1
+		if nextEdge < 0 or nextEdge >= width or above[nextEdge] != SOLID \
+			or below[nextEdge] != SOLID or (nextEdge, y) in hCuts:
+			return x
+
+
+def partition(rows, width):
+	"""
+	Splits the solid cells into the smallest number of rectangles
+	@type rows: [str]
+	@param rows: solid cells, as returned by solidRowsFromBlocking
+	@type width: int
+	@param width: the number of cells in each row
+	@rtype: [(int, int, int, int)]
+	@return: the left, top, right and bottom edges of each rectangle, in
+		cells. The right and bottom edges are exclusive.
+	"""
+	corners = findConcaveCorners(rows, width)
+	horizontal, vertical = _findChords(rows, corners)
+	chosenH, chosenV = _independentChords(horizontal, vertical)
+
+	# Cuts are stored as the unit edges of the grid that they run along.
+	# Horizontal cuts by the cell below them, vertical ones by the cell to
+	# their right.
+	hCuts = set()
+	vCuts = set()
+	resolved = set()
+	for i in chosenH:
+		y, x1, x2 = horizontal[i]
+		hCuts.update([(x, y) for x in range(x1, x2)])
+		resolved.add((x1, y))
+		resolved.add((x2, y))
+	for j in chosenV:
+		x, y1, y2 = vertical[j]
+		vCuts.update([(x, y) for y in range(y1, y2)])
+		resolved.add((x, y1))
+		resolved.add((x, y2))
+	for x, y, h, v in corners:
+		if (x, y) in resolved:
+			continue
+		end = _extend(rows, width, x, y, h, hCuts, vCuts)
+		resolved.add((end, y))
+
+	splits = {}
+	for x, y in vCuts:
+		splits.setdefault(y, []).append(x)
+
+	# Merge the pieces of each row with identical pieces in the row above
+	rectangles = []
+	current = {}
+	for y, row in enumerate(rows):
+		pieces = []
+		for start, end in _runs(row):
+			for x in sorted(splits.get(y, ())):
+				if start < x < end:
+					pieces.append((start, x))
+					start = x
+			pieces.append((start, end))
+		following = {}
+		for start, end in pieces:
+			rectangle = current.get((start, end))
+			if rectangle is None or (start, y) in hCuts:
+				rectangle = [start, y, end, y + 1]
+				rectangles.append(rectangle)
+			else:
+				rectangle[3] = y + 1
+			following[(start, end)] = rectangle
+		current = following
+	return [tuple(r) for r in rectangles]
+
+
+def toPolygons(rectangles, tileSize):
+	"""
+	@type rectangles: [(int, int, int, int)]
+	@param rectangles: rectangles in cells, as returned by partition
+	@type tileSize: int
+	@param tileSize: size of a cell in pixels
+	@rtype: [shapes.Polygon]
+	@return: a polygon for each rectangle, in pixels
+	"""
+	polygons = []
+	for x1, y1, x2, y2 in rectangles:
+		x1 *= tileSize
+		y1 *= tileSize
+		x2 *= tileSize
+		y2 *= tileSize
+		# Clockwise on the screen, which is the order that the intersection
+		# test expects
+		polygons.append(shapes.Polygon([shapes.Point(x1, y1),
+			shapes.Point(x2, y1), shapes.Point(x2, y2),
+			shapes.Point(x1, y2)]))
+	return polygons
+
+
+def generate(rows, width, tileSize):
+	"""
+	@type rows: [str]
+	@param rows: solid cells, as returned by solidRowsFromBlocking
+	@type width: int
+	@param width: the number of cells in each row
+	@type tileSize: int
+	@param tileSize: size of a cell in pixels
+	@rtype: [shapes.Polygon]
+	@return: convex polygons that exactly cover the solid cells
+	"""
+	rectangles = partition(rows, width)
+	log.info("%d rectangles cover %d solid cells" % (len(rectangles),
+		sum([row.count(SOLID) for row in rows])))
+	return toPolygons(rectangles, tileSize)
@@ -36,6 +36,8 @@ import graphics
 import tilemap
 import datafiles
 import background
+import levelio
+import profiler
 
 class HIGTableBuilder(object):
 	"""Builds table layouts for HIG-compliant dialogs"""
@@ -112,6 +114,26 @@ def UnsavedDialog(window, hasFileName = True):
 	return response
 
 
+def ErrorDialog(window, message, details):
+	"""
+	Tells the user why something could not be done
+	@type window: gtk.Window
+	@param window: the parent window
+	@type message: str
+	@param message: what could not be done
+	@type details: str
+	@param details: why it could not be done
+	"""
+	dialog = gtk.MessageDialog(window,
+		gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+		gtk.MESSAGE_ERROR,
+		gtk.BUTTONS_OK,
+		message)
+	dialog.format_secondary_text(details)
+	dialog.run()
+	dialog.destroy()
+
+
 class PropertiesDialog(gtk.Dialog):
 	""" Dialog for File->Properties """
 
@@ -127,7 +149,7 @@ class PropertiesDialog(gtk.Dialog):
 		self.notebook = gtk.Notebook()
 
 		self.createGeneralTab(controller)
-		self.createSaveTab()
+		self.createSaveTab(controller)
 
 		self.vbox.add(self.notebook)
 		self.show_all()
@@ -143,7 +165,7 @@ class PropertiesDialog(gtk.Dialog):
 		builder.addLabeledWidget("Layers:", self.layers)
 		self.notebook.append_page(builder.table, gtk.Label("General"))
 
-	def createSaveTab(self):
+	def createSaveTab(self, controller):
 		builder = HIGTableBuilder()
 		builder.addSectionHeader("File save options")
 		self.parallaxCheck = gtk.CheckButton("Export _Backgrounds", True)
@@ -152,6 +174,13 @@ class PropertiesDialog(gtk.Dialog):
 		self.physicsCheck = gtk.CheckButton("Export p_hysics information", True)
 		self.physicsCheck.set_active(True)
 		builder.addWidget(self.physicsCheck)
+		self.splitCheck = gtk.CheckButton(
+			"_Split concave polygons into convex pieces", True)
+		self.splitCheck.set_active(controller.getSplitConcave())
+		self.splitCheck.set_tooltip_text("For physics engines that only handle"
+			" convex shapes. The level opens with the pieces instead of the"
+			" original polygons.")
+		builder.addWidget(self.splitCheck)
 		self.notebook.append_page(builder.table, gtk.Label("Save"))
 
 
@@ -243,6 +272,192 @@ class NewDialog(gtk.Dialog):
 		return self.tileSpinButton.get_value_as_int()
 
 
+class CollisionDialog(gtk.Dialog):
+	""" Dialog for Edit->Generate Collision Shapes """
+	def __init__(self, parent, layerNames):
+		"""
+		@type parent: gtk.Window
+		@param parent: the dialog's parent window
+		@type layerNames: [str]
+		@param layerNames: names of the map's layers
+		"""
+		gtk.Dialog.__init__(self, "Generate Collision Shapes", parent,
+			gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+			(gtk.STOCK_CANCEL, gtk.RESPONSE_REJECT, gtk.STOCK_OK,
+			gtk.RESPONSE_ACCEPT))
+
+		builder = HIGTableBuilder()
+
+		builder.addSectionHeader("Solid Cells")
+		self.sourceCombo = gtk.combo_box_new_text()
+		self.sourceCombo.append_text("Blocked tiles")
+		for name in layerNames:
+			self.sourceCombo.append_text("Tiles on layer \"%s\"" % name)
+		self.sourceCombo.set_active(0)
+		builder.addLabeledWidget("_Source:", self.sourceCombo)
+
+		self.vbox.add(builder.getTable())
+		self.vbox.show_all()
+		self.set_resizable(False)
+		self.set_default_response(gtk.RESPONSE_ACCEPT)
+
+	def getLayer(self):
+		"""
+		@rtype: int
+		@return: index of the chosen layer, or None if the blocking
+			information was chosen
+		"""
+		index = self.sourceCombo.get_active()
+		if index <= 0:
+			return None
+		return index - 1
+
+
+class OptimizeShapesDialog(gtk.Dialog):
+	""" Dialog for Edit->Optimize Physics Shapes """
+	def __init__(self, parent):
+		gtk.Dialog.__init__(self, "Optimize Physics Shapes", parent,
+			gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+			(gtk.STOCK_CANCEL, gtk.RESPONSE_REJECT, gtk.STOCK_OK,
+			gtk.RESPONSE_ACCEPT))
+
+		builder = HIGTableBuilder()
+
+		builder.addSectionHeader("Vertices")
+		toleranceAdjustment = gtk.Adjustment(1.0, 0.0, 64.0, 0.5, 4.0)
+		self.toleranceSpin = gtk.SpinButton(toleranceAdjustment, 1.0, 1)
+		builder.addLabeledWidget("_Tolerance (pixels):", self.toleranceSpin)
+		self.snapCheck = gtk.CheckButton("_Snap to half tiles")
+		self.snapCheck.set_active(True)
+		builder.addWidget(self.snapCheck)
+
+		builder.addSectionHeader("Shapes")
+		self.mergeCheck = gtk.CheckButton(
+			"_Merge neighbouring shapes with the same properties")
+		self.mergeCheck.set_active(True)
+		builder.addWidget(self.mergeCheck)
+
+		self.vbox.add(builder.getTable())
+		self.vbox.show_all()
+		self.set_resizable(False)
+		self.set_default_response(gtk.RESPONSE_ACCEPT)
+
+	def getTolerance(self):
+		return self.toleranceSpin.get_value()
+
+	def getSnap(self):
+		return self.snapCheck.get_active()
+
+	def getMerge(self):
+		return self.mergeCheck.get_active()
+
+
+class ProfilerDialog(gtk.Dialog):
+	""" Dialog for View->Profiler """
+	def __init__(self, parent):
+		gtk.Dialog.__init__(self, "Profiler", parent,
+			gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+			(gtk.STOCK_CLOSE, gtk.RESPONSE_CLOSE))
+
+		builder = HIGTableBuilder()
+
+		builder.addSectionHeader("Handlers")
+		# Category, name, calls, total, mean and 95th percentile
+		self.treeModel = gtk.ListStore(str, str, int, str, str, str)
+		self.treeView = gtk.TreeView(self.treeModel)
+		for i, title in enumerate(["Kind", "Handler", "Calls", "Total (ms)",
+			"Mean (ms)", "95% (ms)"]):
+			column = gtk.TreeViewColumn(title, gtk.CellRendererText(), text=i)
+			column.set_sort_column_id(i)
+			self.treeView.append_column(column)
+		scrolled = gtk.ScrolledWindow()
+		scrolled.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+		scrolled.set_shadow_type(gtk.SHADOW_IN)
+		scrolled.set_size_request(560, 240)
+		scrolled.add(self.treeView)
+		builder.addWidget(scrolled)
+
+		builder.addSectionHeader("Frames")
+		self.frameLabel = gtk.Label()
+		self.frameLabel.set_alignment(0, 0)
+		builder.addWidget(self.frameLabel)
+
+		buttons = gtk.HButtonBox()
+		buttons.set_layout(gtk.BUTTONBOX_START)
+		buttons.set_spacing(6)
+		refreshButton = gtk.Button(stock=gtk.STOCK_REFRESH)
+		refreshButton.connect("clicked", self.refreshClicked)
+		buttons.pack_start(refreshButton)
+		clearButton = gtk.Button(stock=gtk.STOCK_CLEAR)
+		clearButton.connect("clicked", self.clearClicked)
+		buttons.pack_start(clearButton)
+		saveButton = gtk.Button(stock=gtk.STOCK_SAVE_AS)
+		saveButton.connect("clicked", self.saveClicked)
+		buttons.pack_start(saveButton)
+		builder.addWidget(buttons)
+
+		if not profiler.enabled:
+			self.frameLabel.set_text("Profiling is off. Start the program " +
+				"with --profile to record timings.")
+			for button in (refreshButton, clearButton, saveButton):
+				button.set_sensitive(False)
+
+		self.vbox.add(builder.getTable())
+		self.refresh()
+		self.vbox.show_all()
+		self.set_default_response(gtk.RESPONSE_CLOSE)
+
+	def refresh(self):
+		"""
+		Shows what has been recorded so far
+		"""
+		if not profiler.enabled:
+			return
+		self.treeModel.clear()
+		for category, name, count, total, p95 in profiler.getStatistics():
+			self.treeModel.append([category, name, count,
+				"%.1f" % (total * 1000.0), "%.3f" % (total * 1000.0 / count),
+				"%.3f" % (p95 * 1000.0)])
+
+		count, mean, p95 = profiler.getFrameStatistics()
+		lines = ["%d recent frames, mean %.1f ms, 95%% %.1f ms" % (count,
+			mean * 1000.0, p95 * 1000.0)]
+		for bound, frames in profiler.getFrameHistogram():
+			if bound is None:
+				label = "slower"
+			else:
+				label = "up to %.1f ms" % (bound * 1000.0)
+			lines.append("%16s: %s %d" % (label, "#" * (40 * frames /
+				max(count, 1)), frames))
+		self.frameLabel.set_markup("<tt>%s</tt>" % "\n".join(lines))
+
+	def refreshClicked(self, widget, data = None):
+		self.refresh()
+
+	def clearClicked(self, widget, data = None):
+		profiler.reset()
+		self.refresh()
+
+	def saveClicked(self, widget, data = None):
+		chooser = gtk.FileChooserDialog("Save Profile", self,
+			gtk.FILE_CHOOSER_ACTION_SAVE, (gtk.STOCK_CANCEL,
+			gtk.RESPONSE_CANCEL, gtk.STOCK_SAVE, gtk.RESPONSE_ACCEPT))
+		chooser.set_do_overwrite_confirmation(True)
+		chooser.set_current_name("profile.json")
+		if chooser.run() == gtk.RESPONSE_ACCEPT:
+			try:
+				profiler.dump(chooser.get_filename())
+			except IOError as e:
+				message = gtk.MessageDialog(chooser,
+					gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+					gtk.MESSAGE_ERROR, gtk.BUTTONS_OK,
+					"The profile could not be saved")
+				message.format_secondary_text(str(e))
+				message.run()
+				message.destroy()
+		chooser.destroy()
+
+
 class ResizeDialog(gtk.Dialog):
 	""" Dialog for resizing the map """
 	def __init__(self, parent, currentWidth, currentHeight, thumbnail):
@@ -674,10 +889,12 @@ class BackgroundDialog(gtk.Dialog):
 			return
 		else:
 			index = self.treeModel.get_path(iter)[0]
-			self.__showEditDialog(self.parallaxes[self.comIndex(index)])
+			if self.__showEditDialog(self.parallaxes[self.comIndex(index)]):
+				self.__preview.updateBackground(self.comIndex(index))
 
 	def rowActivated(self, treeview, path, column):
-		self.__showEditDialog(self.parallaxes[self.comIndex(path[0])])
+		if self.__showEditDialog(self.parallaxes[self.comIndex(path[0])]):
+			self.__preview.updateBackground(self.comIndex(path[0]))
 
 	def visibilityToggle(self, cell, path):
 		p = int(path)
@@ -714,6 +931,7 @@ class PreferencesDialog(gtk.Dialog):
 		self.createVisualTab()
 		self.createFilesTab()
 		self.createPhysicsTab()
+		self.createPerformanceTab()
 		self.vbox.add(self.notebook)
 		self.show_all()
 		self.set_resizable(False)
@@ -841,6 +1059,25 @@ class PreferencesDialog(gtk.Dialog):
 		builder.addWidget(self.tilePreviewLoad)
 		builder.addWidget(self.parallaxPreviewLoad)
 
+		builder.addSectionHeader("Compression")
+
+		self.codecCombo = gtk.combo_box_new_text()
+		for codec in levelio.CODECS:
+			self.codecCombo.append_text(codec)
+		if preferences.files["compression"] in levelio.CODECS:
+			self.codecCombo.set_active(levelio.CODECS.index(
+				preferences.files["compression"]))
+		else:
+			self.codecCombo.set_active(0)
+		self.codecCombo.connect("changed", self.codecChanged)
+		builder.addLabeledWidget("_Compress levels with:", self.codecCombo)
+
+		self.levelSpin = gtk.SpinButton(gtk.Adjustment(
+			preferences.files["compression_level"], 1, 9, 1, 1, 0), 1, 0)
+		self.levelSpin.connect("value-changed", self.compressionLevelChanged)
+		builder.addLabeledWidget("Compression _level:", self.levelSpin)
+		self.codecChanged(self.codecCombo)
+
 		# Call the update functions manually to set up the dialog
 		self.prefixToggled(self.usePrefixes)
 		self.entryEdited(self.parallaxEntry, "parallax_prefix")
@@ -860,6 +1097,13 @@ class PreferencesDialog(gtk.Dialog):
 		self.parallaxPreviewLoad.set_sensitive(button.get_active())
 		preferences.files["use_prefixes"] = button.get_active()
 
+	def codecChanged(self, combo):
+		preferences.files["compression"] = combo.get_active_text()
+		self.levelSpin.set_sensitive(combo.get_active_text() != "none")
+
+	def compressionLevelChanged(self, adjustment):
+		preferences.files["compression_level"] = adjustment.get_value_as_int()
+
 	def entryEdited(self, entry, key):
 		preferences.files[key] = entry.get_text()
 		self.setPreviewText()
@@ -899,3 +1143,31 @@ class PreferencesDialog(gtk.Dialog):
 
 	def physicsSpinChange(self, adjustment, key):
 		preferences.physics[key] = adjustment.get_value()
+
+	def createPerformanceTab(self):
+		builder = HIGTableBuilder()
+		builder.addSectionHeader("Binary Levels")
+
+		chunkSpin = gtk.SpinButton(gtk.Adjustment(
+			preferences.performance["resident_chunks"], 16, 1048576, 256,
+			1024, 0), 1, 0)
+		chunkSpin.connect("value-changed", self.performanceSpinChange,
+			"resident_chunks")
+		builder.addLabeledWidget("_Chunks kept in memory:", chunkSpin)
+
+		builder.addSectionHeader("Rendering")
+		threadSpin = gtk.SpinButton(gtk.Adjustment(
+			preferences.performance["render_threads"], -1, 64, 1, 4, 0), 1, 0)
+		threadSpin.connect("value-changed", self.performanceSpinChange,
+			"render_threads")
+		threadSpin.set_tooltip_text("0 uses one thread for each processor. "
+			+ "-1 renders on the main thread.")
+		builder.addLabeledWidget("Rendering _threads:", threadSpin)
+
+		vbox = gtk.VBox()
+		vbox.set_border_width(0)
+		vbox.pack_start(builder.table, False, False)
+		self.notebook.append_page(vbox, gtk.Label("Performance"))
+
+	def performanceSpinChange(self, adjustment, key):
+		preferences.performance[key] = adjustment.get_value_as_int()
@@ -33,6 +33,7 @@ import mapcontroller
 import shapes
 import dialogs
 import undo
+import clipboard
 
 # Constants for use in the UI code.
 TILE_DRAW_ID = 0
@@ -42,6 +43,9 @@ CIRCLE_DRAW_ID = 3
 POLYGON_DRAW_ID = 4
 LIGHT_DRAW_ID = 5
 BLOCK_DRAW_ID = 6
+FLOOD_FILL_ID = 7
+REGION_SELECT_ID = 8
+TILE_REPLACE_ID = 9
 # Add new codes here for new tools
 
 
@@ -404,13 +408,30 @@ class TileSelectTool(TileTool):
 class TileDrawTool(TileTool):
 	def __init__(self, controller, maxX, maxY):
 		TileTool.__init__(self, controller, maxX, maxY)
-		self.setInstructions("Left-click to draw tiles on the map."
-		+ " Right-click to delete them.")
-
 		# Index of the source image
 		self.__selectionIndex = None
 		# surface for drawing
 		self.__brush = None
+		# True to replace terrain tiles around the drawn ones with the tiles
+		# that fit their neighbours
+		self.__autoTile = True
+		self.__updateInstructions()
+
+	def __updateInstructions(self):
+		if self.__autoTile:
+			state = "on"
+		else:
+			state = "off"
+		self.setInstructions("Left-click to draw tiles on the map."
+			+ " Right-click to delete them. Automatic terrain tiling is %s"
+			% state + " (press A to change).")
+
+	def keyPress(self, key):
+		if key == 97: # a
+			self.__autoTile = not self.__autoTile
+			self.__updateInstructions()
+			return True
+		return False
 
 	def mouseMotion(self, x, y):
 		if self.__selectionIndex is None:
@@ -455,6 +476,8 @@ class TileDrawTool(TileTool):
 		if startX == endX and startY == endY:
 			# Do not repeat the pattern. Overflow of the range is allowed if
 			# the starts and ends are the same
+			eX = sX + self.selectionX2 - self.selectionX1
+			eY = sY + self.selectionY2 - self.selectionY1
 			tempY = sY
 			tempX = sX
 			for i in range(self.selectionX1, self.selectionX2 + 1):
@@ -484,6 +507,10 @@ class TileDrawTool(TileTool):
 					action.appendTileAdd((x, y, z), (ix, iy,
 						self.__selectionIndex),	r)
 
+		if self.__autoTile:
+			for x, y, old, new in controller.retile(z, sX, sY, eX, eY):
+				action.appendTileAdd((x, y, z), new, old)
+
 		controller.addUndoAction(action)
 
 	def draw(self, context):
@@ -539,6 +566,125 @@ class TileDrawTool(TileTool):
 		self.selectionX2 = self.selectionY2 = 0
 
 
+class FloodFillTool(TileTool):
+	"""
+	Fills the area of connected tiles that are the same as the one clicked on
+	with the selected tiles. The whole area is changed at once and undone at
+	once.
+	"""
+	def __init__(self, controller, maxX, maxY):
+		TileTool.__init__(self, controller, maxX, maxY)
+		# Index of the source image
+		self.__selectionIndex = None
+		# surface for drawing
+		self.__brush = None
+		# True to also spread to diagonal neighbours
+		self.__diagonal = False
+		# True to stop at blocked tile edges
+		self.__respectBlocking = False
+		self.__updateInstructions()
+
+	def __updateInstructions(self):
+		if self.__diagonal:
+			connectivity = "diagonally"
+		else:
+			connectivity = "horizontally and vertically"
+		if self.__respectBlocking:
+			blocking = "stops"
+		else:
+			blocking = "does not stop"
+		self.setInstructions("Left-click to fill an area with the selected"
+			+ " tiles. The fill spreads %s (press D to change) and %s at"
+			% (connectivity, blocking)
+			+ " blocked edges (press B to change).")
+
+	def mouseMotion(self, x, y):
+		""" See TileGrid.mouseMotion """
+		if self.__selectionIndex is None:
+			return False
+		return TileTool.mouseMotion(self, x, y)
+
+	def mouseButtonPress(self, button, time):
+		""" See TileGrid.buttonPress """
+		if self.__selectionIndex is None or button != 1:
+			return False
+		TileTool.mouseButtonPress(self, button, time)
+		return False
+
+	def mouseButtonRelease(self, button, time):
+		""" See TileGrid.buttonRelease """
+		if self.__selectionIndex is None or button != 1:
+			return False
+		TileTool.mouseButtonRelease(self, button, time)
+		self.__fill(self.selectX1, self.selectY1)
+		return True
+
+	def keyPress(self, key):
+		if key == 100: # d
+			self.__diagonal = not self.__diagonal
+			self.__updateInstructions()
+			return True
+		if key == 98: # b
+			self.__respectBlocking = not self.__respectBlocking
+			self.__updateInstructions()
+			return True
+		return False
+
+	def __fill(self, x, y):
+		controller = self.getController()
+		if x >= controller.mapWidth() or y >= controller.mapHeight():
+			return
+		z = controller.selectedLayer()
+		table = controller.getTileTable()
+		pattern = []
+		for iy in range(self.selectionY1, self.selectionY2 + 1):
+			pattern.append([table.getId(table.intern(self.__selectionIndex,
+				ix, iy)) for ix in range(self.selectionX1,
+				self.selectionX2 + 1)])
+		oldId, runs = controller.findFillRegion(x, y, z, self.__diagonal,
+			self.__respectBlocking)
+		if len(runs) == 0 or pattern == [[oldId]]:
+			return
+		controller.fillTiles(z, runs, pattern, x, y)
+		controller.addUndoAction(undo.TileFillAction(controller, z, runs,
+			oldId, pattern, x, y))
+
+	def draw(self, context):
+		if self.__brush is None or self.getPointer() == False:
+			return
+		ts = self.getController().mapTileSize()
+		x = self.lastX * ts
+		y = self.lastY * ts
+		context.set_source_surface(self.__brush, x, y)
+		context.rectangle(x, y, ts, ts)
+		context.fill()
+
+		fc = graphics.getHighlightColor()
+		hc = graphics.getBackgroundColor()
+		context.rectangle(x + 0.5, y + 0.5, ts, ts)
+		context.set_source_rgba(fc.r, fc.g, fc.b, 1.0)
+		context.set_line_width(3.0)
+		context.stroke()
+		context.rectangle(x + 0.5, y + 0.5, ts, ts)
+		context.set_source_rgba(hc.r, hc.g, hc.b, 1.0)
+		context.set_line_width(1.0)
+		context.stroke()
+
+	def listenSetSelection(self, index, brush, x1, y1, x2, y2):
+		self.__selectionIndex = index
+		self.__brush = brush
+		self.selectionX1 = int(x1)
+		self.selectionY1 = int(y1)
+		self.selectionX2 = int(x2)
+		self.selectionY2 = int(y2)
+
+	def listenFileClosed(self):
+		self.__selectionIndex = None
+		self.__brush = None
+		self.selectionX1 = self.selectionY1 = 0
+		self.selectionX2 = self.selectionY2 = 0
+
+
 class ShapeTool(EditorTool):
 	"""
 	Base class for tools that draw physics shapes
@@ -573,6 +719,9 @@ class PhysicsSelectTool(ShapeTool):
 		# point for dragging an entire shape, or for dragging a single handle.
 		self.__dragStartX = -1
 		self.__dragStartY = -1
+		# While a shape is dragged it is drawn moved by the distance from the
+		# drag start to the last position. The shape itself is only moved
+		# when the button is released.
 		self.__dragging = False
 		self.__handleIndex = None
 		self.setInstructions("Click and drag to move shapes")
@@ -612,16 +761,20 @@ class PhysicsSelectTool(ShapeTool):
 
 	def mouseButtonRelease(self, button, time):
 		if button == 1:
-			if (self.__dragging == True and
-				(self.__dragLastX != self.__dragStartX
+			if (self.__dragging == True and self.__selectedShape is not None
+				and (self.__dragLastX != self.__dragStartX
 				or self.__dragLastY != self.__dragStartY)):
+				dx = self.__dragLastX - self.__dragStartX
+				dy = self.__dragLastY - self.__dragStartY
+				self.__selectedShape.shift(dx, dy)
 				action = undo.ShapeMoveAction(
 					self.getController(),
 					self.__selectedShape,
-					self.__dragLastX - self.__dragStartX,
-					self.__dragLastY - self.__dragStartY,
+					dx,
+					dy,
 					)
 				self.getController().addUndoAction(action)
+				self.getController().notifyWorldModification()
 			if (self.__handleIndex is not None and (
 				self.__dragLastX != self.__dragStartX
 				or self.__dragLastY != self.__dragStartY)):
@@ -635,6 +788,7 @@ class PhysicsSelectTool(ShapeTool):
 					self.__dragLastY,
 					)
 				self.getController().addUndoAction(action)
+				self.getController().notifyWorldModification()
 			self.__dragging = False
 			self.__handleIndex = None
 
@@ -654,30 +808,35 @@ class PhysicsSelectTool(ShapeTool):
 				self.__dragLastY = tmpY
 				return True
 			elif self.__dragging:
-				dx = self.__dragLastX - tmpX
-				dy = self.__dragLastY - tmpY
-				if dx != 0 or dy != 0:
-					ts = self.getController().mapTileSize()
-					self.__selectedShape.shift(-dx, -dy)
+				if tmpX != self.__dragLastX or tmpY != self.__dragLastY:
 					self.__dragLastX = tmpX
 					self.__dragLastY = tmpY
-					self.getController().notifyModification(True)
 					return True
 		return False
 
 	def draw(self, context):
-		ShapeTool.draw(self, context)
-		if self.__selectedShape is not None:
-			if self.__selectedShape.friction is None:
-				# The friction being None (a completely bogus value) means that
-				# the shape was deleted. Because the shape was deleted in a
-				# callback function, this code to set __selectedShape to None
-				# can't be in the button event handler
-				self.__selectedShape = None
-				return
-			for p in self.__selectedShape.getHandles():
-				graphics.drawPointHandle(context, p)
-			graphics.drawMoveHandle(context, self.__selectedShape.getCenter())
+		shape = self.__selectedShape
+		if shape is not None and shape.friction is None:
+			# The friction being None (a completely bogus value) means that
+			# the shape was deleted. Because the shape was deleted in a
+			# callback function, this code to set __selectedShape to None
+			# can't be in the button event handler
+			self.__selectedShape = None
+			shape = None
+		# The selected shape is left out of the overlay and drawn here, so
+		# that dragging it doesn't draw the other shapes again
+		self.getController().drawShapes(context, shape)
+		if shape is None:
+			return
+		context.save()
+		if self.__dragging:
+			context.translate(self.__dragLastX - self.__dragStartX,
+				self.__dragLastY - self.__dragStartY)
+		graphics.drawShape(shape, context)
+		for p in shape.getHandles():
+			graphics.drawPointHandle(context, p)
+		graphics.drawMoveHandle(context, shape.getCenter())
+		context.restore()
 
 	def popupShapeMenu(self, shape, button, time):
 		"""
@@ -693,8 +852,15 @@ class PhysicsSelectTool(ShapeTool):
 		deleteItem.connect("activate", self.deleteCB, shape)
 		propertiesItem = gtk.ImageMenuItem(gtk.STOCK_PROPERTIES)
 		propertiesItem.connect("activate", self.propertiesCB, shape)
+		splitItem = gtk.MenuItem("_Split into Convex Pieces")
+		# The shape is only decomposed if the item is chosen
+		if hasattr(shape, "concave") and shape.concave():
+			splitItem.connect("activate", self.splitCB, shape)
+		else:
+			splitItem.set_sensitive(False)
 		menu.attach(deleteItem, 0, 1, 0, 1)
 		menu.attach(propertiesItem, 0, 1, 1, 2)
+		menu.attach(splitItem, 0, 1, 2, 3)
 		menu.show_all()
 		menu.popup(None, None, None, button, time)
 
@@ -711,6 +877,25 @@ class PhysicsSelectTool(ShapeTool):
 		self.getController().addUndoAction(action)
 		self.getController().removeShape(shape)
 
+	def splitCB(self, menuitem, shape):
+		"""
+		callback for the split item in popupShapeMenu
+		@type menuitem: gtk.MenuItem
+		@param menuitem: ignored
+		@type shape: shapes.Polygon
+		@param shape: the concave shape to replace with convex pieces
+		"""
+		pieces = shape.decompose()
+		if pieces is None:
+			dialogs.ErrorDialog(self.getController().getToplevel(),
+				"The shape could not be split",
+				"Its outline crosses itself or has no area.")
+			return
+		self.__selectedShape = None
+		action = undo.ShapeSplitAction(self.getController(), shape, pieces)
+		self.getController().addUndoAction(action)
+		action.redo()
+
 	def propertiesCB(self, menuitem, shape):
 		"""
 		callback for the properties item in popupShapeMenu
@@ -726,7 +911,7 @@ class PhysicsSelectTool(ShapeTool):
 			shape.friction = d.getFriction()
 			shape.damage = d.getDamage()
 			shape.restitution = d.getRestitution()
-			self.getController().notifyModification(True)
+			self.getController().notifyWorldModification()
 		d.destroy()
 
 	def selectShape(self, x, y):
@@ -929,3 +1114,282 @@ class BlockTool(TileSelectTool):
 
 	def mouseButtonRelease(self, button, time):
 		TileTool.mouseButtonRelease(self, button, time)
+
+
+class RegionTool(TileTool):
+	"""
+	Copies, cuts and pastes rectangular regions of the map. A region includes
+	the tiles of the chosen layers and the blocking information, and can also
+	include the shapes that lie completely inside it. Pasting or cutting is
+	undone as a single action.
+	"""
+	def __init__(self, controller, maxX, maxY):
+		TileTool.__init__(self, controller, maxX, maxY)
+		# True to copy every visible layer, False for only the selected one
+		self.__allLayers = True
+		# True to copy the shapes inside the region
+		self.__withShapes = False
+		self.__updateInstructions()
+
+	def __updateInstructions(self):
+		if self.__allLayers:
+			layers = "all visible layers"
+		else:
+			layers = "the selected layer"
+		if self.__withShapes:
+			shapes = "with"
+		else:
+			shapes = "without"
+		self.setInstructions("Click and drag to select a region. Press C to"
+			+ " copy it, X to cut it and V to paste at the mouse. Copies %s"
+			% layers + " (press L to change) %s shapes (press S to change)."
+			% shapes)
+
+	def __selectedLayers(self):
+		controller = self.getController()
+		if not self.__allLayers:
+			return [controller.selectedLayer()]
+		return [z for z, (name, visible) in
+			enumerate(controller.getLayerInfo()) if visible]
+
+	def __hasSelection(self):
+		return self.selectX1 >= 0 and self.selectY1 >= 0 \
+			and not self.buttonDown
+
+	def __copy(self):
+		controller = self.getController()
+		region = controller.copyRegion(self.selectX1, self.selectY1,
+			self.selectX2 + 1, self.selectY2 + 1, self.__selectedLayers(),
+			True, self.__withShapes)
+		clipboard.setContents(region)
+		return region
+
+	def __cut(self):
+		controller = self.getController()
+		region = self.__copy()
+		removed = []
+		if self.__withShapes:
+			removed = controller.getShapesInRegion(region.x, region.y,
+				region.x + region.width, region.y + region.height)
+		action = undo.RegionAction(controller, region.empty(), region.x,
+			region.y, removed, [])
+		action.setDescription("cut region")
+		controller.addUndoAction(action)
+		action.redo()
+
+	def __paste(self):
+		region = clipboard.getContents()
+		if region is None:
+			return
+		controller = self.getController()
+		missing = controller.missingTilesets(region)
+		if missing:
+			dialogs.ErrorDialog(controller.getToplevel(),
+				"The region could not be pasted",
+				"It uses tilesets that are not open in this map:\n"
+				+ "\n".join(missing))
+			return
+		ts = controller.mapTileSize()
+		x, y = coordsToTiles(self.x(), self.y(), ts)
+		added = region.placeShapes(x * ts, y * ts)
+		action = undo.RegionAction(controller, region, x, y, [], added)
+		controller.addUndoAction(action)
+		action.redo()
+
+	def keyPress(self, key):
+		if key == 99 and self.__hasSelection(): # c
+			self.__copy()
+			return True
+		if key == 120 and self.__hasSelection(): # x
+			self.__cut()
+			return True
+		if key == 118: # v
+			self.__paste()
+			return True
+		if key == 108: # l
+			self.__allLayers = not self.__allLayers
+			self.__updateInstructions()
+			return True
+		if key == 115: # s
+			self.__withShapes = not self.__withShapes
+			self.__updateInstructions()
+			return True
+		return False
+
+	def draw(self, context):
+		ts = self.getController().mapTileSize()
+		fc = graphics.getHighlightColor()
+		hc = graphics.getBackgroundColor()
+		if self.selectX1 >= 0 and self.selectY1 >= 0:
+			x, y, w, h = rectangleSelect(self.selectX1, self.selectY1,
+				self.selectX2, self.selectY2, ts)
+			context.set_source_rgba(fc.r, fc.g, fc.b, 0.25)
+			context.rectangle(x, y, w, h)
+			context.fill()
+			context.rectangle(x + 0.5, y + 0.5, w, h)
+			context.set_source_rgba(fc.r, fc.g, fc.b, 1.0)
+			context.set_line_width(3.0)
+			context.stroke()
+
+		# Outline of where the clipboard would be pasted
+		region = clipboard.getContents()
+		if region is None or self.getPointer() == False or self.buttonDown:
+			return
+		x, y = coordsToTiles(self.x(), self.y(), ts)
+		context.rectangle(x * ts + 0.5, y * ts + 0.5, region.width * ts,
+			region.height * ts)
+		context.set_source_rgba(hc.r, hc.g, hc.b, 1.0)
+		context.set_line_width(1.0)
+		context.set_dash([4.0, 2.0])
+		context.stroke()
+		context.set_dash([])
+
+	def listenFileClosed(self):
+		self.selectX1 = self.selectY1 = -1
+		self.selectX2 = self.selectY2 = -1
+
+
+class TileReplaceTool(TileTool):
+	"""
+	Finds every cell that uses a tile and replaces the tile with the one
+	selected in the palette. The search can be limited to an area of the map.
+	"""
+	def __init__(self, controller, maxX, maxY):
+		TileTool.__init__(self, controller, maxX, maxY)
+		# Id of the tile to find, or 0
+		self.__findId = 0
+		# Id of the tile selected in the palette, or 0
+		self.__replaceId = 0
+		# True to search every visible layer, False for only the selected one
+		self.__allLayers = False
+		# Layer index and runs of cells of every use of the tile found
+		self.__uses = []
+		self.__updateInstructions()
+
+	def __updateInstructions(self):
+		if self.__allLayers:
+			layers = "all visible layers"
+		else:
+			layers = "the selected layer"
+		self.setInstructions("Right-click a tile to find every use of it."
+			+ " Click and drag to only search an area, click once to search"
+			+ " the whole map. Press R to replace the tiles with the one"
+			+ " selected in the palette or Delete to remove them. Searches %s"
+			% layers + " (press L to change).")
+
+	def __layers(self):
+		controller = self.getController()
+		if not self.__allLayers:
+			return [controller.selectedLayer()]
+		return [z for z, (name, visible) in
+			enumerate(controller.getLayerInfo()) if visible]
+
+	def __area(self):
+		"""
+		@return: the area to search, or the whole map if no area is selected
+		"""
+		if self.selectX1 < 0 or (self.selectX1 == self.selectX2
+			and self.selectY1 == self.selectY2):
+			return 0, 0, None, None
+		return self.selectX1, self.selectY1, self.selectX2 + 1, \
+			self.selectY2 + 1
+
+	def __find(self):
+		if self.__findId == 0:
+			self.__uses = []
+			return
+		x1, y1, x2, y2 = self.__area()
+		self.__uses = self.getController().findTileUses(self.__findId,
+			self.__layers(), x1, y1, x2, y2)
+
+	def __replace(self, newId):
+		if self.__findId == 0 or self.__findId == newId:
+			return
+		controller = self.getController()
+		x1, y1, x2, y2 = self.__area()
+		uses = controller.replaceTileUses(self.__findId, newId,
+			self.__layers(), x1, y1, x2, y2)
+		if uses:
+			controller.addUndoAction(undo.TileReplaceAction(controller, uses,
+				self.__findId, newId))
+		self.__uses = []
+
+	def mouseMotion(self, x, y):
+		TileTool.mouseMotion(self, x, y)
+		return self.buttonDown
+
+	def mouseButtonPress(self, button, time):
+		if button == 3:
+			controller = self.getController()
+			x, y = coordsToTiles(self.x(), self.y(), controller.mapTileSize())
+			info = controller.getTile(x, y, controller.selectedLayer())
+			if info is None:
+				self.__findId = 0
+			else:
+				ix, iy, index = info
+				table = controller.getTileTable()
+				self.__findId = table.getId(table.intern(index, ix, iy))
+			self.__find()
+			return True
+		return TileTool.mouseButtonPress(self, button, time)
+
+	def mouseButtonRelease(self, button, time):
+		if button != 1:
+			return False
+		TileTool.mouseButtonRelease(self, button, time)
+		self.__find()
+		return True
+
+	def keyPress(self, key):
+		if key == 114: # r
+			if self.__replaceId != 0:
+				self.__replace(self.__replaceId)
+			return True
+		if key == 65535: # delete
+			self.__replace(0)
+			return True
+		if key == 108: # l
+			self.__allLayers = not self.__allLayers
+			self.__updateInstructions()
+			self.__find()
+			return True
+		return False
+
+	def draw(self, context):
+		ts = self.getController().mapTileSize()
+		fc = graphics.getHighlightColor()
+		x1, y1, x2, y2 = self.__area()
+		if x2 is not None or self.buttonDown:
+			x, y, w, h = rectangleSelect(self.selectX1, self.selectY1,
+				self.selectX2, self.selectY2, ts)
+			context.rectangle(x + 0.5, y + 0.5, w, h)
+			context.set_source_rgba(fc.r, fc.g, fc.b, 1.0)
+			context.set_line_width(3.0)
+			context.stroke()
+
+		context.set_source_rgba(fc.r, fc.g, fc.b, 0.5)
+		for z, runs in self.__uses:
+			for i in range(0, len(runs), 3):
+				context.rectangle(runs[i + 1] * ts, runs[i] * ts,
+					(runs[i + 2] - runs[i + 1] + 1) * ts, ts)
+		context.fill()
+
+	def listenSetSelection(self, index, brush, x1, y1, x2, y2):
+		if index is None:
+			self.__replaceId = 0
+			return
+		table = self.getController().getTileTable()
+		self.__replaceId = table.getId(table.intern(index, int(x1), int(y1)))
+
+	def listenSelectLayer(self, index):
+		self.__find()
+
+	def listenUndoRedo(self):
+		self.__find()
+
+	def listenFileClosed(self):
+		self.__findId = 0
+		self.__replaceId = 0
+		self.__uses = []
+		self.selectX1 = self.selectY1 = -1
+		self.selectX2 = self.selectY2 = -1
@@ -0,0 +1,213 @@
+################################################################################
+# Authors: Brian Schott (Sir Alaran)
+# Copyright: Brian Schott (Sir Alaran)
+# Date: Oct 20 2009
+# License:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+"""
+Queues notifications and delivers them to the handlers that asked for them
+once the main loop is idle
+"""
+
+__docformat__ = "epytext"
+
+import logging
+import time
+
+import gobject
+
+import profiler
+
+log = logging.getLogger("eventbus")
+
+
+def handlerName(handler):
+	"""
+	@rtype: str
+	@return: a name for a handler that is readable in statistics
+	"""
+	owner = getattr(handler, "im_self", None)
+	if owner is not None:
+		return "%s.%s" % (owner.__class__.__name__, handler.__name__)
+	return getattr(handler, "__name__", repr(handler))
+
+
+class EventBus(object):
+	"""
+	Events are posted with a type and arguments. They are kept in a queue
+	until the main loop is idle and then handed to every handler subscribed
+	to their type, in the order they were posted.
+
+	Events of some types are coalesced when they are posted again before
+	they were delivered. For types whose events can be handled twice with
+	the same result, such as a tile being added, an event replaces an
+	earlier one with the same arguments. For types that only report the
+	latest state, such as whether the map has been modified, an event
+	replaces any earlier event of the same type. Events of every other type,
+	such as a layer being added, are all delivered.
+	"""
+	def __init__(self):
+		# Event type to list of handlers
+		self.__handlers = {}
+		# Event types for which only the latest event is delivered
+		self.__latestOnly = set()
+		# Event types whose events replace earlier ones with the same
+		# arguments
+		self.__idempotent = set()
+		# Events waiting to be delivered. Coalesced events are set to None.
+		self.__queue = []
+		# Coalescing key to the position of the event in the queue
+		self.__positions = {}
+		self.__scheduled = False
+		# Handler name and event type to number of calls and seconds spent
+		self.__statistics = {}
+		self.posted = 0
+		self.coalesced = 0
+
+	def subscribe(self, eventType, handler):
+		"""
+		@type eventType: str
+		@param eventType: the type of event to receive
+		@type handler: callable
+		@param handler: called with the arguments of each event of the type
+		"""
+		self.__handlers.setdefault(eventType, []).append(handler)
+
+	def unsubscribe(self, eventType, handler):
+		"""
+		@type eventType: str
+		@param eventType: the type of event to stop receiving
+		@type handler: callable
+		@param handler: a handler passed to subscribe
+		"""
+		handlers = self.__handlers.get(eventType, [])
+		if handler in handlers:
+			handlers.remove(handler)
+
+	def setLatestOnly(self, eventType):
+		"""
+		@type eventType: str
+		@param eventType: a type of event that reports a state, so that
+			handlers only need to see the latest one
+		"""
+		self.__latestOnly.add(eventType)
+
+	def setIdempotent(self, eventType):
+		"""
+		@type eventType: str
+		@param eventType: a type of event that has the same effect when it is
+			handled twice, so that repeated events with the same arguments
+			only need to be delivered once
+		"""
+		self.__idempotent.add(eventType)
+
+	def __key(self, eventType, args):
+		"""
+		@return: the key that the event is coalesced by, or None if it is
+			never coalesced
+		"""
+		if eventType in self.__latestOnly:
+			return eventType
+		if eventType not in self.__idempotent:
+			return None
+		key = (eventType, args)
+		try:
+			hash(key)
+		except TypeError:
+			key = (eventType, tuple([id(a) for a in args]))
+		return key
+
+	def post(self, eventType, *args):
+		"""
+		Queues an event and makes sure that the queue is delivered when the
+		main loop is idle
+		@type eventType: str
+		@param eventType: the type of the event
+		"""
+		self.posted += 1
+		key = self.__key(eventType, args)
+		if key is not None:
+			position = self.__positions.get(key)
+			if position is not None:
+				self.__queue[position] = None
+				self.coalesced += 1
+			self.__positions[key] = len(self.__queue)
+		self.__queue.append((eventType, args))
+		if not self.__scheduled:
+			self.__scheduled = True
+			# Before redrawing, so that handlers can queue their redraws
+			# for the same frame
+			gobject.idle_add(self.__idle, priority=gobject.PRIORITY_HIGH_IDLE)
+
+	def __idle(self):
+		self.flush()
+		return False
+
+	def pending(self):
+		"""
+		@rtype: int
+		@return: the number of events waiting to be delivered
+		"""
+		return len(self.__queue) - self.__queue.count(None)
+
+	def flush(self):
+		"""
+		Delivers the queued events now. Events that handlers post are
+		delivered after the ones that were already queued.
+		"""
+		self.__scheduled = False
+		while self.__queue:
+			queue = self.__queue
+			self.__queue = []
+			self.__positions = {}
+			for event in queue:
+				if event is None:
+					continue
+				eventType, args = event
+				for handler in list(self.__handlers.get(eventType, ())):
+					self.__dispatch(handler, eventType, args)
+
+	def __dispatch(self, handler, eventType, args):
+		start = time.time()
+		try:
+			handler(*args)
+		except Exception:
+			log.exception("%s failed to handle %s" % (handlerName(handler),
+				eventType))
+		elapsed = time.time() - start
+		name = handlerName(handler)
+		statistic = self.__statistics.setdefault((name, eventType), [0, 0.0])
+		statistic[0] += 1
+		statistic[1] += elapsed
+		if profiler.enabled:
+			profiler.record("listener", name, elapsed)
+
+	def getStatistics(self):
+		"""
+		@rtype: [(str, str, int, float)]
+		@return: handler name, event type, number of calls and seconds spent
+			for every handler that has been called, the slowest first
+		"""
+		result = [(name, eventType, count, seconds) for (name, eventType),
+			(count, seconds) in self.__statistics.iteritems()]
+		result.sort(key=lambda s: s[3], reverse=True)
+		return result
+
+	def resetStatistics(self):
+		self.__statistics = {}
+		self.posted = 0
+		self.coalesced = 0
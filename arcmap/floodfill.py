@@ -0,0 +1,338 @@
+################################################################################
+# Authors: Brian Schott (Sir Alaran)
+# Copyright: Brian Schott (Sir Alaran)
+# Date: Oct 20 2009
+# License:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+"""
+Finds the area covered by a flood fill on a map layer
+"""
+
+__docformat__ = "epytext"
+
+import array
+import logging
+import operator
+
+import tilemap
+
+log = logging.getLogger("floodfill")
+
+# Blocking bits, as used by the BlockTool
+BLOCK_UP = 1
+BLOCK_RIGHT = 2
+BLOCK_DOWN = 4
+BLOCK_LEFT = 8
+
+def _bitTable(bit):
+	"""
+	@rtype: str
+	@return: a translation table that turns a blocking value into 1 if it has
+		the given bit set and 0 otherwise
+	"""
+	return "".join([chr(int(i & bit != 0)) for i in range(256)])
+
+_BIT_TABLES = dict([(bit, _bitTable(bit)) for bit in (BLOCK_UP, BLOCK_RIGHT,
+	BLOCK_DOWN, BLOCK_LEFT)])
+
+
+def _orBytes(a, b):
+	"""
+	@type a: str
+	@param a: a string of 0 and 1 bytes
+	@type b: str
+	@param b: a string of 0 and 1 bytes of the same length
+	@rtype: str
+	@return: a string that has a 1 byte wherever a or b has one
+	"""
+	if not a:
+		return a
+	value = int(a.encode("hex"), 16) | int(b.encode("hex"), 16)
+	return ("%x" % value).zfill(len(a) * 2).decode("hex")
+
+
+class _Region(object):
+	"""
+	State of a single fill. Rows of the layer are copied into byte arrays of
+	tile ids the first time they are needed, and tiles are marked as filled
+	in these copies. All searching along a row is done with string
+	operations, so the time spent per tile is very small.
+	"""
+	def __init__(self, layer, blocking, targetId, diagonal, respectBlocking):
+		self.layer = layer
+		self.width = layer.width
+		self.height = layer.height
+		self.blocking = blocking
+		self.diagonal = diagonal
+		self.respectBlocking = respectBlocking
+		self.target = array.array("H", [targetId]).tostring()
+		# Value that marks tiles that have been filled
+		self.mark = array.array("H", [targetId ^ 0xffff]).tostring()
+		# Dictionary of count to the target repeated count times
+		self.__repeated = {}
+		self.__rows = {}
+		self.__blockRows = {}
+		self.__horizontalWalls = {}
+		self.__verticalWalls = {}
+
+	def row(self, y):
+		row = self.__rows.get(y)
+		if row is None:
+			# Copy the whole band of rows that shares chunks with this one
+			top = y - y % tilemap.CHUNK_SIZE
+			for i, ids in enumerate(self.layer.getRows(top,
+				top + tilemap.CHUNK_SIZE)):
+				if top + i not in self.__rows:
+					self.__rows[top + i] = bytearray(ids.tostring())
+			row = self.__rows[y]
+		return row
+
+	def isTarget(self, row, x):
+		return row[x * 2:x * 2 + 2] == self.target
+
+	def repeated(self, count):
+		"""
+		@return: the target id repeated count times. count is a power of two.
+		"""
+		run = self.__repeated.get(count)
+		if run is None:
+			run = self.target * count
+			self.__repeated[count] = run
+		return run
+
+	def runStart(self, row, x):
+		"""
+		@return: the first x-coordinate of the run of target tiles that
+			contains x
+		"""
+		# Compare ever longer pieces of the row at once, then shorter ones
+		count = 1
+		while count <= x and row[(x - count) * 2:x * 2] == self.repeated(count):
+			x -= count
+			count *= 2
+		while count > 1:
+			count //= 2
+			if count <= x and row[(x - count) * 2:x * 2] \
+				== self.repeated(count):
+				x -= count
+		return x
+
+	def runEnd(self, row, x):
+		"""
+		@return: the last x-coordinate of the run of target tiles that starts
+			at x
+		"""
+		end = x + 1
+		count = 1
+		while end + count <= self.width \
+			and row[end * 2:(end + count) * 2] == self.repeated(count):
+			end += count
+			count *= 2
+		while count > 1:
+			count //= 2
+			if end + count <= self.width \
+				and row[end * 2:(end + count) * 2] == self.repeated(count):
+				end += count
+		return end - 1
+
+	def runsBetween(self, row, x1, x2):
+		"""
+		@return: an iterator of the first and last x-coordinates of the runs
+			of target tiles between x1 and x2. Runs are cut off at x1 and x2.
+		"""
+		pos = x1 * 2
+		end = (x2 + 1) * 2
+		while pos < end:
+			start = row.find(self.target, pos, end)
+			if start == -1:
+				return
+			if start % 2 == 1:
+				# The match is made of the bytes of two different tiles
+				pos = start + 1
+				continue
+			last = min(self.runEnd(row, start // 2), x2)
+			yield start // 2, last
+			pos = (last + 1) * 2
+
+	def fill(self, row, x1, x2):
+		row[x1 * 2:(x2 + 1) * 2] = self.mark * (x2 - x1 + 1)
+
+	def blockRow(self, y):
+		row = self.__blockRows.get(y)
+		if row is None:
+			row = str(bytearray(map(operator.itemgetter(y), self.blocking)))
+			self.__blockRows[y] = row
+		return row
+
+	def horizontalWalls(self, y):
+		"""
+		@rtype: str
+		@return: a string with a 1 byte for each x-coordinate from which the
+			tile to the right can't be reached, and a 0 byte otherwise
+		"""
+		walls = self.__horizontalWalls.get(y)
+		if walls is None:
+			row = self.blockRow(y)
+			walls = _orBytes(row.translate(_BIT_TABLES[BLOCK_RIGHT]),
+				(row[1:] + "\0").translate(_BIT_TABLES[BLOCK_LEFT]))
+			self.__horizontalWalls[y] = walls
+		return walls
+
+	def verticalWalls(self, y):
+		"""
+		@rtype: str
+		@return: a string with a 1 byte for each x-coordinate at which row y+1
+			can't be reached from row y, and a 0 byte otherwise
+		"""
+		walls = self.__verticalWalls.get(y)
+		if walls is None:
+			walls = _orBytes(
+				self.blockRow(y).translate(_BIT_TABLES[BLOCK_DOWN]),
+				self.blockRow(y + 1).translate(_BIT_TABLES[BLOCK_UP]))
+			self.__verticalWalls[y] = walls
+		return walls
+
+
+def findRegion(layer, blocking, x, y, diagonal = False,
+	respectBlocking = False):
+	"""
+	Finds the tiles that a flood fill started at (x, y) reaches. These are
+	the tiles that have the same id as the one at (x, y) and are connected to
+	it.
+	@type layer: tilemap.Layer
+	@param layer: the layer to fill
+	@type blocking: [[int]]
+	@param blocking: the blocking information of the map, by column
+	@type x: int
+	@param x: x-coordinate to start at
+	@type y: int
+	@param y: y-coordinate to start at
+	@type diagonal: bool
+	@param diagonal: True to also spread to diagonal neighbours
+	@type respectBlocking: bool
+	@param respectBlocking: True to stop at the blocked edges of tiles
+	@rtype: (int, array.array)
+	@return: the id of the tiles in the region and the y, first x and last x
+		of each horizontal run of tiles in the region, one after the other
+	"""
+	runs = array.array("i")
+	if x < 0 or y < 0 or x >= layer.width or y >= layer.height:
+		return 0, runs
+	targetId = layer.getTileId(x, y)
+	region = _Region(layer, blocking, targetId, diagonal, respectBlocking)
+	stack = [(x, y)]
+	while stack:
+		x, y = stack.pop()
+		row = region.row(y)
+		if not region.isTarget(row, x):
+			continue
+		x1 = region.runStart(row, x)
+		x2 = region.runEnd(row, x1)
+		if respectBlocking:
+			walls = region.horizontalWalls(y)
+			wall = walls.rfind("\1", x1, x)
+			if wall != -1:
+				x1 = wall + 1
+			wall = walls.find("\1", x, x2)
+			if wall != -1:
+				x2 = wall
+		region.fill(row, x1, x2)
+		runs.extend((y, x1, x2))
+		for ny in (y - 1, y + 1):
+			if ny < 0 or ny >= region.height:
+				continue
+			if respectBlocking:
+				_pushBlocked(region, stack, y, ny, x1, x2)
+			else:
+				_pushOpen(region, stack, ny, x1, x2)
+	return targetId, runs
+
+
+def _pushOpen(region, stack, ny, x1, x2):
+	"""
+	Adds a starting point for every run of target tiles in row ny that
+	touches the run from x1 to x2 in the row next to it
+	"""
+	if region.diagonal:
+		x1 = max(x1 - 1, 0)
+		x2 = min(x2 + 1, region.width - 1)
+	for start, end in region.runsBetween(region.row(ny), x1, x2):
+		stack.append((start, ny))
+
+
+def _pushBlocked(region, stack, y, ny, x1, x2):
+	"""
+	Adds starting points in row ny for the tiles that can be reached from the
+	run from x1 to x2 in row y without crossing a blocked edge
+	"""
+	row = region.row(ny)
+	vertical = region.verticalWalls(min(y, ny))
+	horizontal = region.horizontalWalls(ny)
+	if region.diagonal:
+		entries = _diagonalEntries(vertical, horizontal, x1, x2)
+		offset = x1
+	else:
+		entries = vertical
+		offset = 0
+	for start, end in region.runsBetween(row, x1, x2):
+		x = start
+		while x <= end:
+			# First column in this part of the run that can be entered
+			entry = entries.find("\0", x - offset, end + 1 - offset)
+			if entry == -1:
+				break
+			entry += offset
+			stack.append((entry, ny))
+			# Walls inside the run split it into parts that have to be
+			# entered separately
+			wall = horizontal.find("\1", entry, end)
+			if wall == -1:
+				break
+			x = wall + 1
+	if not region.diagonal:
+		return
+	# A diagonal step is allowed if either of the two paths around the corner
+	# is open
+	walls = region.horizontalWalls(y)
+	if x1 > 0 and region.isTarget(row, x1 - 1):
+		if (vertical[x1] == "\0" and horizontal[x1 - 1] == "\0") \
+			or (walls[x1 - 1] == "\0" and vertical[x1 - 1] == "\0"):
+			stack.append((x1 - 1, ny))
+	if x2 < region.width - 1 and region.isTarget(row, x2 + 1):
+		if (vertical[x2] == "\0" and horizontal[x2] == "\0") \
+			or (walls[x2] == "\0" and vertical[x2 + 1] == "\0"):
+			stack.append((x2 + 1, ny))
+
+
+def _diagonalEntries(vertical, horizontal, x1, x2):
+	"""
+	@return: a string with a 0 byte for each x-coordinate from x1 to x2 at
+		which the row next to a run from x1 to x2 can be entered either
+		straight or by going around the corner from a neighbouring column of
+		the run, and a 1 byte otherwise
+	"""
+	n = x2 - x1 + 1
+	full = int("01" * n, 16)
+	v = int(vertical[x1:x2 + 1].encode("hex"), 16)
+	h = int(horizontal[x1:x2 + 1].encode("hex"), 16)
+	# Blocked from the column to the left. The first column has no left
+	# neighbour in the run.
+	left = ((v | h) >> 8) | (1 << (8 * (n - 1)))
+	# Blocked from the column to the right. The last column has no right
+	# neighbour in the run.
+	right = ((v << 8) & full) | 1 | h
+	return ("%x" % (v & left & right)).zfill(n * 2).decode("hex")
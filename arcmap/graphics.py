@@ -37,6 +37,10 @@ import preferences
 
 log = logging.getLogger("graphics")
 
+# Screen pixels around the exposed area that ShapeOverlay draws as well, so
+# that small scrolls don't draw the shapes again
+OVERLAY_MARGIN = 128
+
 def getBackgroundColor():
 	"""
 	@rtype: RGBA
@@ -301,6 +305,98 @@ def drawCircle(context, shape, outlineColor, fillColor,	handles = False):
 			drawPointHandle(context, point)
 
 
+class ShapeOverlay(object):
+	"""
+	Keeps the physics shapes drawn on a surface in screen pixels, so that
+	exposing the map only copies them instead of stroking and filling every
+	shape again. The surface covers the exposed area and a margin around it.
+	It is drawn again when the shapes change, the zoom changes, the exposed
+	area moves outside of it, or a different shape is left out.
+	"""
+	def __init__(self):
+		self.__surface = None
+		# Top-left corner of the part of the map that the surface covers, in
+		# map pixels, and its size in screen pixels
+		self.__x = 0.0
+		self.__y = 0.0
+		self.__width = 0
+		self.__height = 0
+		# Zoom and colors that the surface was drawn with
+		self.__key = None
+		# Shape that was left out of the surface
+		self.__exclude = None
+
+	def invalidate(self):
+		"""
+		Throws the surface away so that it is drawn again. Call this whenever
+		shapes are added, removed or changed.
+		"""
+		self.__surface = None
+
+	def draw(self, context, shapeList, exclude = None):
+		"""
+		@type context: cairo.Context
+		@param context: context to draw on, in map pixels
+		@type shapeList: [shapes.Shape]
+		@param shapeList: the shapes to draw
+		@type exclude: shapes.Shape
+		@param exclude: a shape that is not drawn, because the caller draws it
+			itself, or None
+		"""
+		xx, yx, xy, yy, x0, y0 = context.get_matrix()
+		x1, y1, x2, y2 = context.clip_extents()
+		key = (xx, yy, preferences.visual["valid_outline"],
+			preferences.visual["valid_fill"],
+			preferences.visual["invalid_outline"],
+			preferences.visual["invalid_fill"])
+		if self.__surface is None or key != self.__key \
+				or exclude is not self.__exclude \
+				or not self.__covers(x0, y0, xx, yy, x1, y1, x2, y2):
+			self.__render(context, shapeList, exclude, key, x0, y0, xx, yy,
+				x1, y1, x2, y2)
+		context.save()
+		context.translate(self.__x, self.__y)
+		context.scale(1.0 / xx, 1.0 / yy)
+		context.set_source_surface(self.__surface, 0, 0)
+		context.get_source().set_filter(cairo.FILTER_NEAREST)
+		context.paint()
+		context.restore()
+
+	def __covers(self, x0, y0, xx, yy, x1, y1, x2, y2):
+		"""
+		@return: True if the surface covers the area from (x1, y1) to (x2, y2)
+			and lines up with whole screen pixels
+		"""
+		left = x0 + self.__x * xx
+		top = y0 + self.__y * yy
+		if abs(left - round(left)) > 0.01 or abs(top - round(top)) > 0.01:
+			return False
+		return (x1 >= self.__x and y1 >= self.__y
+			and x2 <= self.__x + self.__width / xx
+			and y2 <= self.__y + self.__height / yy)
+
+	def __render(self, context, shapeList, exclude, key, x0, y0, xx, yy,
+			x1, y1, x2, y2):
+		# The corner is put on a whole screen pixel so that the copy is sharp
+		left = math.floor(x0 + x1 * xx - OVERLAY_MARGIN)
+		top = math.floor(y0 + y1 * yy - OVERLAY_MARGIN)
+		self.__x = (left - x0) / xx
+		self.__y = (top - y0) / yy
+		self.__width = int(math.ceil(x0 + x2 * xx + OVERLAY_MARGIN - left))
+		self.__height = int(math.ceil(y0 + y2 * yy + OVERLAY_MARGIN - top))
+		self.__surface = context.get_target().create_similar(
+			cairo.CONTENT_COLOR_ALPHA, max(self.__width, 1),
+			max(self.__height, 1))
+		self.__key = key
+		self.__exclude = exclude
+		overlayContext = cairo.Context(self.__surface)
+		overlayContext.scale(xx, yy)
+		overlayContext.translate(-self.__x, -self.__y)
+		for shape in shapeList:
+			if shape is not exclude:
+				drawShape(shape, overlayContext)
+
+
 def drawPointHandle(context, p, lineWidth = 1.0):
 	"""
 	@type context: cairo.Context
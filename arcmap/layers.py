@@ -72,10 +72,6 @@ class LayerView(mapcontroller.MapListener):
 		self.scrolledWindow.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
 		self.scrolledWindow.add(self.treeView)
 
-		# Prevent the LayerView from responding to callbacks caused by its own
-		# actions
-		self.__locked = False
-
 	def comIndex(self, index):
 		"""
 		Converts from a tree model index to a map index, and vice-versa
@@ -106,12 +102,9 @@ class LayerView(mapcontroller.MapListener):
 		@type layerName: string
 		@param layerName: the name for the new layer
 		"""
-		self.__locked = True
-		self.treeModel.prepend((layerName, True))
+		# The row is added when the controller posts listenAddLayer
 		action = undo.LayerAddAction(self.getController(), layerName)
 		self.getController().addUndoAction(action)
-		layerName = "New Layer"
-		self.__locked = False
 
 	# Any appearance of magic in the get_path, get_iter and the random array
 	# indicies on them is purely coincidental. Honest.
@@ -123,14 +116,12 @@ class LayerView(mapcontroller.MapListener):
 		iter = self.getCurrent()
 		if iter is None:
 			return
-		self.__locked = True
-		# Remove the current layer
+		# Remove the current layer. The row is removed when the controller
+		# posts listenRemoveLayer.
 		index = self.treeModel.get_path(iter)[0]
 		action = undo.LayerRemoveAction(self.getController(),
 			self.comIndex(index))
 		self.getController().addUndoAction(action)
-		self.treeModel.remove(iter)
-		self.__locked = False
 
 	def raiseLayer(self):
 		"""
@@ -201,13 +192,11 @@ class LayerView(mapcontroller.MapListener):
 		self.treeModel.clear()
 
 	def listenAddLayer(self, layerName):
-		if self.__locked == False:
-			self.treeModel.prepend((layerName, True))
+		self.treeModel.prepend((layerName, True))
 
 	def listenRemoveLayer(self, index):
-		if self.__locked == False:
-			ci = self.comIndex(index)
-			self.treeModel.remove(self.treeModel.get_iter(ci))
+		ci = self.comIndex(index)
+		self.treeModel.remove(self.treeModel.get_iter(ci))
 
 	############################################################################
 	# End MapListener code
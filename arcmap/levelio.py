@@ -19,44 +19,303 @@
 ################################################################################
 
 import os
+import time
+import random
 import logging
+import tempfile
 import json
+import zlib
+import gzip
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		# lzma compression is not available
+		lzma = None
 
+import preferences
+import tilemap
 import mapio
 import worldio
 import backgroundio
+import binaryio
+import profiler
+import scheduler
 
+log = logging.getLogger("levelio")
 
-def write(fileName, tileMap, world, background):
-	if tileMap is not None:
-		mw = mapio.MapWriter(tileMap)
-		md = mw.writed()
-	else:
-		md = None
+# Number of spaces used to indent each level of the JSON output
+INDENT = 4
 
-	if world is not None:
-		ww = worldio.WorldWriter(world)
-		wd = ww.writed()
-	else:
-		wd = None
+# Compression codecs that levels can be saved with
+CODECS = ["none", "zlib", "gzip"]
+if lzma is not None:
+	CODECS.append("lzma")
 
-	if background is not None:
-		bw = backgroundio.BackgroundWriter(background)
-		bd = bw.writed()
-	else:
-		bd = None
+# Seconds after the last change before the changed sections of a level are
+# encoded in the background
+ENCODE_DELAY = 2.0
+
+
+@profiler.timed("levelio")
+def write(fileName, tileMap, world, background, cache = None):
+	"""
+	@type fileName: str
+	@param fileName: the path of the file to save to
+	@type cache: SaveCache
+	@param cache: the encoded sections from the previous save of this level.
+		Only the sections that have changed since then are encoded again. If
+		this is None, every section is encoded.
+	Levels are saved in the binary format (without compression) if the file
+	name ends with binaryio.EXTENSION.
+	This function will raise a SaveError on failure.
+	"""
+	if binaryio.isBinaryName(fileName):
+		try:
+			binaryio.write(fileName, tileMap, world, background)
+		except (IOError, OSError, binaryio.LevelFileError) as e:
+			raise SaveError(str(e))
+		return
 
-	dictionary = {"background": bd, "tileMap": md, "blazeWorld": wd}
+	if cache is None:
+		cache = SaveCache()
+	parts = cache.encodeParts(tileMap, world, background)
 
 	try:
-		f = open(fileName, "w")
-	except IOError as e:
-		log.error(e)
+		f = open(fileName, "wb")
+		try:
+			writeCompressed(f, parts, preferences.files["compression"],
+				preferences.files["compression_level"])
+		finally:
+			f.close()
+	except (IOError, OSError) as e:
+		raise SaveError(str(e))
+
+
+def writeCompressed(f, parts, codec, level):
+	"""
+	Writes text to a file, compressing it on the way
+	@type f: file
+	@param f: the file to write to
+	@type parts: [str]
+	@param parts: the pieces of the text to write, in order
+	@type codec: str
+	@param codec: one of the values in CODECS
+	@type level: int
+	@param level: compression level from 1 (fastest) to 9 (smallest)
+	"""
+	if codec == "zlib":
+		compressor = zlib.compressobj(level)
+		for part in parts:
+			f.write(compressor.compress(part))
+		f.write(compressor.flush())
+	elif codec == "gzip":
+		stream = gzip.GzipFile(fileobj=f, mode="wb", compresslevel=level)
+		for part in parts:
+			stream.write(part)
+		stream.close()
+	elif codec == "lzma" and lzma is not None:
+		compressor = lzma.LZMACompressor(preset=level)
+		for part in parts:
+			f.write(compressor.compress(part))
+		f.write(compressor.flush())
 	else:
-		json.dump(dictionary, f, indent=4)
-		f.close()
+		if codec != "none":
+			log.error("Compression codec \"%s\" is not available. Saving"
+				" without compression" % codec)
+		for part in parts:
+			f.write(part)
+
+
+def readDecompressed(f):
+	"""
+	Reads a file, detecting its compression from the first few bytes
+	@type f: file
+	@param f: a file opened for reading in binary mode
+	@rtype: str
+	@return: the decompressed contents of f
+	"""
+	data = f.read()
+	if data.startswith("\x1f\x8b"):
+		# 16 added to the window size makes zlib expect a gzip header
+		return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+	elif data.startswith("\xfd7zXZ\x00"):
+		if lzma is None:
+			raise LoadError("The level is compressed with lzma, which is not"
+				" available")
+		return lzma.decompress(data)
+	elif (len(data) >= 2 and ord(data[0]) & 0x0f == 8
+		and ((ord(data[0]) << 8) + ord(data[1])) % 31 == 0):
+		# zlib header: deflate compression method and a valid check value.
+		# Neither "{" nor white space can start a zlib stream
+		return zlib.decompress(data)
+	else:
+		return data
+
+
+def _encode(obj, depth):
+	"""
+	@type obj: object
+	@param obj: the object to encode
+	@type depth: int
+	@param depth: the nesting level that the encoded text will be placed at
+	@rtype: str
+	@return: obj encoded as JSON, indented so that it can be pasted into the
+		file at the given depth
+	"""
+	text = json.dumps(obj, indent=INDENT)
+	return text.replace("\n", "\n" + (" " * (INDENT * depth)))
+
+
+class SaveCache(object):
+	"""
+	Keeps the encoded JSON text of each section of a level between saves. The
+	layers, the blocking information, the physics world and the background
+	each have a dirty flag that is set whenever they are modified. Sections
+	that are not dirty are written out from the text that was encoded for them
+	the last time that the level was saved.
+	"""
+	def __init__(self):
+		# Dictionary of tilemap.Layer to (index, text)
+		self.__layers = {}
+		self.__blocking = None
+		self.__world = None
+		self.__background = None
+		# scheduler.Task that encodes changed sections in the background
+		self.__task = None
+
+	def schedule(self, tileMap, world, background):
+		"""
+		Encodes the sections that have changed with the scheduler, one at a
+		time, once the level has not been changed for ENCODE_DELAY seconds.
+		The arguments are the same as for encodeParts.
+		"""
+		self.cancel()
+		self.__task = scheduler.getScheduler().add(
+			lambda: self.prepare(tileMap, world, background),
+			scheduler.PRIORITY_LOW, "levelio.prepare", ENCODE_DELAY)
+
+	def cancel(self):
+		"""
+		Stops encoding sections in the background
+		"""
+		scheduler.getScheduler().cancel(self.__task)
+		self.__task = None
+
+	def encode(self, tileMap, world, background):
+		"""
+		@rtype: str
+		@return: the JSON text for the whole level
+		"""
+		return "".join(self.encodeParts(tileMap, world, background))
+
+	def encodeParts(self, tileMap, world, background):
+		"""
+		@rtype: [str]
+		@return: the JSON text for the whole level, split into pieces so that
+			it can be written out without joining it together first
+		"""
+		pad = " " * INDENT
+		return ["{\n",
+			pad, "\"background\": ", self.__encodeBackground(background), ",\n",
+			pad, "\"tileMap\": ", self.__encodeMap(tileMap), ",\n",
+			pad, "\"blazeWorld\": ", self.__encodeWorld(world), "\n}"]
+
+	def __encodeBackground(self, background):
+		if background is None:
+			return "null"
+		if self.__background is None or background.dirty:
+			bw = backgroundio.BackgroundWriter(background)
+			self.__background = _encode(bw.writed(), 1)
+			background.dirty = False
+		return self.__background
 
+	def __encodeWorld(self, world):
+		if world is None:
+			return "null"
+		if self.__world is None or world.dirty:
+			ww = worldio.WorldWriter(world)
+			self.__world = _encode(ww.writed(), 1)
+			world.dirty = False
+		return self.__world
 
+	def __encodeBlocking(self, tileMap):
+		if self.__blocking is None or tileMap.blockingDirty:
+			self.__blocking = _encode(tileMap.blocking, 2)
+			tileMap.blockingDirty = False
+		return self.__blocking
+
+	def __encodeLayer(self, mapWriter, layer, index):
+		cached = self.__layers.get(layer)
+		if cached is None or cached[0] != index or layer.dirty:
+			cached = (index, _encode(mapWriter.layerDictionary(layer, index),
+				3))
+			self.__layers[layer] = cached
+			layer.dirty = False
+		return cached[1]
+
+	def prepare(self, tileMap, world, background):
+		"""
+		Encodes one of the sections that have changed since they were last
+		encoded. Calling this while the editor is idle leaves the next save
+		with little to do but write the text out. The arguments are the same
+		as for encodeParts.
+		@rtype: bool
+		@return: True if a section was encoded, and there may be more
+		"""
+		if background is not None and (self.__background is None
+				or background.dirty):
+			self.__encodeBackground(background)
+			return True
+		if world is not None and (self.__world is None or world.dirty):
+			self.__encodeWorld(world)
+			return True
+		if tileMap is None:
+			return False
+		if self.__blocking is None or tileMap.blockingDirty:
+			self.__encodeBlocking(tileMap)
+			return True
+		for index, layer in enumerate(tileMap.layers):
+			cached = self.__layers.get(layer)
+			if cached is None or cached[0] != index or layer.dirty:
+				self.__encodeLayer(mapio.MapWriter(tileMap), layer, index)
+				return True
+		return False
+
+	def __encodeMap(self, tileMap):
+		if tileMap is None:
+			return "null"
+		pad = " " * (INDENT * 2)
+		mw = mapio.MapWriter(tileMap)
+
+		# The header is only a few numbers and file names, so it is always
+		# encoded again
+		header = mw.headerDictionary()
+		items = ["%s%s: %s" % (pad, json.dumps(key), _encode(value, 2))
+			for key, value in header.iteritems()]
+
+		items.append("%s\"blocking\": %s" % (pad,
+			self.__encodeBlocking(tileMap)))
+
+		# Layers that were removed from the map are dropped from the cache
+		layers = {}
+		layerText = []
+		for index, layer in enumerate(tileMap.layers):
+			layers[layer] = (index, self.__encodeLayer(mw, layer, index))
+			layerText.append(pad + (" " * INDENT) + layers[layer][1])
+		self.__layers = layers
+		if len(layerText) == 0:
+			items.append("%s\"layers\": []" % pad)
+		else:
+			items.append("%s\"layers\": [\n%s\n%s]" % (pad,
+				",\n".join(layerText), pad))
+
+		return "{\n" + ",\n".join(items) + "\n" + (" " * INDENT) + "}"
+
+
+@profiler.timed("levelio")
 def read(fileName):
 	"""
 	@type fileName: str
@@ -72,16 +331,24 @@ def read(fileName):
 	tilemap = None
 
 	try:
-		f = open(fileName, "r")
+		f = open(fileName, "rb")
 	except IOError as e:
 		err = LoadError(str(e))
 		raise err
 
 	try:
-		dictionary = json.load(f)
+		if f.read(len(binaryio.MAGIC)) == binaryio.MAGIC:
+			f.close()
+			return _readBinary(fileName)
+		f.seek(0)
+		dictionary = json.loads(readDecompressed(f))
+	except LoadError:
+		raise
 	except Exception as e:
 		err = LoadError(str(e))
 		raise err
+	finally:
+		f.close()
 
 	if "background" in dictionary and dictionary["background"] is not None:
 		bgReader = backgroundio.BackgroundReader()
@@ -104,6 +371,31 @@ def read(fileName):
 	return background, world, tilemap
 
 
+def _readBinary(fileName):
+	"""
+	Loads a level saved in the binary format. The layers of the tile map keep
+	the file mapped and load their tiles from it as they are used.
+	"""
+	try:
+		return binaryio.read(fileName)
+	except binaryio.LevelFileError as e:
+		raise LoadError(str(e))
+	except (KeyError, TypeError, ValueError) as e:
+		raise LoadError("The level metadata is incomplete: %s" % e)
+
+
+def release(tileMap):
+	"""
+	Releases the file that the layers of a tile map were loading their tiles
+	from. This should be called when the map is closed.
+	@type tileMap: tilemap.TileMap
+	@param tileMap: the map
+	"""
+	if tileMap is not None and tileMap.levelFile is not None:
+		tileMap.levelFile.close(tileMap.layers)
+		tileMap.levelFile = None
+
+
 class LoadError(Exception):
 	def __init__(self, message):
 		self.msg = message
@@ -111,3 +403,63 @@ class LoadError(Exception):
 	def __str__(self):
 		return self.msg
 
+
+class SaveError(Exception):
+	def __init__(self, message):
+		self.msg = message
+
+	def __str__(self):
+		return self.msg
+
+
+def benchmark(width = 1000, height = 1000, layers = 4):
+	"""
+	Prints the file size, save time and load time of a large synthetic level
+	for each compression codec and a few compression levels
+	@type width: int
+	@param width: width of the test map in tiles
+	@type height: int
+	@param height: height of the test map in tiles
+	@type layers: int
+	@param layers: number of layers in the test map
+	"""
+	random.seed(0)
+	tileMap = tilemap.TileMap.createMap(32, width, height)
+	tileMap.addImage("tiles.png", 0)
+	for z in range(layers):
+		if z > 0:
+			tileMap.addLayer("Layer %d" % z, True)
+		# Lower layers are mostly full, higher layers mostly empty
+		density = 1.0 / (z + 1)
+		for x in range(width):
+			for y in range(height):
+				if random.random() < density:
+					tileMap.addTile(tileMap.tileTable.intern(0,
+						random.randint(0, 7), random.randint(0, 7)), x, y, z)
+	parts = SaveCache().encodeParts(tileMap, None, None)
+
+	fd, fileName = tempfile.mkstemp(".json")
+	os.close(fd)
+	print("%-6s %5s %12s %10s %10s" % ("codec", "level", "bytes", "save (s)",
+		"load (s)"))
+	try:
+		for codec in CODECS:
+			for level in ([0] if codec == "none" else [1, 6, 9]):
+				start = time.time()
+				f = open(fileName, "wb")
+				writeCompressed(f, parts, codec, level)
+				f.close()
+				saveTime = time.time() - start
+
+				start = time.time()
+				read(fileName)
+				loadTime = time.time() - start
+
+				print("%-6s %5d %12d %10.3f %10.3f" % (codec, level,
+					os.path.getsize(fileName), saveTime, loadTime))
+	finally:
+		os.remove(fileName)
+
+
+if __name__ == "__main__":
+	benchmark()
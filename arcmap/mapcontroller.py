@@ -25,6 +25,7 @@ Contains the MapController and MapListener classes.
 __docformat__ = "epytext"
 
 import os
+import array
 import logging
 import copy
 
@@ -38,9 +39,22 @@ import graphics
 import undo
 import datafiles
 import levelio
+import tilerender
+import floodfill
+import autotile
+import eventbus
+import collision
+import worldoptimize
+import clipboard
+import scheduler
+import binaryio
 
 log = logging.getLogger("mapcontroller")
 
+# Number of chunks whose tiles are counted for the tile index in each step
+# of the background task that builds it
+INDEX_CHUNKS_PER_STEP = 16
+
 
 class MapListener:
 	"""
@@ -119,6 +133,15 @@ class MapListener:
 		"""
 		pass
 
+	def listenFillTiles(self, z, runs):
+		"""
+		@type z: int
+		@param z: layer index of the tiles
+		@type runs: array.array
+		@param runs: y, first x and last x of each run of tiles that changed
+		"""
+		pass
+
 	def listenRemoveLayer(self, index):
 		"""
 		Notify the listener that a layer has been removed
@@ -213,6 +236,22 @@ class MapListener:
 		"""
 
 
+# Notifications that a MapListener can receive
+LISTENER_EVENTS = [name for name in dir(MapListener)
+	if name.startswith("listen")]
+
+# Notifications that report a state, so that only the latest one matters
+STATE_EVENTS = ["listenModified", "listenSelectLayer", "listenSetSelection",
+	"listenUndoRedo"]
+
+# Notifications that have the same effect when they are handled twice, so
+# that repeats with the same arguments are only delivered once. Notifications
+# that change the structure of the map, such as adding a layer, are not
+# among them.
+IDEMPOTENT_EVENTS = ["listenAddTile", "listenRemoveTile",
+	"listenSetVisibilty"]
+
+
 class MapController:
 	"""
 	MapController is the command and control center for the program. It manages
@@ -222,6 +261,12 @@ class MapController:
 
 		# List of MapListener
 		self.__listeners = []
+		# Delivers the listen* notifications to the listeners
+		self.__bus = eventbus.EventBus()
+		for eventType in STATE_EVENTS:
+			self.__bus.setLatestOnly(eventType)
+		for eventType in IDEMPOTENT_EVENTS:
+			self.__bus.setIdempotent(eventType)
 		# List of tile images
 		self.__images = []
 		# Name that the file will be saved under
@@ -236,6 +281,16 @@ class MapController:
 		self.__world = None
 		# Background info
 		self.__background = None
+		# Sections of the level encoded by the last save
+		self.__saveCache = None
+		# Images to draw for each tile id
+		self.__renderTable = None
+		# The shapes as they were last drawn
+		self.__shapeOverlay = graphics.ShapeOverlay()
+		# Resolves terrain tiles, created when it is first needed
+		self.__autoTiler = None
+		# scheduler.Task that builds the tile indices of the layers
+		self.__indexTask = None
 		# Source of resize thumbnail
 		self.__thumbnailSource = None
 		# Toplevel widget
@@ -249,12 +304,15 @@ class MapController:
 		if x > self.__map.width or y > self.__map.height or x < 0 or y < 0:
 			return
 		self.__map.blocking[x][y] ^= direction;
+		self.__map.blockingDirty = True
 
 	def clearBlock(self, x, y):
 		self.__map.blocking[x][y] = 0
+		self.__map.blockingDirty = True
 
 	def setBlock(self, direction, x, y):
 		self.__map.blocking[x][y] |= direction
+		self.__map.blockingDirty = True
 
 	def setThumbnailSource(self, source):
 		self.__thumbnailSource = source
@@ -298,6 +356,7 @@ class MapController:
 
 	def setShapes(self, shapes):
 		self.__world.setShapes(shapes)
+		self.__shapeOverlay.invalidate()
 
 	def addShape(self, shape):
 		"""
@@ -305,8 +364,8 @@ class MapController:
 		@param shape: the shape to add to the map
 		"""
 		self.__world.addShape(shape)
-		for listener in self.__listeners:
-			listener.listenAddShape(shape)
+		self.__shapeOverlay.invalidate()
+		self.__bus.post("listenAddShape", shape)
 		self.notifyModification(True)
 
 	def removeShape(self, shape):
@@ -315,10 +374,68 @@ class MapController:
 		@param shape: the shape to remove
 		"""
 		self.__world.delShape(shape)
-		for listener in self.__listeners:
-			listener.listenRemoveShape(shape)
+		self.__shapeOverlay.invalidate()
+		self.__bus.post("listenRemoveShape", shape)
+		self.notifyModification(True)
+
+	def replaceShapes(self, old, new):
+		"""
+		@type old: [shapes.Shape]
+		@param old: the shapes to remove from the map
+		@type new: [shapes.Shape]
+		@param new: the shapes to add to the map
+		"""
+		self.__world.replaceShapes(old, new)
+		self.__shapeOverlay.invalidate()
+		for shape in old:
+			self.__bus.post("listenRemoveShape", shape)
+		for shape in new:
+			self.__bus.post("listenAddShape", shape)
 		self.notifyModification(True)
 
+	def optimizeShapes(self, tolerance, snap, merge):
+		"""
+		Works out a smaller set of shapes for the physics world. The map is
+		not changed.
+		@type tolerance: float
+		@param tolerance: greatest distance in pixels that vertices may move
+		@type snap: bool
+		@param snap: True to snap vertices to half of the tile size, like the
+			shape tools do
+		@type merge: bool
+		@param merge: True to join neighbouring shapes with the same
+			properties
+		@rtype: ([shapes.Shape], [shapes.Shape], worldoptimize.Report)
+		@return: the shapes to remove, the shapes to add in their place, and
+			the shape and vertex counts
+		"""
+		current = self.__world.getShapes()
+		snapInterval = self.__map.tileSize // 2 if snap else None
+		result, report = worldoptimize.optimize(current, tolerance,
+			snapInterval, merge)
+		kept = set([id(s) for s in result])
+		old = [s for s in current if id(s) not in kept]
+		unchanged = set([id(s) for s in current])
+		new = [s for s in result if id(s) not in unchanged]
+		return old, new, report
+
+	def generateCollisionShapes(self, z = None):
+		"""
+		Creates physics shapes that cover the solid parts of the map. The
+		shapes are not added to the map.
+		@type z: int
+		@param z: index of the layer whose tiles are solid, or None to use the
+			cells that have blocked edges
+		@rtype: [shapes.Polygon]
+		@return: the fewest rectangles that exactly cover the solid cells
+		"""
+		if z is None:
+			rows = collision.solidRowsFromBlocking(self.__map.blocking,
+				self.__map.width, self.__map.height)
+		else:
+			rows = collision.solidRowsFromLayer(self.__map.layers[z])
+		return collision.generate(rows, self.__map.width, self.__map.tileSize)
+
 	def hasMap(self):
 		"""
 		@rtype: bool
@@ -338,6 +455,7 @@ class MapController:
 		# Only one map can be used at a time
 		self.close()
 		self.__fileName = fileName
+		self.__saveCache = levelio.SaveCache()
 		if fileName is not None and os.path.exists(fileName):
 			try:
 				self.__background, self.__world, self.__map = levelio.read(
@@ -357,12 +475,14 @@ class MapController:
 				# Same here
 				self.__world = blazeworld.BlazeWorld()
 
+			self.__renderTable = tilerender.TileRenderTable(
+				self.__map.tileTable, self.__map.tileSize)
+
 			for index, fileName in enumerate(self.__map.images):
-				for listener in self.__listeners:
-					listener.listenAddTileSet(fileName)
-			for listener in self.__listeners:
-				listener.listenFileOpened()
-				listener.listenSelectLayer(self.__selectedLayer)
+				self.__bus.post("listenAddTileSet", fileName)
+			self.__bus.post("listenFileOpened")
+			self.__bus.post("listenSelectLayer", self.__selectedLayer)
+			self.__scheduleIndex()
 			return None
 		else:
 			self.__fileName = None
@@ -372,16 +492,23 @@ class MapController:
 		# Ignore this call if there is no map currently loaded
 		if self.__map is None:
 			return
+		scheduler.getScheduler().cancel(self.__indexTask)
+		self.__indexTask = None
+		self.__saveCache.cancel()
+		levelio.release(self.__map)
 		self.__map = None
 		self.__background = None
 		self.__world = None
+		self.__shapeOverlay.invalidate()
+		self.__saveCache = None
+		self.__renderTable = None
+		self.__autoTiler = None
 		self.__images = []
 		self.__modified = False
 		self.__selectedLayer = None
 		self.__fileName = None
 		self.__selectedLayer = None
-		for listener in self.__listeners:
-			listener.listenFileClosed()
+		self.__bus.post("listenFileClosed")
 
 	def new(self, tileSize, width, height):
 		"""
@@ -397,16 +524,49 @@ class MapController:
 		self.__map = tilemap.TileMap.createMap(tileSize, width, height)
 		self.__world = blazeworld.BlazeWorld()
 		self.__background = background.Background()
+		self.__saveCache = levelio.SaveCache()
+		self.__renderTable = tilerender.TileRenderTable(self.__map.tileTable,
+			tileSize)
 		self.__selectedLayer = len(self.__map.layers) - 1
-		for listener in self.__listeners:
-			listener.listenFileOpened()
-			listener.listenSelectLayer(self.__selectedLayer)
+		self.__bus.post("listenFileOpened")
+		self.__bus.post("listenSelectLayer", self.__selectedLayer)
+		self.__scheduleIndex()
+
+	def __scheduleIndex(self):
+		"""
+		Builds the tile indices of the layers with the scheduler, so that the
+		first search for a tile does not have to
+		"""
+		scheduler.getScheduler().cancel(self.__indexTask)
+		self.__indexTask = scheduler.getScheduler().add(self.__indexStep,
+			scheduler.PRIORITY_LOW, "mapcontroller.index")
+
+	def __indexStep(self):
+		if self.__map is None:
+			return False
+		for layer in self.__map.layers:
+			if layer.buildIndex(INDEX_CHUNKS_PER_STEP):
+				return True
+		return False
 
 	def save(self):
-		levelio.write(self.__fileName, self.__map,
-			self.__world if self.saveWorld == True else None,
-			self.__background if self.saveBackground == True else None)
+		"""
+		Saves the map to its file name. If saving fails, the map stays
+		marked as modified.
+		@rtype: str
+		@return: Returns a string saying why the file could not be saved, or
+		    None
+		"""
+		try:
+			levelio.write(self.__fileName, self.__map,
+				self.__world if self.saveWorld == True else None,
+				self.__background if self.saveBackground == True else None,
+				self.__saveCache)
+		except levelio.SaveError as e:
+			log.error(e)
+			return str(e)
 		self.notifyModification(False)
+		return None
 
 	def mapTileSize(self):
 		assert(self.hasMap())
@@ -426,9 +586,11 @@ class MapController:
 		self.__world.resize(width * self.mapTileSize(),
 			height * self.mapTileSize(), xOffset * self.mapTileSize(),
 			yOffset * self.mapTileSize())
-		for listener in self.__listeners:
-			listener.listenResize(width, height, xOffset, yOffset)
+		# The shapes were moved by the offset
+		self.__shapeOverlay.invalidate()
+		self.__bus.post("listenResize", width, height, xOffset, yOffset)
 		self.notifyModification(True)
+		self.__scheduleIndex()
 
 	def getTile(self, x, y, z):
 		"""
@@ -449,8 +611,7 @@ class MapController:
 		@param index: index of layer to select
 		"""
 		self.__selectedLayer = index
-		for listener in self.__listeners:
-			listener.listenSelectLayer(index)
+		self.__bus.post("listenSelectLayer", index)
 
 	def selectedLayer(self):
 		"""
@@ -468,12 +629,13 @@ class MapController:
 
 	def setMapLayerVisibility(self, index, v):
 		self.__map.layers[index].visible = v
-		for listener in self.__listeners:
-			listener.listenSetVisibilty(index, v)
+		self.__map.layers[index].dirty = True
+		self.__bus.post("listenSetVisibilty", index, v)
 		self.notifyModification(True)
 
 	def setLayerName(self, index, name):
 		self.__map.layers[index].name = name
+		self.__map.layers[index].dirty = True
 		self.notifyModification(True)
 
 	def getFileName(self):
@@ -488,11 +650,34 @@ class MapController:
 
 	def addListener(self, listener):
 		"""
-		Adds a listener into the listener list
+		Adds a listener into the listener list. The listener is only sent the
+		notifications that it has a listen* method for.
 		@type listener: MapListener
 		@param listener: Placeholder
 		"""
 		self.__listeners.append(listener)
+		for eventType in LISTENER_EVENTS:
+			if getattr(listener.__class__, eventType).im_func \
+				is not getattr(MapListener, eventType).im_func:
+				self.__bus.subscribe(eventType, getattr(listener, eventType))
+
+	def removeListener(self, listener):
+		"""
+		@type listener: MapListener
+		@param listener: a listener passed to addListener
+		"""
+		if listener in self.__listeners:
+			self.__listeners.remove(listener)
+			for eventType in LISTENER_EVENTS:
+				self.__bus.unsubscribe(eventType, getattr(listener, eventType))
+
+	def getEventBus(self):
+		"""
+		@rtype: eventbus.EventBus
+		@return: the bus that notifications to listeners are posted to. Call
+			its flush method to deliver them before the main loop is idle.
+		"""
+		return self.__bus
 
 	def openTileSet(self, fileName):
 		"""
@@ -507,6 +692,14 @@ class MapController:
 			self.__images.append(image)
 			index = len(self.__images) - 1
 			self.__map.addImage(fileName, index)
+			self.__renderTable.setTileset(index, image)
+			# Terrains saved in the level take precedence over the ones that
+			# the tileset declares
+			if not [t for t in self.__map.terrains if t.image == index]:
+				terrains = autotile.readTerrainFile(fileName, index)
+				if len(terrains) > 0:
+					self.__map.terrains.extend(terrains)
+					self.__autoTiler = None
 			return index
 		else:
 			return None
@@ -518,14 +711,17 @@ class MapController:
 					self.__map.blocking[x][y])
 
 
-	def drawShapes(self, context):
+	def drawShapes(self, context, exclude = None):
 		"""
-		Draws the shapes in the map to the given context
+		Draws the shapes in the map to the given context. They are copied from
+		a surface that is only drawn again when they change.
 		@type context: cairo.Context
 		@param context: context to draw on
+		@type exclude: shapes.Shape
+		@param exclude: a shape not to draw, such as one that is being
+			dragged, or None
 		"""
-		for shape in self.__world.getShapes():
-			graphics.drawShape(shape, context)
+		self.__shapeOverlay.draw(context, self.__world.getShapes(), exclude)
 
 	def addLayer(self, layerName, visible):
 		"""
@@ -538,9 +734,8 @@ class MapController:
 		# select the new layer. This also ensures that a layer is selected on
 		# map load.
 		self.__selectedLayer = len(self.__map.layers) - 1
-		for listener in self.__listeners:
-			listener.listenAddLayer(layerName)
-			listener.listenSelectLayer(len(self.__map.layers))
+		self.__bus.post("listenAddLayer", layerName)
+		self.__bus.post("listenSelectLayer", len(self.__map.layers))
 		self.notifyModification(True)
 		return self.__selectedLayer
 
@@ -554,8 +749,7 @@ class MapController:
 		@param index: the index to add the layer at
 		"""
 		self.__map.addLayerLiteral(layer, index)
-		for listener in self.__listeners:
-			listener.listenAddLayer(layer.name)
+		self.__bus.post("listenAddLayer", layer.name)
 		self.notifyModification(True)
 
 	def removeLayer(self, index):
@@ -566,8 +760,7 @@ class MapController:
 		@return: The removed layer (for undo)
 		"""
 		l = self.__map.removeLayer(index)
-		for listener in self.__listeners:
-			listener.listenRemoveLayer(index)
+		self.__bus.post("listenRemoveLayer", index)
 		self.notifyModification(True)
 		return l
 
@@ -579,8 +772,7 @@ class MapController:
 		@param secondIndex: second layer index
 		"""
 		self.__map.swapLayers(firstIndex, secondIndex)
-		for listener in self.__listeners:
-			listener.listenSwapLayers(firstIndex, secondIndex)
+		self.__bus.post("listenSwapLayers", firstIndex, secondIndex)
 		self.notifyModification(True)
 
 	def getNumLayers(self):
@@ -613,8 +805,8 @@ class MapController:
 			context.set_source_surface(self.__images[index], -(x1 * ts), -(y1 * ts))
 			context.set_operator(cairo.OPERATOR_SOURCE)
 			context.paint()
-		for listener in self.__listeners:
-			listener.listenSetSelection(index, brushSurface, x1, y1, x2, y2)
+		self.__bus.post("listenSetSelection", index, brushSurface, x1, y1, x2,
+			y2)
 
 	def addTile(self, x, y, z, ix, iy, ii):
 		"""
@@ -636,10 +828,9 @@ class MapController:
 			tile that used to be at the coordinates (x, y, z), or None if there
 			was no tile there before
 		"""
-		t = tilemap.Tile(ii, ix, iy)
+		t = self.__map.tileTable.intern(ii, ix, iy)
 		r = self.__map.addTile(t, x, y, z)
-		for listener in self.__listeners:
-			listener.listenAddTile(t, x, y, z)
+		self.__bus.post("listenAddTile", t, x, y, z)
 		self.notifyModification(True)
 		return r
 
@@ -658,14 +849,359 @@ class MapController:
 		if z == -1:
 			z = self.__selectedLayer
 		r = self.__map.removeTile(x, y, z)
-		for listener in self.__listeners:
-			listener.listenRemoveTile(x, y, z)
+		self.__bus.post("listenRemoveTile", x, y, z)
 		self.notifyModification(True)
 		return r
 
 	def getTile(self, x, y, z):
 		return self.__map.getTile(x, y, z)
 
+	def retile(self, z, x1, y1, x2, y2):
+		"""
+		Replaces the terrain tiles in and around an area with the ones that
+		fit their neighbours
+		@type z: int
+		@param z: layer index
+		@type x1: int
+		@param x1: left edge of the area that was changed
+		@type y1: int
+		@param y1: top edge of the area that was changed
+		@type x2: int
+		@param x2: right edge of the area that was changed
+		@type y2: int
+		@param y2: bottom edge of the area that was changed
+		@rtype: [(int, int, (int, int, int), (int, int, int))]
+		@return: the x-coordinate, y-coordinate, old image information and new
+			image information of each tile that was replaced
+		"""
+		if z >= len(self.__map.layers) or len(self.__map.terrains) == 0:
+			return []
+		if self.__autoTiler is None:
+			self.__autoTiler = autotile.AutoTiler(self.__map.tileTable,
+				self.__map.terrains)
+		changes = self.__autoTiler.retile(self.__map.layers[z], x1, y1, x2,
+			y2)
+		if len(changes) == 0:
+			return []
+		tiles = self.__map.tileTable.tiles
+		runs = array.array("i")
+		result = []
+		for x, y, oldId, newId in changes:
+			runs.extend((y, x, x))
+			result.append((x, y, tiles[oldId].getImageInfo(),
+				tiles[newId].getImageInfo()))
+		self.__bus.post("listenFillTiles", z, runs)
+		self.notifyModification(True)
+		return result
+
+	def findFillRegion(self, x, y, z, diagonal, respectBlocking):
+		"""
+		@type x: int
+		@param x: x-coordinate to start the fill at
+		@type y: int
+		@param y: y-coordinate to start the fill at
+		@type z: int
+		@param z: layer index
+		@type diagonal: bool
+		@param diagonal: True to also spread to diagonal neighbours
+		@type respectBlocking: bool
+		@param respectBlocking: True to stop at blocked tile edges
+		@rtype: (int, array.array)
+		@return: the id of the tiles that a flood fill would replace and the
+			y, first x and last x of each run of them. See
+			floodfill.findRegion.
+		"""
+		if z >= len(self.__map.layers):
+			return 0, array.array("i")
+		return floodfill.findRegion(self.__map.layers[z], self.__map.blocking,
+			x, y, diagonal, respectBlocking)
+
+	def fillTiles(self, z, runs, pattern, originX, originY):
+		"""
+		Sets many tiles at once. Listeners are notified once for all of them.
+		@type z: int
+		@param z: layer index
+		@type runs: array.array
+		@param runs: y, first x and last x of each run of tiles to set
+		@type pattern: [[int]]
+		@param pattern: rows of tile ids that are repeated over the runs
+		@type originX: int
+		@param originX: x-coordinate at which the pattern starts
+		@type originY: int
+		@param originY: y-coordinate at which the pattern starts
+		"""
+		if z >= len(self.__map.layers):
+			return
+		self.__map.layers[z].fillRuns(runs, pattern, originX, originY)
+		self.__bus.post("listenFillTiles", z, runs)
+		self.notifyModification(True)
+
+	def getShapesInRegion(self, x1, y1, x2, y2):
+		"""
+		@type x1: int
+		@param x1: left edge, in tiles
+		@type y1: int
+		@param y1: top edge, in tiles
+		@type x2: int
+		@param x2: right edge, in tiles, exclusive
+		@type y2: int
+		@param y2: bottom edge, in tiles, exclusive
+		@rtype: [shapes.Shape]
+		@return: the shapes that lie completely inside the area
+		"""
+		ts = self.__map.tileSize
+		inside = []
+		for shape in self.__world.getShapes():
+			left, top, right, bottom = shape.boundingBox()
+			if left >= x1 * ts and top >= y1 * ts and right <= x2 * ts \
+				and bottom <= y2 * ts:
+				inside.append(shape)
+		return inside
+
+	def copyRegion(self, x1, y1, x2, y2, layers, withBlocking = True,
+		withShapes = False):
+		"""
+		@type x1: int
+		@param x1: left edge, in tiles
+		@type y1: int
+		@param y1: top edge, in tiles
+		@type x2: int
+		@param x2: right edge, in tiles, exclusive
+		@type y2: int
+		@param y2: bottom edge, in tiles, exclusive
+		@type layers: [int]
+		@param layers: indices of the layers to copy
+		@type withBlocking: bool
+		@param withBlocking: True to copy the blocking information
+		@type withShapes: bool
+		@param withShapes: True to copy the shapes that lie completely inside
+			the area
+		@rtype: clipboard.Region
+		@return: the contents of the area. Parts of the area outside of the map
+			are left out.
+		"""
+		x1 = max(x1, 0)
+		y1 = max(y1, 0)
+		x2 = max(min(x2, self.__map.width), x1)
+		y2 = max(min(y2, self.__map.height), y1)
+		region = clipboard.Region(x1, y1, x2 - x1, y2 - y1,
+			self.__map.tileSize)
+		region.images = [None] + [t.getImageInfo() for t in
+			self.__map.tileTable.tiles[1:]]
+		region.tilesets = list(self.__map.images)
+		for z in layers:
+			cells = array.array("H")
+			for row in self.__map.layers[z].getRows(y1, y2):
+				cells.extend(row[x1:x2])
+			region.layers.append((z, cells))
+		if withBlocking:
+			region.blocking = array.array("B")
+			for column in self.__map.blocking[x1:x2]:
+				region.blocking.extend(column[y1:y2])
+		if withShapes:
+			ts = self.__map.tileSize
+			for shape in self.getShapesInRegion(x1, y1, x2, y2):
+				shape = copy.deepcopy(shape)
+				shape.shift(-x1 * ts, -y1 * ts)
+				region.shapes.append(shape)
+		return region
+
+	def __regionImages(self, region):
+		"""
+		@rtype: {int: int}
+		@return: the image index in this map for each image index used in the
+			region. Tilesets that are not open in this map are left out.
+		"""
+		opened = {}
+		for index, fileName in enumerate(self.__map.images):
+			if fileName is not None:
+				opened[os.path.abspath(fileName)] = index
+		indices = {}
+		for index in region.getImageIndices():
+			if index < len(region.tilesets) \
+				and region.tilesets[index] is not None:
+				fileName = os.path.abspath(region.tilesets[index])
+				if fileName in opened:
+					indices[index] = opened[fileName]
+		return indices
+
+	def missingTilesets(self, region):
+		"""
+		@type region: clipboard.Region
+		@param region: a region that may have come from another map
+		@rtype: [str]
+		@return: the file names of the tilesets that the region uses and that
+			are not open in this map. The region can only be pasted once they
+			have been opened.
+		"""
+		indices = self.__regionImages(region)
+		return sorted([region.tilesets[index]
+			for index in region.getImageIndices() if index not in indices])
+
+	def __regionIds(self, region):
+		"""
+		@rtype: [int]
+		@return: the tile id in this map for each tile id used in the region,
+			or None if they are the same
+		"""
+		indices = self.__regionImages(region)
+		tiles = self.__map.tileTable.tiles
+		same = len(indices) == len(region.getImageIndices())
+		for index, mapped in indices.iteritems():
+			if index != mapped:
+				same = False
+		if same:
+			for i, info in enumerate(region.images[1:]):
+				if i + 1 >= len(tiles) or tiles[i + 1].getImageInfo() != info:
+					same = False
+					break
+		if same:
+			return None
+		used = set()
+		for z, cells in region.layers:
+			used.update(cells)
+		used.discard(0)
+		ids = [0] * len(region.images)
+		for i in used:
+			ix, iy, index = region.images[i]
+			if index not in indices:
+				# Tiles from a tileset that is not open are left out
+				continue
+			ids[i] = self.__map.tileTable.getId(self.__map.tileTable.intern(
+				indices[index], ix, iy))
+		return ids
+
+	def pasteRegion(self, region, x, y):
+		"""
+		Replaces an area of the map with the contents of a region. Each layer
+		of the region is written to the layer with the same index, as a single
+		bulk edit. Shapes are not pasted, see clipboard.Region.placeShapes.
+		Tiles from tilesets that are not open in this map are left out, see
+		missingTilesets.
+		@type region: clipboard.Region
+		@param region: the region to paste
+		@type x: int
+		@param x: x-coordinate of the top-left corner, in tiles
+		@type y: int
+		@param y: y-coordinate of the top-left corner, in tiles
+		@rtype: clipboard.Region
+		@return: what was in the area before, or None if the area is outside of
+			the map
+		"""
+		left = max(x, 0)
+		top = max(y, 0)
+		right = min(x + region.width, self.__map.width)
+		bottom = min(y + region.height, self.__map.height)
+		if right <= left or bottom <= top:
+			return None
+		layers = [z for z in region.getLayerIndices()
+			if z < len(self.__map.layers)]
+		old = self.copyRegion(left, top, right, bottom, layers,
+			region.blocking is not None)
+
+		ids = self.__regionIds(region)
+		runs = array.array("i")
+		for row in range(top, bottom):
+			runs.extend((row, left, right - 1))
+		for z, cells in region.layers:
+			if z >= len(self.__map.layers):
+				continue
+			pattern = region.getRows(cells, left - x, top - y, right - x,
+				bottom - y)
+			if ids is not None:
+				pattern = [array.array("H", [ids[i] for i in row])
+					for row in pattern]
+			self.__map.layers[z].fillRuns(runs, pattern, left, top)
+			self.__bus.post("listenFillTiles", z, runs)
+
+		if region.blocking is not None:
+			columns = region.getColumns(left - x, top - y, right - x,
+				bottom - y)
+			for column, blocking in zip(self.__map.blocking[left:right],
+				columns):
+				column[top:bottom] = blocking.tolist()
+			self.__map.blockingDirty = True
+
+		self.notifyModification(True)
+		return old
+
+	def findTileUses(self, tileId, layers, x1 = 0, y1 = 0, x2 = None,
+		y2 = None):
+		"""
+		@type tileId: int
+		@param tileId: id of the tile to look for
+		@type layers: [int]
+		@param layers: indices of the layers to search
+		@type x1: int
+		@param x1: left edge of the area to search, in tiles
+		@type y1: int
+		@param y1: top edge of the area to search, in tiles
+		@type x2: int
+		@param x2: right edge of the area to search, exclusive. Defaults to
+			the width of the map.
+		@type y2: int
+		@param y2: bottom edge of the area to search, exclusive. Defaults to
+			the height of the map.
+		@rtype: [(int, array.array)]
+		@return: the layer index and the runs of cells that use the tile for
+			each layer that uses it. See tilemap.Layer.findTile.
+		"""
+		uses = []
+		for z in layers:
+			runs = self.__map.layers[z].findTile(tileId, x1, y1, x2, y2)
+			if len(runs) > 0:
+				uses.append((z, runs))
+		return uses
+
+	def replaceTileUses(self, oldId, newId, layers, x1 = 0, y1 = 0,
+		x2 = None, y2 = None):
+		"""
+		Replaces every use of a tile in an area of some layers with another
+		tile. Each layer is changed with a single fill.
+		@type oldId: int
+		@param oldId: id of the tile to replace
+		@type newId: int
+		@param newId: id of the tile to replace it with, or 0 to remove it
+		@rtype: [(int, array.array)]
+		@return: the layer index and the runs of cells that were changed for
+			each layer that was changed. See findTileUses for the other
+			parameters.
+		"""
+		uses = self.findTileUses(oldId, layers, x1, y1, x2, y2)
+		for z, runs in uses:
+			self.__map.layers[z].fillRuns(runs, [[newId]], 0, 0)
+			self.__bus.post("listenFillTiles", z, runs)
+		if uses:
+			self.notifyModification(True)
+		return uses
+
+	def getLayerChunk(self, z, key):
+		"""
+		@type z: int
+		@param z: layer index
+		@type key: (int, int)
+		@param key: chunk coordinates (tile coordinates divided by
+			tilemap.CHUNK_SIZE)
+		@rtype: array.array
+		@return: the tile ids of the chunk, row by row, or None if the chunk is
+			empty
+		"""
+		return self.__map.layers[z].getChunk(key)
+
+	def getRenderTable(self):
+		"""
+		@rtype: tilerender.TileRenderTable
+		@return: the surfaces to draw for each tile id
+		"""
+		return self.__renderTable
+
+	def getTileTable(self):
+		"""
+		@rtype: tilemap.TileTable
+		@return: the table that maps the tile ids of the map's layers to tiles
+		"""
+		return self.__map.tileTable
+
 	def getLayerInfo(self):
 		"""
 		@rtype: [(string, bool)]
@@ -707,8 +1243,42 @@ class MapController:
 			longer has unsaved changes
 		"""
 		self.__modified = modified
-		for listener in self.__listeners:
-			listener.listenModified(self.__modified)
+		self.__bus.post("listenModified", self.__modified)
+		# Binary levels are written chunk by chunk and don't use the cache
+		if modified and self.__saveCache is not None and \
+				(self.__fileName is None or
+				not binaryio.isBinaryName(self.__fileName)):
+			self.__saveCache.schedule(self.__map,
+				self.__world if self.saveWorld == True else None,
+				self.__background if self.saveBackground == True else None)
+
+	def getSplitConcave(self):
+		"""
+		@rtype: bool
+		@return: True if concave polygons are saved as their convex pieces
+		"""
+		return self.__world.splitConcave
+
+	def setSplitConcave(self, split):
+		"""
+		@type split: bool
+		@param split: True to save concave polygons as their convex pieces.
+			The polygons in the editor are not changed, but a level that is
+			saved this way opens with the pieces instead of the polygons.
+		"""
+		if split != self.__world.splitConcave:
+			self.__world.splitConcave = split
+			self.__world.dirty = True
+			self.notifyModification(True)
+
+	def notifyWorldModification(self):
+		"""
+		Notify the controller that shapes in the physics world were changed in
+		place so that the world is written out again on the next save.
+		"""
+		self.__world.dirty = True
+		self.__shapeOverlay.invalidate()
+		self.notifyModification(True)
 
 	def setToplevel(self, widget):
 		self.__toplevel = widget
@@ -723,17 +1293,14 @@ class MapController:
 	def undo(self):
 		undo.undo()
 		self.notifyModification(undo.canUndo())
-		for listener in self.__listeners:
-			listener.listenUndoRedo()
+		self.__bus.post("listenUndoRedo")
 
 	def redo(self):
 		undo.redo()
 		self.notifyModification(True)
-		for listener in self.__listeners:
-			listener.listenUndoRedo()
+		self.__bus.post("listenUndoRedo")
 
 	def addUndoAction(self, action):
 		undo.addUndoAction(action)
 		self.notifyModification(True)
-		for listener in self.__listeners:
-			listener.listenUndoRedo()
+		self.__bus.post("listenUndoRedo")
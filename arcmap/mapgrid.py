@@ -25,8 +25,10 @@ Module for drawing the map to the screen
 
 __docformat__ = "epytext"
 
+import collections
 import math
 import logging
+import time
 import cairo
 import gtk
 
@@ -35,6 +37,56 @@ import mapcontroller
 import tilegrid
 import editortools
 import graphics
+import tilemap
+import tilerender
+import preferences
+import rasterizer
+import scheduler
+
+# The layers of the map are rendered in three bands
+BAND_BELOW = 0
+BAND_SELECTED = 1
+BAND_ABOVE = 2
+BANDS = 3
+
+# Largest width and height, in screen pixels, of the parts that the bands are
+# split into for the worker threads
+JOB_SIZE = 256
+
+# Chunks this far outside of the view are loaded ahead of time, so that
+# levels that load their chunks on demand don't stall when scrolled
+WARM_MARGIN = 1
+
+# Seconds after the view stops scrolling before the chunks around it are
+# loaded
+WARM_DELAY = 0.25
+
+# Seconds without zooming or fast scrolling before the view is rendered at
+# full quality. Until then it shows the old pixels scaled and the overview.
+SETTLE_DELAY = 0.15
+
+# Factor that each step of Ctrl+wheel zooms by
+WHEEL_ZOOM_STEP = 1.1
+
+
+class _RenderJob(object):
+	"""
+	Part of a band that has been given to the worker threads
+	"""
+	def __init__(self, band, left, top, right, bottom, offsetX, offsetY,
+			generation):
+		self.band = band
+		# Area of the buffer in screen pixels, at the scroll offsets below
+		self.left = left
+		self.top = top
+		self.right = right
+		self.bottom = bottom
+		self.offsetX = offsetX
+		self.offsetY = offsetY
+		self.generation = generation
+		self.cancelled = False
+		self.done = False
+		self.surface = None
 
 
 class MapGrid(tilegrid.TileGrid, mapcontroller.MapListener):
@@ -50,15 +102,17 @@ class MapGrid(tilegrid.TileGrid, mapcontroller.MapListener):
 	# MapGrid modifies the transformaiton matrix during its specialRedraw call.
 
 
-	def __init__(self, controller, statusBar):
+	def __init__(self, controller, statusBar, overview = None):
 		"""
 		@type controller: MapController
 		@param controller: the map controller
 		@type statusBar: gtk.StatusBar
 		@param statusBar: status bar to update
+		@type overview: overview.Overview
+		@param overview: overview of the map that is shown where nothing has
+			been rendered yet, or None
 		"""
 		mapcontroller.MapListener.__init__(self, controller)
-		controller.setThumbnailSource(self)
 
 		pixelWidth = controller.mapWidth() * controller.mapTileSize()
 		pixelHeight = controller.mapHeight() * controller.mapTileSize()
@@ -82,10 +136,52 @@ class MapGrid(tilegrid.TileGrid, mapcontroller.MapListener):
 		# and the scrollUpdate function.
 		self.__redrawLocked = False
 
+		# The tile layers of the view as they were last rendered, in screen
+		# pixels. When the view scrolls, the part of it that is still visible
+		# is moved over instead of being rendered again.
+		self.__buffer = None
+		# The visible layers below the selected layer, the selected layer, and
+		# the visible layers above it, each rendered on its own. The buffer is
+		# made by compositing the three, so an edit to the selected layer
+		# only renders that layer again.
+		self.__bands = []
+		# Surface that the buffer and the bands are moved into when
+		# scrolling. It is swapped with each of them afterwards.
+		self.__spare = None
+		# Scroll offsets and zoom that the buffer was rendered at
+		self.__bufferX = 0
+		self.__bufferY = 0
+		self.__bufferZoom = None
+		# For each band, rectangles of the map, in pixels, that have changed
+		# since it was rendered. None means that all of it must be rendered
+		# again.
+		self.__damage = [None, None, None]
+		# Whether the layers other than the selected one are drawn faded
+		self.__dimOthers = False
+		# For each band, the jobs that have been given to the worker threads
+		# in the order that they were given. Results are copied to the band in
+		# that order too, so that an old result never covers a newer one.
+		self.__pending = [collections.deque() for band in range(BANDS)]
+		# Changed whenever the bands are made again, so that results that
+		# were rendered for the old ones are thrown away
+		self.__generation = 0
+		# scheduler.Task that loads the chunks around the view, or None
+		self.__warmTask = None
+		self.__overview = overview
+		# While the view is being zoomed or scrolled quickly, nothing is
+		# rendered. The damage is kept until input has settled.
+		self.__interactive = False
+		# scheduler.Task that ends interactive mode, or None
+		self.__settleTask = None
+		# Time of the last change to the scroll offsets
+		self.__lastScroll = 0.0
+
 		self.addTool(editortools.TileDrawTool(controller, pixelWidth,
 			pixelHeight), editortools.TILE_DRAW_ID)
 		self.addTool(editortools.TileDeleteTool(controller, pixelWidth,
 			pixelHeight), editortools.TILE_DELETE_ID)
+		self.addTool(editortools.FloodFillTool(controller, pixelWidth,
+			pixelHeight), editortools.FLOOD_FILL_ID)
 		self.addTool(editortools.PhysicsSelectTool(controller, pixelWidth,
 			pixelHeight), editortools.PHYSICS_SELECT_ID)
 		self.addTool(editortools.CircleDrawTool(controller, pixelWidth,
@@ -94,6 +190,10 @@ class MapGrid(tilegrid.TileGrid, mapcontroller.MapListener):
 			pixelHeight), editortools.POLYGON_DRAW_ID)
 		self.addTool(editortools.BlockTool(controller, pixelWidth,
 			pixelHeight), editortools.BLOCK_DRAW_ID)
+		self.addTool(editortools.RegionTool(controller, pixelWidth,
+			pixelHeight), editortools.REGION_SELECT_ID)
+		self.addTool(editortools.TileReplaceTool(controller, pixelWidth,
+			pixelHeight), editortools.TILE_REPLACE_ID)
 
 		self.createScrollBars()
 
@@ -130,60 +230,46 @@ class MapGrid(tilegrid.TileGrid, mapcontroller.MapListener):
 
 		self.__redrawLocked = True
 
+		# The whole view is kept in the back buffer, so the size of the view
+		# comes from the allocation rather than from the exposed area
+		allocation = self.get_allocation()
+		width = allocation.width
+		height = allocation.height
+
 		# Ensure that the scrolling is handled correctly
 		# This sets the size of the scroll bar handles correctly
-		self.vAdjust.page_size = eh / self.getZoom()
-		self.hAdjust.page_size = ew / self.getZoom()
+		self.vAdjust.page_size = height / self.getZoom()
+		self.hAdjust.page_size = width / self.getZoom()
 
 		# Adjust the scroll offsets so that the maximum amount of map is
 		# visible. This mimics the behavior of a drawing area inside of a
 		# gtk.ScrolledWindow
-		ewz = int(ew / self.getZoom())
+		ewz = int(width / self.getZoom())
 		if self.__scrollOffsetX + ewz > self.hAdjust.upper:
-			self.__scrollOffsetX = int(max(self.hAdjust.upper - ewz, 0))
+			self.__scrollOffsetX = self.__snap(max(self.hAdjust.upper - ewz, 0))
 			self.hAdjust.value = self.__scrollOffsetX
 
-		ehz = int(eh / self.getZoom())
+		ehz = int(height / self.getZoom())
 		if self.__scrollOffsetY + ehz > self.vAdjust.upper:
-			self.__scrollOffsetY = int(max(self.vAdjust.upper - ehz, 0))
+			self.__scrollOffsetY = self.__snap(max(self.vAdjust.upper - ehz, 0))
 			self.vAdjust.value = self.__scrollOffsetY
 
-		context.rectangle(0, 0, self.hAdjust.upper - self.__scrollOffsetX,
-			self.vAdjust.upper - self.__scrollOffsetY)
-		context.set_source(self.checkerPattern)
-		context.fill()
-
-		# Draw tile layers
-		controller = self.getController()
-		ts = int(controller.mapTileSize())
-
-		xStart = self.__scrollOffsetX // ts
-		xEnd = (ewz // ts) + xStart + 2
-		yStart = self.__scrollOffsetY // ts
-		yEnd = (ehz // ts) + yStart + 2
-
-		i = controller.getLayerInfo()
-
-		for z in range(controller.getNumLayers()):
-			if i[z][1] == False:
-				continue # The layer is not visible
-			for x in range(xStart, xEnd):
-				for y in range(yStart, yEnd):
-					info = controller.getTile(x, y, z)
-					if info is not None:
-						surface = controller.getTilesetSurface(info[2])
-						context.set_source_surface(surface,
-							((x - info[0]) * ts) - self.__scrollOffsetX,
-							((y - info[1]) * ts) - self.__scrollOffsetY)
-						context.rectangle((x * ts) - self.__scrollOffsetX,
-							(y * ts) - self.__scrollOffsetY, ts, ts)
-						context.fill()
+		self.__updateBuffer(context, width, height)
 
+		# The buffer is in screen pixels, so it is copied without the zoom
+		context.save()
+		context.identity_matrix()
+		context.set_source_surface(self.__buffer, 0, 0)
+		context.set_operator(cairo.OPERATOR_SOURCE)
+		context.paint()
+		context.restore()
 
 		if self.showGrid == True:
+			controller = self.getController()
+			ts = int(controller.mapTileSize())
 			context.save()
-			context.rectangle(0, 0, ts * controller.mapWidth(),
-				ts * controller.mapHeight())
+			context.rectangle(0, 0, self.hAdjust.upper - self.__scrollOffsetX,
+				self.vAdjust.upper - self.__scrollOffsetY)
 			context.clip()
 			graphics.drawGrid(context, ts, ewz, ehz,
 				self.__scrollOffsetX,
@@ -197,6 +283,487 @@ class MapGrid(tilegrid.TileGrid, mapcontroller.MapListener):
 
 		self.__redrawLocked = False
 
+	def __updateBuffer(self, context, width, height):
+		"""
+		Brings the back buffer up to date with the view. When the view has
+		only scrolled, the pixels that are still visible are moved over and
+		only the strips that came into view are rendered.
+		@type context: cairo.Context
+		@param context: context of the window, used to create the buffer
+		@type width: int
+		@param width: width of the view in screen pixels
+		@type height: int
+		@param height: height of the view in screen pixels
+		"""
+		zoom = self.getZoom()
+		if self.__buffer is None or self.__buffer.get_width() != width \
+				or self.__buffer.get_height() != height:
+			target = context.get_target()
+			self.__buffer = target.create_similar(cairo.CONTENT_COLOR_ALPHA,
+				width, height)
+			self.__spare = target.create_similar(cairo.CONTENT_COLOR_ALPHA,
+				width, height)
+			self.__bands = [target.create_similar(cairo.CONTENT_COLOR_ALPHA,
+				width, height) for band in range(BANDS)]
+			self.__bufferZoom = zoom
+			self.__restart()
+			self.__bufferX = self.__scrollOffsetX
+			self.__bufferY = self.__scrollOffsetY
+			self.__placeholder([(0, 0, width, height)])
+		elif self.__bufferZoom != zoom:
+			self.__rescale(zoom)
+
+		offsetX = self.__scrollOffsetX
+		offsetY = self.__scrollOffsetY
+		viewW = width / zoom
+		viewH = height / zoom
+		# The offsets are snapped to whole screen pixels, so this only rounds
+		# away floating point error
+		dx = int(round((offsetX - self.__bufferX) * zoom))
+		dy = int(round((offsetY - self.__bufferY) * zoom))
+		placeholders = []
+		if abs(dx) >= width or abs(dy) >= height:
+			# Scrolled too far for any of the buffer to be reused
+			self.__restart()
+			placeholders.append((offsetX, offsetY, viewW, viewH))
+		elif dx != 0 or dy != 0:
+			self.__buffer = self.__shift(self.__buffer, dx, dy)
+			for band in range(BANDS):
+				self.__bands[band] = self.__shift(self.__bands[band], dx, dy)
+			strips = []
+			if offsetX > self.__bufferX:
+				strips.append((self.__bufferX + viewW, offsetY,
+					offsetX - self.__bufferX, viewH))
+			elif offsetX < self.__bufferX:
+				strips.append((offsetX, offsetY, self.__bufferX - offsetX,
+					viewH))
+			if offsetY > self.__bufferY:
+				strips.append((offsetX, self.__bufferY + viewH, viewW,
+					offsetY - self.__bufferY))
+			elif offsetY < self.__bufferY:
+				strips.append((offsetX, offsetY, viewW,
+					self.__bufferY - offsetY))
+			for damage in self.__damage:
+				if damage is not None:
+					damage.extend(strips)
+			placeholders = strips
+		self.__bufferX = offsetX
+		self.__bufferY = offsetY
+		self.__placeholder([self.__toScreen(strip) for strip in placeholders])
+
+		if self.__interactive:
+			# Rendered once input settles
+			return
+
+		pool = rasterizer.getPool()
+		changed = set()
+		for band in range(BANDS):
+			if self.__damage[band] is None:
+				damage = [(offsetX, offsetY, viewW, viewH)]
+				# Nothing that was asked for before is needed any more
+				for job in self.__pending[band]:
+					job.cancelled = True
+			else:
+				damage = self.__damage[band]
+			self.__damage[band] = []
+			for rectangle in damage:
+				rectangle = self.__toScreen(rectangle)
+				if rectangle is None:
+					continue
+				if pool is None:
+					self.__renderBand(band, *rectangle)
+					changed.add(rectangle)
+					continue
+				# Large areas are split up so that several workers can
+				# render them at the same time
+				left, top, right, bottom = rectangle
+				for y in range(top, bottom, JOB_SIZE):
+					for x in range(left, right, JOB_SIZE):
+						self.__submit(pool, band, x, y,
+							min(x + JOB_SIZE, right), min(y + JOB_SIZE, bottom))
+		for left, top, right, bottom in changed:
+			self.__composite(left, top, right, bottom)
+
+	def __toScreen(self, rectangle):
+		"""
+		@type rectangle: (float, float, float, float)
+		@param rectangle: x, y, width and height of part of the map in pixels
+		@rtype: (int, int, int, int)
+		@return: the left, top, right and bottom of the part of the buffer
+			that shows it, or None if it is not in view. This is rounded
+			outwards to whole screen pixels so that no seams are left between
+			the parts of the buffer.
+		"""
+		x, y, w, h = rectangle
+		zoom = self.__bufferZoom
+		left = max(int(math.floor((x - self.__bufferX) * zoom)), 0)
+		top = max(int(math.floor((y - self.__bufferY) * zoom)), 0)
+		right = min(int(math.ceil((x + w - self.__bufferX) * zoom)),
+			self.__buffer.get_width())
+		bottom = min(int(math.ceil((y + h - self.__bufferY) * zoom)),
+			self.__buffer.get_height())
+		if right <= left or bottom <= top:
+			return None
+		return left, top, right, bottom
+
+	def __restart(self):
+		"""
+		Forgets everything that has been rendered or asked for, so that all of
+		the bands are rendered again
+		"""
+		self.__generation += 1
+		for pending in self.__pending:
+			for job in pending:
+				job.cancelled = True
+		self.__pending = [collections.deque() for band in range(BANDS)]
+		self.__damage = [None] * BANDS
+
+	def __placeholder(self, rectangles):
+		"""
+		Draws the checker pattern, and the overview of the map over it, where
+		the bands have nothing to show until the workers have rendered it
+		@type rectangles: [(int, int, int, int)]
+		@param rectangles: left, top, right and bottom of each area in screen
+			pixels. None is ignored.
+		"""
+		controller = self.getController()
+		ts = controller.mapTileSize()
+		overview = self.__overview
+		if overview is not None and not overview.hasMap():
+			overview = None
+		for band in range(BANDS):
+			context = cairo.Context(self.__bands[band])
+			for rectangle in rectangles:
+				if rectangle is None:
+					continue
+				left, top, right, bottom = rectangle
+				context.save()
+				context.rectangle(left, top, right - left, bottom - top)
+				context.clip()
+				context.set_operator(cairo.OPERATOR_CLEAR)
+				context.paint()
+				context.set_operator(cairo.OPERATOR_OVER)
+				if band != BAND_BELOW:
+					context.restore()
+					continue
+				context.scale(self.__bufferZoom, self.__bufferZoom)
+				context.translate(-self.__bufferX, -self.__bufferY)
+				context.rectangle(0, 0, self.hAdjust.upper, self.vAdjust.upper)
+				context.set_source(self.checkerPattern)
+				context.fill()
+				if overview is not None:
+					# One pixel of the first level of the overview for each
+					# tile, blown up without filtering
+					context.scale(ts, ts)
+					overview.draw(context, controller.mapWidth(),
+						controller.mapHeight(), cairo.FILTER_NEAREST)
+				context.restore()
+		for rectangle in rectangles:
+			if rectangle is not None:
+				self.__composite(*rectangle)
+
+	def __rescale(self, zoom):
+		"""
+		Makes new bands for a new zoom level. Until they have been rendered,
+		they show the old bands scaled without filtering, over the overview
+		of the map where the old bands don't reach.
+		@type zoom: float
+		@param zoom: the new zoom level
+		"""
+		width = self.__buffer.get_width()
+		height = self.__buffer.get_height()
+		oldBands = self.__bands
+		oldZoom = self.__bufferZoom
+		oldX = self.__bufferX
+		oldY = self.__bufferY
+		self.__bands = [surface.create_similar(cairo.CONTENT_COLOR_ALPHA,
+			width, height) for surface in oldBands]
+		self.__bufferZoom = zoom
+		self.__bufferX = self.__scrollOffsetX
+		self.__bufferY = self.__scrollOffsetY
+		self.__restart()
+		self.__placeholder([(0, 0, width, height)])
+		for band in range(BANDS):
+			context = cairo.Context(self.__bands[band])
+			context.scale(zoom, zoom)
+			context.translate(oldX - self.__bufferX, oldY - self.__bufferY)
+			context.scale(1.0 / oldZoom, 1.0 / oldZoom)
+			context.rectangle(0, 0, width, height)
+			context.clip()
+			context.set_source_surface(oldBands[band], 0, 0)
+			context.get_source().set_filter(cairo.FILTER_NEAREST)
+			context.set_operator(cairo.OPERATOR_SOURCE)
+			context.paint()
+		self.__composite(0, 0, width, height)
+
+	def __submit(self, pool, band, left, top, right, bottom):
+		"""
+		Asks the worker threads to render part of a band. Until it is done,
+		the band keeps showing what it showed before. See __renderBand for
+		the other parameters.
+		@type pool: rasterizer.RasterPool
+		@param pool: the workers
+		"""
+		controller = self.getController()
+		ts = int(controller.mapTileSize())
+		zoom = self.__bufferZoom
+		x = left / zoom + self.__bufferX
+		y = top / zoom + self.__bufferY
+		xStart = max(int(x) // ts, 0)
+		xEnd = min(int(math.ceil(right / zoom + self.__bufferX)) // ts + 1,
+			controller.mapWidth())
+		yStart = max(int(y) // ts, 0)
+		yEnd = min(int(math.ceil(bottom / zoom + self.__bufferY)) // ts + 1,
+			controller.mapHeight())
+
+		# Everything that the worker reads is copied, so that the map can be
+		# edited while it renders
+		chunks = tilerender.gatherChunks(controller, self.__bandLayers(band),
+			xStart, yStart, xEnd, yEnd, True)
+		renderTable = controller.getRenderTable()
+		entries = list(renderTable.lookup())
+		opacity = renderTable.opacity()[:]
+		checker = self.checkerPattern if band == BAND_BELOW else None
+		mapWidth = self.hAdjust.upper
+		mapHeight = self.vAdjust.upper
+		nearest = zoom > 1.0
+
+		job = _RenderJob(band, left, top, right, bottom, self.__bufferX,
+			self.__bufferY, self.__generation)
+		self.__pending[band].append(job)
+		if checker is None and len(chunks) == 0:
+			# Nothing to draw, so the area only needs to be cleared
+			job.done = True
+			self.__finished(job, None)
+			return
+
+		def render():
+			if job.cancelled:
+				return None
+			surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, right - left,
+				bottom - top)
+			context = cairo.Context(surface)
+			context.scale(zoom, zoom)
+			context.translate(-x, -y)
+			if checker is not None:
+				context.rectangle(0, 0, mapWidth, mapHeight)
+				context.set_source(checker)
+				context.fill()
+			tilerender.renderTiles(context, chunks, entries, opacity, ts,
+				xStart, yStart, xEnd, yEnd, nearest)
+			return surface
+
+		pool.submit(render, lambda surface: self.__finished(job, surface))
+
+	def __finished(self, job, surface):
+		"""
+		Copies the results of the jobs of a band that are done to the band,
+		in the order that the jobs were given
+		@type job: _RenderJob
+		@param job: the job that has just finished
+		@type surface: cairo.ImageSurface
+		@param surface: what it rendered, or None if the area is empty
+		"""
+		job.done = True
+		job.surface = surface
+		pending = self.__pending[job.band]
+		changed = []
+		while len(pending) > 0 and pending[0].done:
+			finished = pending.popleft()
+			if finished.cancelled or finished.generation != self.__generation:
+				continue
+			# The view may have scrolled since the job was given out
+			dx = int((finished.offsetX - self.__bufferX) * self.__bufferZoom)
+			dy = int((finished.offsetY - self.__bufferY) * self.__bufferZoom)
+			left = finished.left + dx
+			top = finished.top + dy
+			right = finished.right + dx
+			bottom = finished.bottom + dy
+			context = cairo.Context(self.__bands[finished.band])
+			context.rectangle(left, top, right - left, bottom - top)
+			context.clip()
+			if finished.surface is None:
+				context.set_operator(cairo.OPERATOR_CLEAR)
+				context.paint()
+			else:
+				context.set_source_surface(finished.surface, left, top)
+				context.set_operator(cairo.OPERATOR_SOURCE)
+				context.paint()
+			changed.append((max(left, 0), max(top, 0),
+				min(right, self.__buffer.get_width()),
+				min(bottom, self.__buffer.get_height())))
+		for left, top, right, bottom in changed:
+			if right > left and bottom > top:
+				self.__composite(left, top, right, bottom)
+		if len(changed) > 0:
+			self.queue_draw()
+
+	def __shift(self, surface, dx, dy):
+		"""
+		Moves the contents of a surface by a number of screen pixels
+		@rtype: cairo.Surface
+		@return: the surface with the moved contents. The surface that was
+			passed in becomes the spare surface.
+		"""
+		context = cairo.Context(self.__spare)
+		context.set_source_surface(surface, -dx, -dy)
+		context.set_operator(cairo.OPERATOR_SOURCE)
+		context.paint()
+		shifted = self.__spare
+		self.__spare = surface
+		return shifted
+
+	def __bandLayers(self, band):
+		"""
+		@rtype: [int]
+		@return: the indices of the visible layers in a band
+		"""
+		controller = self.getController()
+		selected = controller.selectedLayer()
+		info = controller.getLayerInfo()
+		if band == BAND_BELOW:
+			layers = range(0, selected)
+		elif band == BAND_SELECTED:
+			layers = [selected]
+		else:
+			layers = range(selected + 1, controller.getNumLayers())
+		return [z for z in layers if 0 <= z < len(info) and info[z][1]]
+
+	def __bandOf(self, z):
+		selected = self.getController().selectedLayer()
+		if z < selected:
+			return BAND_BELOW
+		elif z == selected:
+			return BAND_SELECTED
+		else:
+			return BAND_ABOVE
+
+	def __renderBand(self, band, left, top, right, bottom):
+		"""
+		Renders part of one of the bands
+		@type band: int
+		@param band: BAND_BELOW, BAND_SELECTED or BAND_ABOVE
+		@type left: int
+		@param left: left edge in screen pixels
+		@type top: int
+		@param top: top edge in screen pixels
+		@type right: int
+		@param right: right edge in screen pixels
+		@type bottom: int
+		@param bottom: bottom edge in screen pixels
+		"""
+		zoom = self.__bufferZoom
+		offsetX = self.__bufferX
+		offsetY = self.__bufferY
+		context = cairo.Context(self.__bands[band])
+		context.rectangle(left, top, right - left, bottom - top)
+		context.clip()
+		context.set_operator(cairo.OPERATOR_CLEAR)
+		context.paint()
+		context.set_operator(cairo.OPERATOR_OVER)
+		context.scale(zoom, zoom)
+		context.translate(-offsetX, -offsetY)
+		if band == BAND_BELOW:
+			context.rectangle(0, 0, self.hAdjust.upper, self.vAdjust.upper)
+			context.set_source(self.checkerPattern)
+			context.fill()
+		self.renderArea(context, left / zoom + offsetX, top / zoom + offsetY,
+			right / zoom + offsetX, bottom / zoom + offsetY,
+			self.__bandLayers(band))
+
+	def __composite(self, left, top, right, bottom):
+		"""
+		Copies part of the three bands to the buffer. See __renderBand for
+		the parameters.
+		"""
+		context = cairo.Context(self.__buffer)
+		context.rectangle(left, top, right - left, bottom - top)
+		context.clip()
+		context.set_operator(cairo.OPERATOR_CLEAR)
+		context.paint()
+		context.set_operator(cairo.OPERATOR_OVER)
+		for band, surface in enumerate(self.__bands):
+			context.set_source_surface(surface, 0, 0)
+			if self.__dimOthers and band != BAND_SELECTED:
+				context.paint_with_alpha(preferences.visual["dim_opacity"])
+			else:
+				context.paint()
+
+	def renderArea(self, context, x1, y1, x2, y2, layers = None):
+		"""
+		Renders the tile layers in part of the map
+		@type context: cairo.Context
+		@param context: context with its origin at the top-left corner of the
+			map
+		@type x1: float
+		@param x1: left edge of the area in pixels
+		@type y1: float
+		@param y1: top edge of the area in pixels
+		@type x2: float
+		@param x2: right edge of the area in pixels
+		@type y2: float
+		@param y2: bottom edge of the area in pixels
+		@type layers: [int]
+		@param layers: indices of the layers to render, or None to render
+			all of the visible layers
+		"""
+		controller = self.getController()
+		ts = int(controller.mapTileSize())
+
+		xStart = max(int(x1) // ts, 0)
+		xEnd = min(int(math.ceil(x2)) // ts + 1, controller.mapWidth())
+		yStart = max(int(y1) // ts, 0)
+		yEnd = min(int(math.ceil(y2)) // ts + 1, controller.mapHeight())
+
+		if layers is None:
+			i = controller.getLayerInfo()
+			layers = [z for z in range(controller.getNumLayers()) if i[z][1]]
+		renderTable = controller.getRenderTable()
+		tilerender.renderTiles(context, tilerender.gatherChunks(controller,
+			layers, xStart, yStart, xEnd, yEnd), renderTable.lookup(),
+			renderTable.opacity(), ts, xStart, yStart, xEnd, yEnd,
+			self.getZoom() > 1.0)
+
+	def invalidate(self, x = 0, y = 0, width = None, height = None,
+			z = None):
+		"""
+		Marks part of the map to be rendered again the next time the view is
+		drawn, and queues a redraw. With no arguments the whole view is
+		rendered again.
+		@type x: int
+		@param x: left edge in pixels
+		@type y: int
+		@param y: top edge in pixels
+		@type width: int
+		@param width: width in pixels
+		@type height: int
+		@param height: height in pixels
+		@type z: int
+		@param z: the layer that changed, or None if it could have been any
+			of them
+		"""
+		if z is None:
+			bands = range(BANDS)
+		else:
+			bands = [self.__bandOf(z)]
+		for band in bands:
+			if width is None or height is None:
+				self.__damage[band] = None
+			elif self.__damage[band] is not None:
+				self.__damage[band].append((x, y, width, height))
+		self.queue_draw()
+
+	def setDimOthers(self, dim):
+		"""
+		@type dim: bool
+		@param dim: True to fade the layers other than the selected one
+		"""
+		self.__dimOthers = dim
+		if self.__buffer is not None:
+			self.__composite(0, 0, self.__buffer.get_width(),
+				self.__buffer.get_height())
+		self.queue_draw()
+
 	def addTool(self, tool, toolID):
 		tilegrid.TileGrid.addTool(self, tool, toolID)
 		self.__lastMessage = self.__statusBar.push(self.__contextID,
@@ -250,6 +817,13 @@ class MapGrid(tilegrid.TileGrid, mapcontroller.MapListener):
 		@type event: gtk.gdk.Event
 		@param event: the scroll event
 		"""
+		if event.state & gtk.gdk.CONTROL_MASK:
+			# Ctrl+wheel zooms smoothly around the pointer
+			if event.direction == gtk.gdk.SCROLL_UP:
+				self.zoomAt(self.getZoom() * WHEEL_ZOOM_STEP, event.x, event.y)
+			elif event.direction == gtk.gdk.SCROLL_DOWN:
+				self.zoomAt(self.getZoom() / WHEEL_ZOOM_STEP, event.x, event.y)
+			return True
 		if event.direction == gtk.gdk.SCROLL_UP:
 			self.vAdjust.set_value(self.vAdjust.value
 				- self.vAdjust.step_increment)
@@ -280,81 +854,192 @@ class MapGrid(tilegrid.TileGrid, mapcontroller.MapListener):
 			self.getToolInstructions())
 		self.queue_draw()
 
+	def setZoom(self, factor):
+		oldZoom = self.getZoom()
+		tilegrid.TileGrid.setZoom(self, factor)
+		if self.getZoom() != oldZoom:
+			self.__scrollOffsetX = self.__snap(self.__scrollOffsetX)
+			self.__scrollOffsetY = self.__snap(self.__scrollOffsetY)
+			self.__interact()
+
+	def __snap(self, value):
+		"""
+		Rounds a scroll offset to the nearest one that lands on a whole screen
+		pixel at the current zoom level. The back buffer can then always be
+		moved by whole pixels when scrolling, even when the zoom level is not.
+		@type value: float
+		@param value: the offset in map pixels
+		@rtype: float
+		@return: the snapped offset in map pixels
+		"""
+		zoom = self.getZoom()
+		return round(value * zoom) / zoom
+
+	def zoomAt(self, factor, x, y):
+		"""
+		Zooms without moving the point of the map that is under a point of
+		the view
+		@type factor: float
+		@param factor: the new zoom level
+		@type x: float
+		@param x: x-coordinate in screen pixels from the left of the view
+		@type y: float
+		@param y: y-coordinate in screen pixels from the top of the view
+		"""
+		oldZoom = self.getZoom()
+		mapX = self.hAdjust.value + x / oldZoom
+		mapY = self.vAdjust.value + y / oldZoom
+		self.setZoom(factor)
+		zoom = self.getZoom()
+		if zoom == oldZoom:
+			return
+		allocation = self.get_allocation()
+		for adjustment, point, size in ((self.hAdjust, mapX - x / zoom,
+				allocation.width), (self.vAdjust, mapY - y / zoom,
+				allocation.height)):
+			# The page size is set again on the next redraw, but the new value
+			# has to be clamped to it now
+			adjustment.page_size = size / zoom
+			point = min(point, adjustment.upper - adjustment.page_size)
+			adjustment.set_value(max(point, 0))
+
+	def __interact(self):
+		"""
+		Stops rendering until there has been no zooming or fast scrolling for
+		SETTLE_DELAY seconds
+		"""
+		self.__interactive = True
+		scheduler.getScheduler().cancel(self.__settleTask)
+		self.__settleTask = scheduler.getScheduler().add(self.__settle,
+			scheduler.PRIORITY_HIGH, "mapgrid.settle", SETTLE_DELAY)
+
+	def __settle(self):
+		self.__settleTask = None
+		self.__interactive = False
+		# The damage that was kept is rendered on the next redraw
+		self.queue_draw()
+		return False
+
 	def scrollUpdate(self, adjustment, vertical):
+		# Scrolling again before the last scroll has settled is fast enough
+		# that rendering each step would hold up input
+		now = time.time()
+		if now - self.__lastScroll < SETTLE_DELAY:
+			self.__interact()
+		self.__lastScroll = now
+
 		if vertical:
-			self.__scrollOffsetY = int(round(adjustment.get_value()))
+			self.__scrollOffsetY = self.__snap(adjustment.get_value())
 		else:
-			self.__scrollOffsetX = int(round(adjustment.get_value()))
+			self.__scrollOffsetX = self.__snap(adjustment.get_value())
 
 		# Prevent an infinite loop
 		if self.__redrawLocked == False:
 			self.queue_draw()
 
-	def getThumbnail(self, largest):
+		scheduler.getScheduler().cancel(self.__warmTask)
+		steps = self.__warmChunks()
+		self.__warmTask = scheduler.getScheduler().add(
+			lambda: next(steps, False), scheduler.PRIORITY_LOW,
+			"mapgrid.warm", WARM_DELAY)
+
+	def __warmChunks(self):
 		"""
-		@type largest: int
-		@param largest: the largest of the dimentions of the returned image
+		Loads the chunks of every layer in a margin around the view, one row
+		of chunks at a time
 		"""
 		controller = self.getController()
-		ts = controller.mapTileSize()
-		mw = controller.mapWidth()
-		mh = controller.mapHeight()
-		w = mw * ts
-		h = mh * ts
-		s = 1.0
-		if w > h:
-			s = float(largest) / float(w)
-		else:
-			s = float(largest) / float(h)
-		result = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(w * s), int(h * s))
-		context = cairo.Context(result)
-		context.scale(s, s)
-
-		# Now a trick to get this to work correctly. specialRedraw changes based
-		# on the values of self.__scrollOffset*, so make a copy of them here
-		tempScrollX = self.__scrollOffsetX
-		tempScrollY = self.__scrollOffsetY
-		self.__scrollOffsetX = 0
-		self.__scrollOffsetY = 0
-
-		self.specialRedraw(context, 0, 0, w, h)
-
-		# Restore them here
-		self.__scrollOffsetX = tempScrollX
-		self.__scrollOffsetY = tempScrollY
+		cs = tilemap.CHUNK_SIZE
+		x, y, w, h = self.getViewRectangle()
+		span = controller.mapTileSize() * cs
+		left = max(x // span - WARM_MARGIN, 0)
+		top = max(y // span - WARM_MARGIN, 0)
+		right = min((x + w) // span + WARM_MARGIN + 1,
+			(controller.mapWidth() + cs - 1) // cs)
+		bottom = min((y + h) // span + WARM_MARGIN + 1,
+			(controller.mapHeight() + cs - 1) // cs)
+		for z in range(controller.getNumLayers()):
+			for cy in range(top, bottom):
+				if not controller.hasMap() or z >= controller.getNumLayers():
+					return
+				for cx in range(left, right):
+					controller.getLayerChunk(z, (cx, cy))
+				yield True
 
+	def getViewRectangle(self):
+		"""
+		@rtype: (int, int, int, int)
+		@return: the x, y, width and height of the part of the map that is
+			visible, in pixels
+		"""
+		return int(self.__scrollOffsetX), int(self.__scrollOffsetY), \
+			int(self.hAdjust.page_size), int(self.vAdjust.page_size)
 
-		return result
+	def centerOn(self, x, y):
+		"""
+		Scrolls so that a point of the map is in the middle of the view
+		@type x: float
+		@param x: x-coordinate in pixels
+		@type y: float
+		@param y: y-coordinate in pixels
+		"""
+		for adjustment, value in ((self.hAdjust, x), (self.vAdjust, y)):
+			value = min(value - adjustment.page_size / 2.0,
+				adjustment.upper - adjustment.page_size)
+			adjustment.set_value(max(value, 0))
 
 	############################################################################
 	# MapListener code
 	############################################################################
 
 	def listenSetVisibilty(self, index, visible):
-		self.queue_draw()
+		self.invalidate()
 
 	def listenResize(self, width, height, xOffset, yOffset):
 		ts = self.getController().mapTileSize()
 		self.vAdjust.upper = height * ts
 		self.hAdjust.upper = width * ts
+		self.invalidate()
 
 	def listenAddLayer(self, layerName):
-		self.queue_draw()
+		self.invalidate()
 
 	def listenRemoveLayer(self, index):
-		self.queue_draw()
+		self.invalidate()
 
 	def listenSwapLayers(self, index1, index2):
-		self.queue_draw()
+		self.invalidate()
 
 	def listenAddTile(self, tile, x, y, z):
-		self.queue_draw()
+		ts = self.getController().mapTileSize()
+		self.invalidate(x * ts, y * ts, ts, ts, z)
 
 	def listenRemoveTile(self, x, y, z):
-		self.queue_draw()
+		ts = self.getController().mapTileSize()
+		self.invalidate(x * ts, y * ts, ts, ts, z)
+
+	def listenFillTiles(self, z, runs):
+		if len(runs) == 0:
+			return
+		# One rectangle around all of the runs is cheaper to render than one
+		# for each run
+		ts = self.getController().mapTileSize()
+		ys = runs[0::3]
+		left = min(runs[1::3])
+		right = max(runs[2::3]) + 1
+		self.invalidate(left * ts, min(ys) * ts, (right - left) * ts,
+			(max(ys) - min(ys) + 1) * ts, z)
+
+	def listenAddTileSet(self, fileName):
+		# Tiles that could not be drawn before may have an image now
+		self.invalidate()
+
+	def listenSelectLayer(self, index):
+		# The layers move between the bands
+		self.invalidate()
 
 	def listenUndoRedo(self):
-		self.queue_draw()
+		self.invalidate()
 
 	############################################################################
 	# End MapListener code
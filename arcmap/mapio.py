@@ -29,6 +29,7 @@ import json
 
 import preferences
 import tilemap
+import autotile
 import graphics
 import datafiles
 
@@ -37,12 +38,8 @@ log = logging.getLogger("mapio")
 
 class MapWriter(object):
 	def __init__(self, tileMap):
-		self.__dictionary = {"layers": [], "images": []}
+		self.__dictionary = None
 		self.__map = tileMap
-		self.writeInfo(self.__map.width, self.__map.height, self.__map.tileSize)
-		self.writeLayers(self.__map.layers)
-		self.writeImages(self.__map.images)
-		self.writeBlocking(self.__map.blocking)
 
 	def writeInfo(self, width, height, tileSize):
 		self.__dictionary["width"] = width
@@ -51,7 +48,8 @@ class MapWriter(object):
 
 	def writeLayers(self, layers):
 		for index, layer in enumerate(layers):
-			self.__writeLayer(layer, index)
+			self.__dictionary["layers"].append(self.layerDictionary(layer,
+				index))
 
 	def writeBlocking(self, blocking):
 		self.__dictionary["blocking"] = blocking
@@ -61,26 +59,57 @@ class MapWriter(object):
 			self.__dictionary["images"].append({"index": index,
 				"fileName": datafiles.getTilesetPath(fileName, True)})
 
-	def __writeLayer(self, layer, index):
+	def writeTerrains(self, terrains):
+		self.__dictionary["terrains"] = [terrain.toDictionary()
+			for terrain in terrains]
+
+	def headerDictionary(self):
+		"""
+		@rtype: {}
+		@return: the size, image and terrain information of the map, without
+			the layers or the blocking information
+		"""
+		saved = self.__dictionary
+		self.__dictionary = {"images": []}
+		self.writeInfo(self.__map.width, self.__map.height, self.__map.tileSize)
+		self.writeImages(self.__map.images)
+		if len(self.__map.terrains) > 0:
+			self.writeTerrains(self.__map.terrains)
+		header = self.__dictionary
+		self.__dictionary = saved
+		return header
+
+	def layerDictionary(self, layer, index):
+		"""
+		@type layer: tilemap.Layer
+		@param layer: the layer to write
+		@type index: int
+		@param index: the index of the layer in the map
+		@rtype: {}
+		@return: the layer in the form of a Python dictionary
+		"""
 		layerDictionary = {"index": index, "name": layer.name,
 			"visible": layer.visible, "tiles": []}
-		for x, column in enumerate(layer.tiles):
-			for y, tile in enumerate(column):
-				if tile is not None:
-					ix, iy, index = tile.getImageInfo()
-					layerDictionary["tiles"].append({"x": x, "y": y, "ix": ix,
-						"iy": iy, "ii": index})
-		self.__dictionary["layers"].append(layerDictionary)
+		for x, y, tile in layer.iterTiles():
+			ix, iy, ii = tile.getImageInfo()
+			layerDictionary["tiles"].append({"x": x, "y": y, "ix": ix,
+				"iy": iy, "ii": ii})
+		return layerDictionary
 
 	def writef(self, fileName):
 		try:
 			f = open(fileName, "w")
 		except IOError as e:
 			log.warning(e)
-		json.dump(self.__dictionary, f, indent=4)
+		json.dump(self.writed(), f, indent=4)
 		f.close()
 
 	def writed(self):
+		if self.__dictionary is None:
+			self.__dictionary = self.headerDictionary()
+			self.__dictionary["layers"] = []
+			self.writeLayers(self.__map.layers)
+			self.writeBlocking(self.__map.blocking)
 		return self.__dictionary
 
 
@@ -140,6 +169,10 @@ class MapReader:
 			log.error("No image files specified in map file")
 			return None
 
+		if "terrains" in d:
+			for terrain in d["terrains"]:
+				self.__readTerrain(terrain)
+
 		if "layers" in d:
 			if len(d["layers"]) == 0:
 				self.map.addLayer("New Layer", True)
@@ -174,6 +207,12 @@ class MapReader:
 
 		self.map.addImage(fileName, index)
 
+	def __readTerrain(self, terrain):
+		try:
+			self.map.terrains.append(autotile.Terrain.fromDictionary(terrain))
+		except (KeyError, TypeError, ValueError) as e:
+			raise MapLoadException("Invalid terrain: %s" % e)
+
 	def __readLayer(self, layer):
 		if "name" in layer:
 			if type(layer["name"]) == str or type(layer["name"]) == unicode:
@@ -236,7 +275,7 @@ class MapReader:
 			else:
 				raise MapLoadException("No image index specified for tile")
 
-			t = tilemap.Tile(ii, ix, iy)
+			t = self.map.tileTable.intern(ii, ix, iy)
 			self.map.addTile(t, x, y, layer["index"])
 
 
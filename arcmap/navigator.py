@@ -0,0 +1,154 @@
+################################################################################
+# Authors: Brian Schott (Sir Alaran)
+# Copyright: Brian Schott (Sir Alaran)
+# Date: Oct 20 2009
+# License:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+"""
+Contains a widget that shows the whole map and moves the map view to where
+it is clicked.
+"""
+
+__docformat__ = "epytext"
+
+import gtk
+
+import graphics
+
+
+class Navigator(gtk.DrawingArea):
+	"""
+	Draws the map overview scaled to fit, with a rectangle around the part of
+	the map that the map grid shows. Clicking or dragging centers the map grid
+	on that point.
+	"""
+
+	__gsignals__ = {"expose-event": "override"}
+
+	def __init__(self, overview):
+		"""
+		@type overview: overview.Overview
+		@param overview: the overview of the map
+		"""
+		gtk.DrawingArea.__init__(self)
+		self.__overview = overview
+		self.__overview.addCallback(self.queue_draw)
+		# mapgrid.MapGrid that is moved around, or None
+		self.__mapGrid = None
+		# Handler ids of the scroll adjustment signals
+		self.__handlers = []
+		self.__dragging = False
+
+		self.set_size_request(-1, 160)
+
+		# Like TileGrid, the drawing area gets its mouse events through an
+		# event box
+		self.eventBox = gtk.EventBox()
+		self.eventBox.connect("button-press-event", self.buttonPress)
+		self.eventBox.connect("button-release-event", self.buttonRelease)
+		self.eventBox.connect("motion-notify-event", self.mouseMotion)
+		self.eventBox.add(self)
+		self.eventBox.set_events(gtk.gdk.POINTER_MOTION_MASK |
+			gtk.gdk.BUTTON_PRESS_MASK |
+			gtk.gdk.BUTTON_RELEASE_MASK)
+		self.eventBox.show_all()
+
+	def getWidget(self):
+		return self.eventBox
+
+	def setMapGrid(self, mapGrid):
+		"""
+		@type mapGrid: mapgrid.MapGrid
+		@param mapGrid: the map view to move around, or None
+		"""
+		if self.__mapGrid is not None:
+			for adjustment, handler in self.__handlers:
+				adjustment.disconnect(handler)
+		self.__handlers = []
+		self.__mapGrid = mapGrid
+		if mapGrid is not None:
+			for adjustment in (mapGrid.hAdjust, mapGrid.vAdjust):
+				handler = adjustment.connect("value-changed", self.__moved)
+				self.__handlers.append((adjustment, handler))
+		self.queue_draw()
+
+	def __moved(self, adjustment):
+		self.queue_draw()
+
+	def __layout(self):
+		"""
+		@return: the x-offset, y-offset and scale at which the map is drawn
+			to fit the widget, in pixels per tile
+		"""
+		width, height = self.__overview.getSize()
+		allocation = self.get_allocation()
+		scale = min(float(allocation.width) / max(width, 1),
+			float(allocation.height) / max(height, 1))
+		x = (allocation.width - width * scale) / 2.0
+		y = (allocation.height - height * scale) / 2.0
+		return x, y, scale
+
+	def do_expose_event(self, event):
+		context = self.window.cairo_create()
+		context.rectangle(event.area.x, event.area.y, event.area.width,
+			event.area.height)
+		context.clip()
+		graphics.getBackgroundColor().contextColor(context)
+		context.paint()
+		if not self.__overview.hasMap():
+			return
+
+		x, y, scale = self.__layout()
+		width, height = self.__overview.getSize()
+		context.save()
+		context.translate(int(x), int(y))
+		self.__overview.draw(context, int(width * scale), int(height * scale))
+		context.restore()
+
+		if self.__mapGrid is None:
+			return
+		viewX, viewY, viewW, viewH = self.__mapGrid.getViewRectangle()
+		ts = float(self.__mapGrid.getController().mapTileSize())
+		fc = graphics.getHighlightColor()
+		context.set_source_rgba(fc.r, fc.g, fc.b, 1.0)
+		context.set_line_width(1.0)
+		context.rectangle(int(x + viewX / ts * scale) + 0.5,
+			int(y + viewY / ts * scale) + 0.5,
+			int(viewW / ts * scale), int(viewH / ts * scale))
+		context.stroke()
+
+	def __center(self, px, py):
+		if self.__mapGrid is None or not self.__overview.hasMap():
+			return
+		x, y, scale = self.__layout()
+		if scale <= 0:
+			return
+		ts = self.__mapGrid.getController().mapTileSize()
+		self.__mapGrid.centerOn((px - x) / scale * ts, (py - y) / scale * ts)
+
+	def buttonPress(self, widget, event):
+		if event.button == 1:
+			self.__dragging = True
+			self.__center(event.x, event.y)
+
+	def buttonRelease(self, widget, event):
+		if event.button == 1:
+			self.__dragging = False
+
+	def mouseMotion(self, widget, event):
+		if self.__dragging:
+			self.__center(event.x, event.y)
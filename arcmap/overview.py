@@ -0,0 +1,364 @@
+################################################################################
+# Authors: Brian Schott (Sir Alaran)
+# Copyright: Brian Schott (Sir Alaran)
+# Date: Oct 20 2009
+# License:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+"""
+Keeps a small picture of the whole map for thumbnails and the navigator.
+"""
+
+__docformat__ = "epytext"
+
+import array
+import logging
+import struct
+
+import cairo
+
+import mapcontroller
+import scheduler
+import tilemap
+
+log = logging.getLogger("overview")
+
+# Number of chunks that are redrawn in each step of the scheduler task
+CHUNKS_PER_STEP = 4
+
+# Levels are added to the pyramid until the largest side is this small
+SMALLEST_LEVEL = 16
+
+
+def tileColor(surface, x, y, size):
+	"""
+	@type surface: cairo.ImageSurface
+	@param surface: the surface that holds the tile image
+	@type x: int
+	@param x: x-coordinate of the image on the surface
+	@type y: int
+	@param y: y-coordinate of the image on the surface
+	@type size: int
+	@param size: width and height of the image
+	@rtype: int
+	@return: the average color of the image, as a premultiplied ARGB32 pixel
+	"""
+	tile = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
+	context = cairo.Context(tile)
+	context.set_source_surface(surface, -x, -y)
+	context.set_operator(cairo.OPERATOR_SOURCE)
+	context.paint()
+	# Halving with bilinear filtering averages each 2x2 block of pixels
+	while size > 1:
+		size = (size + 1) // 2
+		half = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
+		context = cairo.Context(half)
+		context.scale(0.5, 0.5)
+		context.set_source_surface(tile, 0, 0)
+		context.get_source().set_filter(cairo.FILTER_BILINEAR)
+		context.set_operator(cairo.OPERATOR_SOURCE)
+		context.paint()
+		tile = half
+	tile.flush()
+	return struct.unpack("=I", str(tile.get_data()[0:4]))[0]
+
+
+class Overview(mapcontroller.MapListener):
+	"""
+	A pyramid of images of the map. The first level has one pixel for each
+	tile, in the average color of the topmost visible tile there. Each level
+	after that is half the size of the one before. When tiles change, only
+	the chunks that they are in are drawn again, on idle, and the change is
+	carried up through the pyramid. Thumbnails are scaled down from the
+	smallest level that is large enough, so they take the same time on any
+	size of map.
+	"""
+	def __init__(self, controller):
+		mapcontroller.MapListener.__init__(self, controller)
+		self.__width = 0
+		self.__height = 0
+		# Pixels of the first level, row by row
+		self.__pixels = None
+		# cairo.ImageSurface for each level of the pyramid
+		self.__levels = []
+		# Average color of each tile id, or None where it is not yet known
+		self.__colors = []
+		# Keys of the chunks that need to be drawn again
+		self.__dirty = set()
+		# scheduler.Task that draws the dirty chunks, or None
+		self.__task = None
+		# Functions that are called after the overview has changed
+		self.__callbacks = []
+
+	def addCallback(self, callback):
+		"""
+		@type callback: callable
+		@param callback: called without arguments whenever the overview has
+			been updated
+		"""
+		self.__callbacks.append(callback)
+
+	def removeCallback(self, callback):
+		if callback in self.__callbacks:
+			self.__callbacks.remove(callback)
+
+	def hasMap(self):
+		"""
+		@rtype: bool
+		@return: True if there is a map to show
+		"""
+		return self.__pixels is not None
+
+	def getSize(self):
+		"""
+		@rtype: (int, int)
+		@return: the size of the map in tiles
+		"""
+		return self.__width, self.__height
+
+	def __create(self):
+		controller = self.getController()
+		self.__width = controller.mapWidth()
+		self.__height = controller.mapHeight()
+		self.__pixels = array.array("I", [0]) * (self.__width * self.__height)
+		self.__levels = [cairo.ImageSurface.create_for_data(self.__pixels,
+			cairo.FORMAT_ARGB32, self.__width, self.__height,
+			self.__width * 4)]
+		width = self.__width
+		height = self.__height
+		while max(width, height) > SMALLEST_LEVEL:
+			width = max((width + 1) // 2, 1)
+			height = max((height + 1) // 2, 1)
+			self.__levels.append(cairo.ImageSurface(cairo.FORMAT_ARGB32,
+				width, height))
+		self.__colors = []
+		self.__markAll()
+
+	def __markAll(self):
+		cs = tilemap.CHUNK_SIZE
+		self.__dirty = set([(cx, cy)
+			for cx in range((self.__width + cs - 1) // cs)
+			for cy in range((self.__height + cs - 1) // cs)])
+		self.__schedule()
+
+	def __mark(self, x, y):
+		cs = tilemap.CHUNK_SIZE
+		self.__dirty.add((x // cs, y // cs))
+		self.__schedule()
+
+	def __schedule(self):
+		if self.__pixels is None:
+			return
+		if self.__task is None or not self.__task.isActive():
+			self.__task = scheduler.getScheduler().add(self.__step,
+				scheduler.PRIORITY_HIGH, "overview")
+
+	def __step(self):
+		if self.__pixels is None:
+			return False
+		self.update(CHUNKS_PER_STEP)
+		return len(self.__dirty) > 0
+
+	def update(self, limit = None):
+		"""
+		Draws the chunks that have changed
+		@type limit: int
+		@param limit: the most chunks to draw, or None to draw all of them
+		"""
+		if self.__pixels is None or not self.__dirty:
+			return
+		keys = sorted(self.__dirty)
+		if limit is not None:
+			keys = keys[:limit]
+		for key in keys:
+			self.__dirty.discard(key)
+			self.__drawChunk(key)
+		for callback in self.__callbacks:
+			callback()
+
+	def __tileColors(self):
+		"""
+		@return: the average color of each tile id of the map
+		"""
+		controller = self.getController()
+		entries = controller.getRenderTable().lookup()
+		ts = controller.mapTileSize()
+		while len(self.__colors) < len(entries):
+			entry = entries[len(self.__colors)]
+			if entry is None:
+				self.__colors.append(0)
+			else:
+				self.__colors.append(tileColor(entry[0], entry[1], entry[2],
+					ts))
+		return self.__colors
+
+	def composeChunk(self, key):
+		"""
+		@type key: (int, int)
+		@param key: chunk coordinates
+		@rtype: array.array
+		@return: the color of the topmost visible tile of each cell of the
+			chunk, row by row, or 0 where there is none
+		"""
+		controller = self.getController()
+		colors = self.__tileColors()
+		cs = tilemap.CHUNK_SIZE
+		pixels = array.array("I", [0]) * (cs * cs)
+		info = controller.getLayerInfo()
+		# Later layers are drawn on top of earlier ones
+		for z in reversed(range(len(info))):
+			if not info[z][1]:
+				continue
+			chunk = controller.getLayerChunk(z, key)
+			if chunk is None:
+				continue
+			for i, tileId in enumerate(chunk):
+				if tileId != 0 and pixels[i] == 0:
+					pixels[i] = colors[tileId]
+			if 0 not in pixels:
+				break
+		return pixels
+
+	def __drawChunk(self, key):
+		cs = tilemap.CHUNK_SIZE
+		left = key[0] * cs
+		top = key[1] * cs
+		w = min(cs, self.__width - left)
+		h = min(cs, self.__height - top)
+		if w <= 0 or h <= 0:
+			return
+		pixels = self.composeChunk(key)
+		for y in range(h):
+			start = (top + y) * self.__width + left
+			self.__pixels[start:start + w] = pixels[y * cs:y * cs + w]
+		self.__levels[0].mark_dirty_rectangle(left, top, w, h)
+
+		# Carry the change up through the pyramid
+		right = left + w
+		bottom = top + h
+		for below, level in zip(self.__levels, self.__levels[1:]):
+			left //= 2
+			top //= 2
+			right = (right + 1) // 2
+			bottom = (bottom + 1) // 2
+			context = cairo.Context(level)
+			context.rectangle(left, top, right - left, bottom - top)
+			context.clip()
+			context.scale(0.5, 0.5)
+			context.set_source_surface(below, 0, 0)
+			context.get_source().set_filter(cairo.FILTER_BILINEAR)
+			context.set_operator(cairo.OPERATOR_SOURCE)
+			context.paint()
+
+	def draw(self, context, width, height, filter = cairo.FILTER_GOOD):
+		"""
+		Draws the whole map scaled to a size
+		@type context: cairo.Context
+		@param context: the context to draw to
+		@type width: int
+		@param width: width to draw the map at, in pixels
+		@type height: int
+		@param height: height to draw the map at, in pixels
+		@type filter: int
+		@param filter: the cairo filter that the image is scaled with
+		"""
+		if self.__pixels is None or width <= 0 or height <= 0:
+			return
+		# The smallest level that is at least as large as the result
+		level = self.__levels[0]
+		for candidate in self.__levels:
+			if candidate.get_width() < width or candidate.get_height() < height:
+				break
+			level = candidate
+		context.save()
+		context.rectangle(0, 0, width, height)
+		context.clip()
+		context.scale(float(width) / level.get_width(),
+			float(height) / level.get_height())
+		context.set_source_surface(level, 0, 0)
+		context.get_source().set_filter(filter)
+		context.paint()
+		context.restore()
+
+	def getThumbnail(self, largest):
+		"""
+		@type largest: int
+		@param largest: the largest of the dimentions of the returned image
+		@rtype: cairo.ImageSurface
+		@return: a picture of the whole map
+		"""
+		self.update()
+		s = float(largest) / max(self.__width, self.__height, 1)
+		width = max(int(self.__width * s), 1)
+		height = max(int(self.__height * s), 1)
+		result = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+		self.draw(cairo.Context(result), width, height)
+		return result
+
+	############################################################################
+	# MapListener code
+	############################################################################
+
+	def listenFileOpened(self):
+		self.__create()
+
+	def listenFileClosed(self):
+		scheduler.getScheduler().cancel(self.__task)
+		self.__task = None
+		self.__pixels = None
+		self.__levels = []
+		self.__colors = []
+		self.__dirty = set()
+		for callback in self.__callbacks:
+			callback()
+
+	def listenResize(self, width, height, xoffset, yoffset):
+		self.__create()
+
+	def listenAddTile(self, source, x, y, z):
+		self.__mark(x, y)
+
+	def listenRemoveTile(self, x, y, z):
+		self.__mark(x, y)
+
+	def listenFillTiles(self, z, runs):
+		cs = tilemap.CHUNK_SIZE
+		for i in range(0, len(runs), 3):
+			cy = runs[i] // cs
+			for cx in range(runs[i + 1] // cs, runs[i + 2] // cs + 1):
+				self.__dirty.add((cx, cy))
+		self.__schedule()
+
+	def listenAddTileSet(self, fileName):
+		# Tiles that could not be drawn before may have an image now
+		self.__colors = []
+		self.__markAll()
+
+	def listenSetVisibilty(self, index, visible):
+		self.__markAll()
+
+	def listenAddLayer(self, layerName):
+		self.__markAll()
+
+	def listenRemoveLayer(self, index):
+		self.__markAll()
+
+	def listenSwapLayers(self, index1, index2):
+		self.__markAll()
+
+	############################################################################
+	# End MapListener code
+	############################################################################
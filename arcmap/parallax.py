@@ -24,14 +24,26 @@ Contains custom widget for previewing parallax backgrounds.
 """
 
 import gtk
+import gobject
 import cairo
 
 import graphics
 import tilemap
 
+# Milliseconds between redraws while the preview offsets are changing
+FRAME_INTERVAL = 16
+
+# Tiled images smaller than this are repeated onto a larger surface before
+# they are used as a pattern, so that filling the preview needs fewer repeats
+PRETILE_SIZE = 256
+
 class ParallaxViewer(gtk.DrawingArea):
 	"""
-	Widget for drawing parallax backgrounds to the screen
+	Widget for drawing parallax backgrounds to the screen. Each layer is kept
+	as a pattern that repeats in the directions the layer tiles in. The layers
+	are composited when the widget is exposed, with the scroll offsets applied
+	through the pattern matrices, so moving the preview doesn't draw anything
+	in advance.
 	"""
 
 	__gsignals__ = {"expose-event": "override"}
@@ -48,6 +60,8 @@ class ParallaxViewer(gtk.DrawingArea):
 		gtk.DrawingArea.__init__(self)
 		# List of cairo.ImageSurface
 		self.__layers = []
+		# List of cairo.SurfacePattern, one for each layer
+		self.__patterns = []
 		# List of tilemap.Parallax
 		self.__backgrounds = []
 		# X-offset for preview
@@ -60,15 +74,13 @@ class ParallaxViewer(gtk.DrawingArea):
 		self.__height = height
 		# Scaling applied to preview
 		self.__scaleFactor = scale
-		# Buffer to draw on
-		self.__drawBuffer = cairo.ImageSurface(cairo.FORMAT_ARGB32, width,
-			height)
 		# Background color
 		self.__backColor = graphics.RGBA(0.0, 0.0, 0.0, 1.0)
+		# Source id of the pending redraw, or None
+		self.__redrawSource = None
 
 		self.set_size_request(int(self.__width * self.__scaleFactor),
 			int(self.__height * self.__scaleFactor))
-		self.__redrawBuffer()
 
 	def do_expose_event(self, event):
 		windowContext = self.window.cairo_create()
@@ -76,18 +88,117 @@ class ParallaxViewer(gtk.DrawingArea):
 			event.area.height)
 		windowContext.clip()
 		windowContext.scale(self.__scaleFactor, self.__scaleFactor)
-		windowContext.set_source_surface(self.__drawBuffer)
+		windowContext.rectangle(0, 0, self.__width, self.__height)
+		windowContext.clip()
+		self.__backColor.contextColor(windowContext)
 		windowContext.paint()
 
+		for index, pattern in enumerate(self.__patterns):
+			back = self.__backgrounds[index]
+			if back.visible == False or pattern is None:
+				continue
+			layerSurface = self.__layers[index]
+			x = self.__origin(self.__x, back.hScroll, back.hScrollSpeed)
+			y = self.__origin(-self.__y, back.vScroll, back.vScrollSpeed)
+			pattern.set_matrix(cairo.Matrix(x0=-x, y0=-y))
+			windowContext.set_source(pattern)
+			if back.hTile:
+				left = 0
+				width = self.__width
+			else:
+				left = x
+				width = layerSurface.get_width()
+			if back.vTile:
+				top = 0
+				height = self.__height
+			else:
+				top = y
+				height = layerSurface.get_height()
+			windowContext.rectangle(left, top, width, height)
+			windowContext.fill()
+
+	def __origin(self, coord, scroll, scrollSpeed):
+		"""
+		@rtype: int
+		@return: position of the top left corner of a layer in the preview
+		"""
+		if scroll == True:
+			return -int(coord * scrollSpeed)
+		else:
+			return 0
+
+	def __createPattern(self, layerSurface, back):
+		"""
+		@type layerSurface: cairo.ImageSurface
+		@param layerSurface: the image of a layer
+		@type back: tilemap.Parallax
+		@param back: the layer
+		@rtype: cairo.SurfacePattern
+		@return: the pattern to draw the layer with
+		"""
+		if layerSurface is None:
+			return None
+		width = layerSurface.get_width()
+		height = layerSurface.get_height()
+		if back.hTile or back.vTile:
+			xTimes = 1
+			yTimes = 1
+			if back.hTile and width < PRETILE_SIZE:
+				xTimes = (PRETILE_SIZE + width - 1) // width
+			if back.vTile and height < PRETILE_SIZE:
+				yTimes = (PRETILE_SIZE + height - 1) // height
+			if xTimes > 1 or yTimes > 1:
+				tiled = cairo.ImageSurface(cairo.FORMAT_ARGB32, width * xTimes,
+					height * yTimes)
+				context = cairo.Context(tiled)
+				pattern = cairo.SurfacePattern(layerSurface)
+				pattern.set_extend(cairo.EXTEND_REPEAT)
+				context.set_source(pattern)
+				context.paint()
+				layerSurface = tiled
+			pattern = cairo.SurfacePattern(layerSurface)
+			pattern.set_extend(cairo.EXTEND_REPEAT)
+		else:
+			pattern = cairo.SurfacePattern(layerSurface)
+		return pattern
+
+	def __scheduleRedraw(self):
+		"""
+		Redraws the preview at most once per frame no matter how often the
+		offsets change
+		"""
+		if self.__redrawSource is None:
+			self.__redrawSource = gobject.timeout_add(FRAME_INTERVAL,
+				self.__redraw)
+
+	def __redraw(self):
+		self.__redrawSource = None
+		self.queue_draw()
+		return False
+
 	def addBackground(self, parallax):
 		"""
 		Adds a background to the preview
 		@type parallax: tilemap.Parallax
 		@param parallax: the background to add
 		"""
-		self.__layers.append(graphics.loadImage(parallax.fileName))
+		layerSurface = graphics.loadImage(parallax.fileName)
+		self.__layers.append(layerSurface)
+		self.__patterns.append(self.__createPattern(layerSurface, parallax))
 		self.__backgrounds.append(parallax)
-		self.__redrawBuffer()
+		self.queue_draw()
+
+	def updateBackground(self, index):
+		"""
+		Reloads the image and recreates the pattern for a layer after its
+		settings were changed
+		@type index: int
+		@param index: index of the layer
+		"""
+		self.__layers[index] = graphics.loadImage(
+			self.__backgrounds[index].fileName)
+		self.__patterns[index] = self.__createPattern(self.__layers[index],
+			self.__backgrounds[index])
 		self.queue_draw()
 
 	def setX(self, x):
@@ -96,8 +207,7 @@ class ParallaxViewer(gtk.DrawingArea):
 		@param x: the new x-coordinate for the preview
 		"""
 		self.__x = x
-		self.__redrawBuffer()
-		self.queue_draw()
+		self.__scheduleRedraw()
 
 	def setY(self, y):
 		"""
@@ -105,8 +215,7 @@ class ParallaxViewer(gtk.DrawingArea):
 		@param y: the y-coordinate for the preview
 		"""
 		self.__y = y
-		self.__redrawBuffer()
-		self.queue_draw()
+		self.__scheduleRedraw()
 
 	def setColor(self, color):
 		"""
@@ -115,7 +224,6 @@ class ParallaxViewer(gtk.DrawingArea):
 		    layers
 		"""
 		self.__backColor = color
-		self.__redrawBuffer()
 		self.queue_draw()
 
 	def setWidth(self, width):
@@ -150,7 +258,6 @@ class ParallaxViewer(gtk.DrawingArea):
 		@param vis: True to set the layer visible, False to set invisible
 		"""
 		self.__backgrounds[index].visible = vis
-		self.__redrawBuffer()
 		self.queue_draw()
 
 	def swapLayers(self, index1, index2):
@@ -169,7 +276,10 @@ class ParallaxViewer(gtk.DrawingArea):
 		self.__layers[index1] = self.__layers[index2]
 		self.__layers[index2] = tl
 
-		self.__redrawBuffer()
+		tp = self.__patterns[index1]
+		self.__patterns[index1] = self.__patterns[index2]
+		self.__patterns[index2] = tp
+
 		self.queue_draw()
 
 	def deleteLayer(self, index):
@@ -179,7 +289,7 @@ class ParallaxViewer(gtk.DrawingArea):
 		"""
 		del self.__backgrounds[index]
 		del self.__layers[index]
-		self.__redrawBuffer()
+		del self.__patterns[index]
 		self.queue_draw()
 
 	def __sizeChanged(self):
@@ -188,62 +298,4 @@ class ParallaxViewer(gtk.DrawingArea):
 		"""
 		self.set_size_request(int(self.__width * self.__scaleFactor),
 			int(self.__height * self.__scaleFactor))
-		self.__drawBuffer = cairo.ImageSurface(cairo.FORMAT_ARGB32,
-			self.__width, self.__height)
-		self.__redrawBuffer()
 		self.queue_draw()
-
-	def __redrawBuffer(self):
-		"""
-		Redraws the window
-		"""
-		context = cairo.Context(self.__drawBuffer)
-		self.__backColor.contextColor(context)
-		context.paint()
-		for index, layerSurface in enumerate(self.__layers):
-			back = self.__backgrounds[index]
-			if back.visible == False:
-				continue
-
-			def calcBaseTimes(coord, scroll, scrollSpeed, tile, dimention,
-				viewDimention):
-				if scroll == True:
-					coord = int(coord * scrollSpeed)
-				else:
-					coord = 0
-				if tile == True:
-					if coord > 0:
-						coord = -(coord % dimention)
-					else:
-						coord = -coord % dimention
-					times = (viewDimention // dimention) + 2
-				else:
-					times = 1
-				return coord, times
-
-			x, xTimes = calcBaseTimes(self.__x, back.hScroll, back.hScrollSpeed,
-				back.hTile, layerSurface.get_width(), self.__width)
-			y, yTimes = calcBaseTimes(-self.__y, back.vScroll,
-				back.vScrollSpeed, back.vTile, layerSurface.get_height(),
-				self.__height)
-
-			for i in range(xTimes):
-				if x <= 0:
-					dstX = x + (layerSurface.get_width() * i)
-				else:
-					if self.__width > layerSurface.get_width():
-						dstX = x + (layerSurface.get_width() * -(i - 1))
-					else:
-						dstX = x + (layerSurface.get_width() * -i)
-				for j in range(yTimes):
-					if y <= 0:
-						dstY = y + (layerSurface.get_height() * j)
-					else:
-						if self.__height > layerSurface.get_height():
-							dstY = y + (layerSurface.get_height() * -(j - 1))
-						else:
-							dstY = y + (layerSurface.get_height() * -j)
-					context.set_source_surface(layerSurface, dstX, dstY)
-					context.rectangle(dstX, dstY, layerSurface.get_width(),
-						layerSurface.get_height())
-					context.fill()
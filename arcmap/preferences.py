@@ -53,6 +53,8 @@ visual = {
 	"invalid_fill" : 0xff000080,
 	"stipple_length" : 4,
 	"stipple_gap" : 2,
+	# Opacity of the layers other than the selected one when they are dimmed
+	"dim_opacity" : 0.3,
 }
 
 # Default values for physics. (static geometry)
@@ -65,7 +67,21 @@ files = {
 	"tileset_prefix" : os.path.join("images", "tiles"),
 	"parallax_prefix" : os.path.join("images", "parallax"),
 	"data_prefix" : "",
-	"use_prefixes" : False
+	"use_prefixes" : False,
+	# One of levelio.CODECS
+	"compression" : "none",
+	# From 1 (fastest) to 9 (smallest files)
+	"compression_level" : 6,
+}
+
+performance = {
+	# Number of chunks of a binary level that are kept in memory before the
+	# least recently used ones are dropped. Modified chunks are always kept
+	# until the level is saved.
+	"resident_chunks" : 4096,
+	# Number of threads that render the map. 0 starts one for each
+	# processor, and -1 renders on the main thread.
+	"render_threads" : 0,
 }
 
 def save():
@@ -83,6 +99,7 @@ def save():
 	config.set("Visual", "invalid_outline",
 		"0x%08x" % visual["invalid_outline"])
 	config.set("Visual", "invalid_fill", "0x%08x" % visual["invalid_fill"])
+	config.set("Visual", "dim_opacity", str(visual["dim_opacity"]))
 
 	config.add_section("Physics")
 	config.set("Physics", "default_restitution",
@@ -95,6 +112,14 @@ def save():
 	config.set("Files", "parallax_prefix", str(files["parallax_prefix"]))
 	config.set("Files", "data_prefix", str(files["data_prefix"]))
 	config.set("Files", "use_prefixes", str(files["use_prefixes"]))
+	config.set("Files", "compression", str(files["compression"]))
+	config.set("Files", "compression_level", str(files["compression_level"]))
+
+	config.add_section("Performance")
+	config.set("Performance", "resident_chunks",
+		str(performance["resident_chunks"]))
+	config.set("Performance", "render_threads",
+		str(performance["render_threads"]))
 
 	if os.path.exists(datafiles.userConfigPath()) == False:
 		try:
@@ -119,7 +144,7 @@ def load():
 		def getIntOption(section, sectionName, name):
 			try:
 				section[name] = config.getint(sectionName, name)
-			except ConfigParser.NoOptionError:
+			except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
 				pass
 			except ValueError:
 				pass
@@ -127,13 +152,13 @@ def load():
 		def getFloatOption(section, sectionName, name):
 			try:
 				section[name] = config.getfloat(sectionName, name)
-			except ConfigParser.NoOptionError:
+			except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
 				pass
 
 		def getHexOption(section, sectionName, name):
 			try:
 				section[name] = config.get(sectionName, name)
-			except ConfigParser.NoOptionError:
+			except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
 				pass
 			try:
 				section[name] = int(section[name], 16)
@@ -143,7 +168,7 @@ def load():
 		def getBoolOption(section, sectionName, name):
 			try:
 				section[name] = config.getboolean(sectionName, name)
-			except ConfigParser.NoOptionError:
+			except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
 				pass
 			except ValueError:
 				pass
@@ -151,7 +176,7 @@ def load():
 		def getStringOption(section, sectionName, name):
 			try:
 				section[name] = config.get(sectionName, name)
-			except ConfigParser.NoOptionError:
+			except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
 				pass
 
 		getIntOption(visual, "Visual", "handle_size")
@@ -161,6 +186,7 @@ def load():
 		getHexOption(visual, "Visual", "valid_outline")
 		getHexOption(visual, "Visual", "invalid_fill")
 		getHexOption(visual, "Visual", "invalid_outline")
+		getFloatOption(visual, "Visual", "dim_opacity")
 
 		getFloatOption(physics, "Physics", "default_friction")
 		getFloatOption(physics, "Physics", "default_restitution")
@@ -169,6 +195,11 @@ def load():
 		getStringOption(files, "Files", "parallax_prefix")
 		getStringOption(files, "Files", "data_prefix")
 		getBoolOption(files, "Files", "use_prefixes")
+		getStringOption(files, "Files", "compression")
+		getIntOption(files, "Files", "compression_level")
+
+		getIntOption(performance, "Performance", "resident_chunks")
+		getIntOption(performance, "Performance", "render_threads")
 
 	else:
 		log.info("Could not open user configuration file. Using defaults")
@@ -0,0 +1,270 @@
+################################################################################
+# Authors: Brian Schott (Sir Alaran)
+# Copyright: Brian Schott (Sir Alaran)
+# Date: Oct 20 2009
+# License:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+"""
+Records how long the editor spends in tool handlers, listener callbacks,
+redraws and level loading and saving.
+
+Profiling is off unless enable() is called before the editor is created. When
+it is off, nothing is wrapped and the only cost is checking the enabled flag.
+"""
+
+__docformat__ = "epytext"
+
+import collections
+import functools
+import json
+import logging
+import time
+
+log = logging.getLogger("profiler")
+
+# Number of recent calls of each handler that the 95th percentile is taken from
+SAMPLES = 512
+
+# Number of recent frames kept for the frame time histogram
+FRAMES = 256
+
+# Upper bounds of the frame time histogram buckets, in seconds. The last
+# bucket holds every frame slower than the last bound.
+FRAME_BUCKETS = [0.004, 0.008, 0.0167, 0.0333, 0.05, 0.1, 0.25]
+
+enabled = False
+
+
+class _Record(object):
+	""" Timing of a single handler """
+	__slots__ = ["count", "total", "samples"]
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.samples = collections.deque(maxlen=SAMPLES)
+
+	def add(self, seconds):
+		self.count += 1
+		self.total += seconds
+		self.samples.append(seconds)
+
+
+_records = {}
+_frames = collections.deque(maxlen=FRAMES)
+
+
+def enable():
+	"""
+	Turns profiling on. Only handlers that are instrumented after this call
+	are measured.
+	"""
+	global enabled
+	enabled = True
+	log.info("Profiling enabled")
+
+
+def reset():
+	""" Forgets everything that has been recorded """
+	_records.clear()
+	_frames.clear()
+
+
+def record(category, name, seconds):
+	"""
+	@type category: str
+	@param category: the kind of handler, such as "tool" or "listener"
+	@type name: str
+	@param name: the name of the handler
+	@type seconds: float
+	@param seconds: the time taken by one call of the handler
+	"""
+	r = _records.get((category, name))
+	if r is None:
+		r = _Record()
+		_records[(category, name)] = r
+	r.add(seconds)
+
+
+def recordFrame(seconds):
+	"""
+	@type seconds: float
+	@param seconds: the time taken to draw one frame
+	"""
+	_frames.append(seconds)
+
+
+def percentile(values, fraction):
+	"""
+	@type values: [float]
+	@param values: the values to look at
+	@type fraction: float
+	@param fraction: between 0 and 1
+	@rtype: float
+	@return: the smallest value that is at least as large as the given
+		fraction of the values, or 0 if there are no values
+	"""
+	if len(values) == 0:
+		return 0.0
+	ordered = sorted(values)
+	index = int(fraction * len(ordered) + 0.5) - 1
+	return ordered[min(max(index, 0), len(ordered) - 1)]
+
+
+def timed(category, name = None):
+	"""
+	Decorator that records the calls of a function while profiling is
+	enabled
+	@type category: str
+	@param category: the kind of function
+	@type name: str
+	@param name: the name to record the calls under. Defaults to the name of
+		the function.
+	"""
+	def decorate(function):
+		label = name or function.__name__
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			if not enabled:
+				return function(*args, **kwargs)
+			start = time.time()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				record(category, label, time.time() - start)
+		return wrapper
+	return decorate
+
+
+def instrument(obj, methodNames, category):
+	"""
+	Replaces the methods of an object with versions that record their calls.
+	Does nothing unless profiling is enabled.
+	@type obj: object
+	@param obj: the object to instrument
+	@type methodNames: [str]
+	@param methodNames: names of the methods to measure
+	@type category: str
+	@param category: the kind of handler the methods are
+	"""
+	if not enabled:
+		return
+	for methodName in methodNames:
+		method = getattr(obj, methodName, None)
+		if method is None:
+			continue
+		label = "%s.%s" % (obj.__class__.__name__, methodName)
+		setattr(obj, methodName, _wrap(method, category, label))
+
+
+def _wrap(method, category, label):
+	def wrapper(*args, **kwargs):
+		start = time.time()
+		try:
+			return method(*args, **kwargs)
+		finally:
+			record(category, label, time.time() - start)
+	return wrapper
+
+
+def getStatistics():
+	"""
+	@rtype: [(str, str, int, float, float)]
+	@return: category, name, number of calls, seconds spent in total and the
+		95th percentile of the recent calls in seconds for each handler, the
+		one that took the most time first
+	"""
+	result = [(category, name, r.count, r.total, percentile(r.samples, 0.95))
+		for (category, name), r in _records.iteritems()]
+	result.sort(key=lambda s: s[3], reverse=True)
+	return result
+
+
+def getFrameHistogram():
+	"""
+	@rtype: [(float, int)]
+	@return: the upper bound in seconds and the number of recent frames for
+		each bucket. The bound of the last bucket is None.
+	"""
+	counts = [0] * (len(FRAME_BUCKETS) + 1)
+	for seconds in _frames:
+		for i, bound in enumerate(FRAME_BUCKETS):
+			if seconds <= bound:
+				counts[i] += 1
+				break
+		else:
+			counts[-1] += 1
+	return zip(FRAME_BUCKETS + [None], counts)
+
+
+def getFrameStatistics():
+	"""
+	@rtype: (int, float, float)
+	@return: the number of recent frames, their mean and their 95th
+		percentile in seconds
+	"""
+	if len(_frames) == 0:
+		return 0, 0.0, 0.0
+	return len(_frames), sum(_frames) / len(_frames), \
+		percentile(_frames, 0.95)
+
+
+def toDict():
+	"""
+	@rtype: dict
+	@return: everything that has been recorded, in a form that can be saved
+		as JSON. Times are in milliseconds.
+	"""
+	handlers = []
+	for category, name, count, total, p95 in getStatistics():
+		handlers.append({
+			"category" : category,
+			"name" : name,
+			"calls" : count,
+			"total_ms" : total * 1000.0,
+			"mean_ms" : total * 1000.0 / count,
+			"p95_ms" : p95 * 1000.0,
+		})
+	count, mean, p95 = getFrameStatistics()
+	histogram = []
+	for bound, frames in getFrameHistogram():
+		histogram.append({
+			"up_to_ms" : None if bound is None else bound * 1000.0,
+			"frames" : frames,
+		})
+	return {
+		"handlers" : handlers,
+		"frames" : {
+			"count" : count,
+			"mean_ms" : mean * 1000.0,
+			"p95_ms" : p95 * 1000.0,
+			"histogram" : histogram,
+		},
+	}
+
+
+def dump(fileName):
+	"""
+	Saves everything that has been recorded to a JSON file
+	@type fileName: str
+	@param fileName: the path of the file to write
+	"""
+	f = open(fileName, "w")
+	try:
+		json.dump(toDict(), f, indent=1)
+	finally:
+		f.close()
@@ -0,0 +1,150 @@
+################################################################################
+# Authors: Brian Schott (Sir Alaran)
+# Copyright: Brian Schott (Sir Alaran)
+# Date: Oct 20 2009
+# License:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+"""
+Renders parts of the map on worker threads so that the editor stays
+responsive while large areas are drawn.
+
+pycairo lets go of the interpreter lock while cairo draws, so several workers
+can render at the same time on different cores. Workers never touch the map
+or any widget. They are given copies of everything that they read, draw to
+surfaces of their own, and hand the surfaces back to the main loop with
+gobject.idle_add. gobject.threads_init must have been called for that to be
+safe.
+"""
+
+__docformat__ = "epytext"
+
+import logging
+import Queue
+import threading
+
+import gobject
+
+import preferences
+
+log = logging.getLogger("rasterizer")
+
+
+def cpuCount():
+	"""
+	@rtype: int
+	@return: the number of processors, or 1 if it can not be found
+	"""
+	try:
+		import multiprocessing
+		return multiprocessing.cpu_count()
+	except (ImportError, NotImplementedError):
+		return 1
+
+
+class RasterPool(object):
+	"""
+	A number of worker threads that run jobs from a queue and pass each
+	result to a callback on the main loop
+	"""
+	def __init__(self, workers):
+		"""
+		@type workers: int
+		@param workers: number of worker threads to start
+		"""
+		self.__queue = Queue.Queue()
+		self.__workers = 0
+		self.__lock = threading.Lock()
+		self.setWorkers(workers)
+
+	def setWorkers(self, workers):
+		"""
+		Starts or stops worker threads so that there are a number of them.
+		Workers that are stopped finish the job that they are running first.
+		@type workers: int
+		@param workers: number of worker threads
+		"""
+		workers = max(workers, 1)
+		with self.__lock:
+			while self.__workers < workers:
+				thread = threading.Thread(target=self.__work,
+					name="rasterizer-%d" % self.__workers)
+				thread.daemon = True
+				thread.start()
+				self.__workers += 1
+			while self.__workers > workers:
+				# Each None makes one worker exit
+				self.__queue.put(None)
+				self.__workers -= 1
+
+	def getWorkers(self):
+		"""
+		@rtype: int
+		@return: the number of worker threads
+		"""
+		return self.__workers
+
+	def submit(self, job, callback):
+		"""
+		Queues a job
+		@type job: callable
+		@param job: called without arguments on a worker thread
+		@type callback: callable
+		@param callback: called on the main loop with the return value of the
+			job, or with None if the job raised an exception
+		"""
+		self.__queue.put((job, callback))
+
+	def __work(self):
+		while True:
+			item = self.__queue.get()
+			if item is None:
+				return
+			job, callback = item
+			try:
+				result = job()
+			except Exception:
+				log.exception("Rendering job failed")
+				result = None
+			gobject.idle_add(self.__deliver, callback, result)
+
+	def __deliver(self, callback, result):
+		callback(result)
+		return False
+
+
+# The pool shared by every map view, created when it is first needed
+_pool = None
+
+
+def getPool():
+	"""
+	@rtype: RasterPool
+	@return: the worker pool, with as many workers as
+		preferences.performance["render_threads"] asks for, or None if
+		rendering should happen on the main thread
+	"""
+	global _pool
+	threads = preferences.performance["render_threads"]
+	if threads < 0:
+		return None
+	if threads == 0:
+		threads = cpuCount()
+	if _pool is None:
+		_pool = RasterPool(threads)
+	elif _pool.getWorkers() != threads:
+		_pool.setWorkers(threads)
+	return _pool
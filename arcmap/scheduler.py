@@ -0,0 +1,230 @@
+################################################################################
+# Authors: Brian Schott (Sir Alaran)
+# Copyright: Brian Schott (Sir Alaran)
+# Date: Oct 20 2009
+# License:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+"""
+Runs background work in the gaps between user input.
+
+Work is broken into steps. A task is a function that does one step and
+returns True if it has more to do, the same as a function given to
+gobject.idle_add. Whenever the main loop is idle, the scheduler runs steps
+of the most urgent tasks until a time budget is used up and then gives
+control back, so that input is never held up for longer than one step.
+"""
+
+__docformat__ = "epytext"
+
+import logging
+import time
+
+import gobject
+
+import profiler
+
+log = logging.getLogger("scheduler")
+
+# Task priorities. Lower numbers run first.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Seconds that one idle slice may spend running steps
+SLICE_BUDGET = 0.008
+
+# A task that has been passed over for this many slices runs before anything
+# else in the next one, whatever its priority
+STARVATION_SLICES = 50
+
+
+class Task(object):
+	"""
+	Work that has been given to the scheduler
+	"""
+	def __init__(self, function, priority, name):
+		self.function = function
+		self.priority = priority
+		self.name = name
+		# Number of slices in a row that the task has been passed over in
+		self.waited = 0
+		self.active = True
+		# Source id of the timeout that adds the task after a delay, or None
+		self.timeout = None
+		# Order the task was added in, so that tasks with the same priority
+		# run first come, first served
+		self.sequence = 0
+
+	def cancel(self):
+		"""
+		Stops the task. A step that is running finishes first.
+		"""
+		self.active = False
+		if self.timeout is not None:
+			gobject.source_remove(self.timeout)
+			self.timeout = None
+
+	def isActive(self):
+		"""
+		@rtype: bool
+		@return: True if the task has not finished or been cancelled
+		"""
+		return self.active
+
+
+class Scheduler(object):
+	"""
+	Runs the steps of tasks on the main loop when it is idle
+	"""
+	def __init__(self, budget = SLICE_BUDGET):
+		"""
+		@type budget: float
+		@param budget: seconds that one idle slice may spend running steps
+		"""
+		self.__budget = budget
+		self.__tasks = []
+		self.__sequence = 0
+		# Whether an idle handler has been added and not yet run
+		self.__scheduled = False
+
+	def add(self, function, priority = PRIORITY_NORMAL, name = None,
+			delay = None):
+		"""
+		@type function: callable
+		@param function: does one step of the work and returns True if there
+			is more to do
+		@type priority: int
+		@param priority: PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW
+		@type name: str
+		@param name: name of the task in logs and profiles
+		@type delay: float
+		@param delay: seconds to wait before the first step, or None
+		@rtype: Task
+		@return: the task, which can be used to cancel it
+		"""
+		if name is None:
+			name = getattr(function, "__name__", "task")
+		task = Task(function, priority, name)
+		if delay is None:
+			self.__start(task)
+		else:
+			task.timeout = gobject.timeout_add(int(delay * 1000),
+				self.__delayed, task)
+		return task
+
+	def __delayed(self, task):
+		task.timeout = None
+		if task.active:
+			self.__start(task)
+		return False
+
+	def __start(self, task):
+		self.__sequence += 1
+		task.sequence = self.__sequence
+		self.__tasks.append(task)
+		if not self.__scheduled:
+			self.__scheduled = True
+			gobject.idle_add(self.__idle, priority=gobject.PRIORITY_LOW)
+
+	def cancel(self, task):
+		"""
+		@type task: Task
+		@param task: the task to stop, or None
+		"""
+		if task is not None:
+			task.cancel()
+
+	def getPending(self):
+		"""
+		@rtype: [Task]
+		@return: the tasks that are waiting to run, most urgent first. Tasks
+			that are waiting for their delay are not included.
+		"""
+		self.__tasks = [task for task in self.__tasks if task.active]
+		return sorted(self.__tasks, key=self.__urgency)
+
+	def __urgency(self, task):
+		starved = 0 if task.waited >= STARVATION_SLICES else 1
+		return (starved, task.priority, task.sequence)
+
+	def runSlice(self, budget = None):
+		"""
+		Runs steps of the most urgent tasks until the budget is used up. At
+		least one step is always run.
+		@type budget: float
+		@param budget: seconds to spend, or None for the scheduler's budget
+		@rtype: bool
+		@return: True if there are tasks left
+		"""
+		if budget is None:
+			budget = self.__budget
+		start = time.time()
+		ran = set()
+		for task in self.getPending():
+			if ran and time.time() - start >= budget:
+				break
+			ran.add(task)
+			# Steps of one task run until it is done or the budget is gone
+			while task.active:
+				self.__step(task)
+				if time.time() - start >= budget:
+					break
+		for task in self.__tasks:
+			if task in ran:
+				task.waited = 0
+			else:
+				task.waited += 1
+		self.__tasks = [task for task in self.__tasks if task.active]
+		return len(self.__tasks) > 0
+
+	def __step(self, task):
+		stepStart = time.time()
+		try:
+			more = task.function()
+		except Exception:
+			log.exception("Task %s failed" % task.name)
+			more = False
+		if profiler.enabled:
+			profiler.record("task", task.name, time.time() - stepStart)
+		if not more:
+			task.active = False
+
+	def flush(self):
+		"""
+		Runs every task that is waiting until it is done. Tasks that are
+		waiting for their delay are not run.
+		"""
+		while self.runSlice(float("inf")):
+			pass
+
+	def __idle(self):
+		if self.runSlice():
+			return True
+		self.__scheduled = False
+		return False
+
+
+# The scheduler that the editor uses
+_scheduler = Scheduler()
+
+
+def getScheduler():
+	"""
+	@rtype: Scheduler
+	@return: the scheduler that the editor uses
+	"""
+	return _scheduler
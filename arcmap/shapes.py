@@ -25,8 +25,16 @@ Contains various geometry related classes and functions
 
 
 import math
+import array
+import logging
+import operator
+import random
+import time
+
 import preferences
 
+log = logging.getLogger("shapes")
+
 class Point:
 	"""
 	This may just end up being replaced by a tuple
@@ -43,6 +51,15 @@ class Point:
 		self.y = y
 
 
+def _number(value):
+	"""
+	@return: value as an int if it is a whole number
+	"""
+	if value == int(value):
+		return int(value)
+	return value
+
+
 class Shape:
 	"""
 	Base class for shapes
@@ -110,6 +127,11 @@ class Shape:
 
 
 class Polygon(Shape):
+	"""
+	The vertices are kept in two arrays of coordinates. Values that are
+	derived from them are calculated when they are first needed and kept
+	until the vertices change.
+	"""
 
 	def __init__(self, points = None):
 		"""
@@ -117,80 +139,111 @@ class Polygon(Shape):
 		@param points: the points that make up the polygon
 		"""
 		Shape.__init__(self)
-		self.__points = points
-		self.__concave = False
+		self.__xs = array.array("d")
+		self.__ys = array.array("d")
 		if points is not None:
-			if len(self.__points) < 3:
+			for p in points:
+				self.__xs.append(p.x)
+				self.__ys.append(p.y)
+			if len(self.__xs) < 3:
 				log.warning("Polygon constructed with fewer than three points."+
 					" This will not end well.")
-			else:
-				self.__concave = self.__calcConcave()
-				self.calcCenter()
 		else:
-			self.__points = [Point(0, 0)]
+			self.__xs.append(0)
+			self.__ys.append(0)
+		self.__invalidate()
 
 		points = None
 
+	def __invalidate(self):
+		"""
+		Forgets everything that was derived from the vertices
+		"""
+		self.__normals = None
+		self.__box = None
+		self.__concave = None
+		self.__fan = None
+		self.setCenter(None)
+
 	def addPoint(self, p):
 		"""
 		Brief Description
 		@type p: Point
 		@param p: the point to add
 		"""
-		self.__points.append(p)
-		self.__concave = self.__calcConcave()
-		self.calcCenter()
+		self.__xs.append(p.x)
+		self.__ys.append(p.y)
+		self.__invalidate()
 
 	def getPoints(self):
 		"""
 		@rtype: Point[]
 		@return: A copy of the polygon's points
 		"""
-		return self.__points[:]
+		return [Point(_number(x), _number(y)) for x, y in zip(self.__xs,
+			self.__ys)]
+
+	def getCoordinates(self):
+		"""
+		@rtype: (array.array, array.array)
+		@return: copies of the x and y-coordinates of the polygon's points
+		"""
+		return array.array("d", self.__xs), array.array("d", self.__ys)
 
 	def getLastPoint(self):
-		if len(self.__points) > 2:
-			return self.__points[-2]
+		if len(self.__xs) > 2:
+			return Point(_number(self.__xs[-2]), _number(self.__ys[-2]))
 		else:
 			return None
 
 	def delExtraPoint(self):
-		del self.__points[-1]
+		del self.__xs[-1]
+		del self.__ys[-1]
+		self.__invalidate()
 
 	def forceCClockwise(self):
 		"""
 		Rearranges the points of the shape so that they are in counter-clockwise
 		order.
 		"""
-		# Python makes this too easy.
-		self.__points.sort(key=lambda p: math.atan2(p.x - self.getCenter().x,
-			p.y - self.getCenter().y), reverse=True)
+		c = self.getCenter()
+		order = sorted(range(len(self.__xs)), key=lambda i: math.atan2(
+			self.__xs[i] - c.x, self.__ys[i] - c.y), reverse=True)
+		self.__xs = array.array("d", [self.__xs[i] for i in order])
+		self.__ys = array.array("d", [self.__ys[i] for i in order])
+		self.__invalidate()
 
 	def calcCenter(self):
 		"""
 		Recalculates the center of the shape. This center is simply the average
 		of the x and y coordinates of all the points
 		"""
-		l = len(self.__points)
+		l = len(self.__xs)
 		if l == 0:
 			return
-		totalx = 0
-		totaly = 0
-		for p in self.__points:
-			totalx += p.x
-			totaly += p.y
-		center = Point(totalx / float(l), totaly / float(l))
-		self.setCenter(center)
+		self.setCenter(Point(sum(self.__xs) / float(l),
+			sum(self.__ys) / float(l)))
+
+	def getCenter(self):
+		if Shape.getCenter(self) is None:
+			self.calcCenter()
+		return Shape.getCenter(self)
+
+	def boundingBox(self):
+		if self.__box is None:
+			self.__box = (min(self.__xs), min(self.__ys), max(self.__xs),
+				max(self.__ys))
+		return self.__box
 
 	def convex(self):
 		"""
 		@rtype: bool
 		@return: True if the shape is convex
 		"""
-		if len(self.__points) <= 2:
+		if len(self.__xs) <= 2:
 			return False
 		else:
-			return not self.__concave
+			return not self.concave()
 
 	def concave(self):
 		"""
@@ -198,71 +251,168 @@ class Polygon(Shape):
 		@return: True if the shape is convex
 		"""
 		# Separated from the calculating function so that the query is fast
+		if self.__concave is None:
+			self.__concave = self.__calcConcave()
 		return self.__concave
 
 	def __calcConcave(self):
-		if len(self.__points) <= 2:
+		if len(self.__xs) <= 2:
 			# This shape isn't even valid
 			return True
-		elif len(self.__points) == 3:
+		elif len(self.__xs) == 3:
 			# Triangles are always convex
 			return False
-		# I think I adapted this from something I snatched from Wikipedia...
-		# Basically the cross products of the vectors will all point up or all
-		# point down if the turns made at each vertex are in the same direction
-		positiveFlag = negativeFlag = False
-		for i in range(len(self.__points)):
-			j = (i + 1) % len(self.__points)
-			k = (i + 2) % len(self.__points)
-			z  = ((self.__points[j].x - self.__points[i].x)
-				* (self.__points[k].y - self.__points[j].y))
-			z = z - ((self.__points[j].y - self.__points[i].y)
-				* (self.__points[k].x - self.__points[j].x))
-			if z < 0:
-				positiveFlag = True
-			elif z > 0:
-				negativeFlag = True
-			if positiveFlag and negativeFlag:
-				return True
-		return False
+		# The cross products of the edge vectors will all point up or all
+		# point down if the turns made at each vertex are in the same
+		# direction. The normals are the edge vectors turned to the right, so
+		# their cross products are the same.
+		nx, ny = self.__edgeNormals()
+		turns = [nx[i - 1] * ny[i] - ny[i - 1] * nx[i]
+			for i in range(len(nx))]
+		return min(turns) < 0 and max(turns) > 0
+
+	def __edgeNormals(self):
+		"""
+		@return: the x and y components of the right-hand normals of the
+			vectors that point from point n to point n+1
+		"""
+		if self.__normals is None:
+			xs = self.__xs
+			ys = self.__ys
+			# The last point goes back to the first
+			nextXs = xs[1:] + xs[:1]
+			nextYs = ys[1:] + ys[:1]
+			self.__normals = (
+				array.array("d", map(operator.sub, nextYs, ys)),
+				array.array("d", map(operator.sub, xs, nextXs)))
+		return self.__normals
 
 	def adjust(self, x, y, i = -1):
-		self.__points[i].x = x
-		self.__points[i].y = y
-		self.__concave = self.__calcConcave()
-		self.calcCenter()
+		self.__xs[i] = x
+		self.__ys[i] = y
+		self.__invalidate()
 		i = -1
 
+	def __usesFan(self):
+		"""
+		@return: True if the points can be found with a binary search over
+			the triangles that fan out from the first vertex. This works for
+			convex polygons with their vertices in the order that intersects
+			expects.
+		"""
+		if self.__fan is None:
+			self.__fan = self.convex() and signedArea(self.__xs, self.__ys) > 0
+		return self.__fan
+
+	def __inFan(self, px, py):
+		xs = self.__xs
+		ys = self.__ys
+		x0 = xs[0]
+		y0 = ys[0]
+		last = len(xs) - 1
+		if _cross(x0, y0, xs[1], ys[1], px, py) <= 0 \
+			or _cross(x0, y0, xs[last], ys[last], px, py) >= 0:
+			return False
+		low = 1
+		high = last
+		while high - low > 1:
+			middle = (low + high) // 2
+			if _cross(x0, y0, xs[middle], ys[middle], px, py) > 0:
+				low = middle
+			else:
+				high = middle
+		return _cross(xs[low], ys[low], xs[high], ys[high], px, py) > 0
+
 	def intersects(self, p):
-		# First create a list of vectors that are the right-hand normals of the
-		# vectors that point from point n to point n+1
-		rightVectors = []
-		for i in range(len(self.__points) - 1):
-			dx = self.__points[i + 1].x - self.__points[i].x
-			dy = self.__points[i + 1].y - self.__points[i].y
-			rightVectors.append(Point(dy, -dx))
-		# Last point back to the first
-		dx = self.__points[0].x - self.__points[-1].x
-		dy = self.__points[0].y - self.__points[-1].y
-		rightVectors.append(Point(dy, -dx))
-
-		for i, v in enumerate(rightVectors):
-			# Calculate the vector pointing from the vertex to the test point,
-			# then multiply the components by the right-hand normal.
-			x = (p.x - self.__points[i].x) * v.x
-			y = (p.y - self.__points[i].y) * v.y
-
-			# If the sum of the components is positive, the point is on the
-			# positive side of the normal vector, and thus outside the shape
-			if (x + y) >= 0:
+		x1, y1, x2, y2 = self.boundingBox()
+		if p.x <= x1 or p.x >= x2 or p.y <= y1 or p.y >= y2:
+			return False
+		if self.__usesFan():
+			return self.__inFan(p.x, p.y)
+		nx, ny = self.__edgeNormals()
+		xs = self.__xs
+		ys = self.__ys
+		for i in range(len(xs)):
+			# If the vector pointing from the vertex to the test point is on
+			# the positive side of the normal vector, the point is outside the
+			# shape
+			if (p.x - xs[i]) * nx[i] + (p.y - ys[i]) * ny[i] >= 0:
 				return False
 		return True
 
+	def intersectsPoints(self, points):
+		"""
+		Tests many points at once. Convex shapes find each point with a
+		binary search. Otherwise each edge is tested against all of the points
+		that are still inside the shape.
+		@type points: Point[]
+		@param points: the points to test
+		@rtype: bool[]
+		@return: a list with True for each point that intersects the shape,
+			and False for the others
+		"""
+		x1, y1, x2, y2 = self.boundingBox()
+		inside = [i for i, p in enumerate(points)
+			if x1 < p.x < x2 and y1 < p.y < y2]
+		if self.__usesFan():
+			result = [False] * len(points)
+			inFan = self.__inFan
+			for i in inside:
+				result[i] = inFan(points[i].x, points[i].y)
+			return result
+		pxs = [points[i].x for i in inside]
+		pys = [points[i].y for i in inside]
+		nx, ny = self.__edgeNormals()
+		for i in range(len(self.__xs)):
+			if not inside:
+				break
+			vx = self.__xs[i]
+			vy = self.__ys[i]
+			a = nx[i]
+			b = ny[i]
+			# The points are inside this edge where this is below zero
+			limit = vx * a + vy * b
+			keep = [j for j in range(len(inside))
+				if pxs[j] * a + pys[j] * b < limit]
+			inside = [inside[j] for j in keep]
+			pxs = [pxs[j] for j in keep]
+			pys = [pys[j] for j in keep]
+		result = [False] * len(points)
+		for i in inside:
+			result[i] = True
+		return result
+
+	def decompose(self):
+		"""
+		Splits the polygon into convex pieces. See decompose.
+		@rtype: Polygon[]
+		@return: convex polygons with the same physical properties as this one
+			that together cover the same area, or None if the outline crosses
+			itself
+		"""
+		pieces = decompose(self.getPoints())
+		if pieces is None:
+			return None
+		polygons = []
+		for piece in pieces:
+			polygon = Polygon(piece)
+			polygon.friction = self.friction
+			polygon.restitution = self.restitution
+			polygon.damage = self.damage
+			polygons.append(polygon)
+		return polygons
+
 	def shift(self, xoffset, yoffset):
-		for p in self.__points:
-			p.x = p.x + xoffset
-			p.y = p.y + yoffset
-		self.calcCenter()
+		self.__xs = array.array("d", [x + xoffset for x in self.__xs])
+		self.__ys = array.array("d", [y + yoffset for y in self.__ys])
+		# Moving the shape doesn't change the direction of its edges
+		if self.__box is not None:
+			x1, y1, x2, y2 = self.__box
+			self.__box = (x1 + xoffset, y1 + yoffset, x2 + xoffset,
+				y2 + yoffset)
+		c = Shape.getCenter(self)
+		if c is not None:
+			self.setCenter(Point(c.x + xoffset, c.y + yoffset))
 
 	def getHandles(self):
 		return self.getPoints()
@@ -289,8 +439,8 @@ class Circle(Shape):
 
 	def boundingBox(self):
 		c = self.getCenter()
-		return (c.x - self.__radius, c.x + self.__radius, self.__radius * 2,
-			self.__radius * 2)
+		return (c.x - self.__radius, c.y - self.__radius, c.x + self.__radius,
+			c.y + self.__radius)
 
 	def getRadius(self):
 		"""
@@ -362,6 +512,405 @@ def isInsideRectangle(shape, x, y, w, h):
 	return True
 
 
+def _cross(ax, ay, bx, by, cx, cy):
+	"""
+	@return: the cross product of the vectors from a to b and from b to c.
+		It is positive if the path turns clockwise on the screen at b.
+	"""
+	return (bx - ax) * (cy - by) - (by - ay) * (cx - bx)
+
+
+def signedArea(xs, ys):
+	"""
+	@type xs: [number]
+	@param xs: x-coordinates of the vertices of a polygon
+	@type ys: [number]
+	@param ys: y-coordinates of the vertices of a polygon
+	@rtype: float
+	@return: the area of the polygon. It is positive if the vertices are in
+		clockwise order on the screen, which is the order that
+		Polygon.intersects expects.
+	"""
+	total = 0
+	for i in range(len(xs)):
+		total += xs[i - 1] * ys[i] - xs[i] * ys[i - 1]
+	return total / 2.0
+
+
+def _segmentsCross(ax, ay, bx, by, cx, cy, dx, dy):
+	"""
+	@return: True if the segment from a to b and the segment from c to d
+		have any point in common
+	"""
+	d1 = _cross(cx, cy, dx, dy, ax, ay)
+	d2 = _cross(cx, cy, dx, dy, bx, by)
+	d3 = _cross(ax, ay, bx, by, cx, cy)
+	d4 = _cross(ax, ay, bx, by, dx, dy)
+	if ((d1 > 0 and d2 < 0) or (d1 < 0 and d2 > 0)) \
+		and ((d3 > 0 and d4 < 0) or (d3 < 0 and d4 > 0)):
+		return True
+	def onSegment(px, py, qx, qy, rx, ry):
+		return min(px, qx) <= rx <= max(px, qx) \
+			and min(py, qy) <= ry <= max(py, qy)
+	return (d1 == 0 and onSegment(cx, cy, dx, dy, ax, ay)) \
+		or (d2 == 0 and onSegment(cx, cy, dx, dy, bx, by)) \
+		or (d3 == 0 and onSegment(ax, ay, bx, by, cx, cy)) \
+		or (d4 == 0 and onSegment(ax, ay, bx, by, dx, dy))
+
+
+class _Grid(object):
+	"""
+	Buckets of items by position, so that only the items near a rectangle
+	have to be looked at
+	"""
+	def __init__(self, xs, ys, count):
+		self.left = min(xs)
+		self.top = min(ys)
+		size = max(max(xs) - self.left, max(ys) - self.top, 1)
+		self.cellSize = size / max(math.sqrt(count) / 2.0, 1.0)
+		self.__cells = {}
+
+	def __range(self, x1, y1, x2, y2):
+		left = int((x1 - self.left) // self.cellSize)
+		top = int((y1 - self.top) // self.cellSize)
+		right = int((x2 - self.left) // self.cellSize)
+		bottom = int((y2 - self.top) // self.cellSize)
+		for cx in range(left, right + 1):
+			for cy in range(top, bottom + 1):
+				yield cx, cy
+
+	def add(self, item, x1, y1, x2, y2):
+		for key in self.__range(x1, y1, x2, y2):
+			self.__cells.setdefault(key, set()).add(item)
+
+	def remove(self, item, x1, y1, x2, y2):
+		for key in self.__range(x1, y1, x2, y2):
+			self.__cells[key].discard(item)
+
+	def find(self, x1, y1, x2, y2):
+		"""
+		@return: a set of the items that might touch the rectangle
+		"""
+		found = set()
+		for key in self.__range(x1, y1, x2, y2):
+			found.update(self.__cells.get(key, ()))
+		return found
+
+
+def _simplify(points):
+	"""
+	@return: lists of the x and y-coordinates of the points without repeated
+		points and without points that lie on the line between their
+		neighbours
+	"""
+	xs = []
+	ys = []
+	for p in points:
+		if xs and xs[-1] == p.x and ys[-1] == p.y:
+			continue
+		xs.append(p.x)
+		ys.append(p.y)
+	if len(xs) > 1 and xs[0] == xs[-1] and ys[0] == ys[-1]:
+		del xs[-1]
+		del ys[-1]
+	changed = True
+	while changed and len(xs) >= 3:
+		changed = False
+		i = 0
+		while i < len(xs) and len(xs) >= 3:
+			j = i - 1
+			k = (i + 1) % len(xs)
+			if _cross(xs[j], ys[j], xs[i], ys[i], xs[k], ys[k]) == 0:
+				del xs[i]
+				del ys[i]
+				changed = True
+			else:
+				i += 1
+	return xs, ys
+
+
+def isSimple(xs, ys):
+	"""
+	@type xs: [number]
+	@param xs: x-coordinates of the vertices of a polygon
+	@type ys: [number]
+	@param ys: y-coordinates of the vertices of a polygon
+	@rtype: bool
+	@return: True if no two edges of the polygon touch, other than the
+		neighbouring edges at the vertex they share
+	"""
+	n = len(xs)
+	grid = _Grid(xs, ys, n)
+	for i in range(n):
+		j = (i + 1) % n
+		grid.add(i, min(xs[i], xs[j]), min(ys[i], ys[j]), max(xs[i], xs[j]),
+			max(ys[i], ys[j]))
+	for i in range(n):
+		j = (i + 1) % n
+		for k in grid.find(min(xs[i], xs[j]), min(ys[i], ys[j]),
+			max(xs[i], xs[j]), max(ys[i], ys[j])):
+			if k <= i:
+				continue
+			l = (k + 1) % n
+			if k == j or l == i:
+				# Neighbouring edges only share their common vertex unless
+				# the outline folds back on itself, which _simplify removes
+				continue
+			if _segmentsCross(xs[i], ys[i], xs[j], ys[j], xs[k], ys[k], xs[l],
+				ys[l]):
+				return False
+	return True
+
+
+def triangulate(xs, ys):
+	"""
+	Splits a simple polygon into triangles by repeatedly cutting off ears.
+	An ear is a convex vertex whose triangle with its two neighbours does not
+	contain any other vertex. Only reflex vertices can be inside such a
+	triangle, so only they are checked, and they are kept in a grid so that
+	only the ones near the triangle are looked at.
+	@type xs: [number]
+	@param xs: x-coordinates of the vertices, in clockwise order on the screen
+	@type ys: [number]
+	@param ys: y-coordinates of the vertices
+	@rtype: [(int, int, int)]
+	@return: the indices of the vertices of each triangle, in the same order
+		as the polygon, or None if no ear could be found
+	"""
+	n = len(xs)
+	before = [n - 1] + range(n - 1)
+	after = range(1, n) + [0]
+	def crossAt(i):
+		a = before[i]
+		c = after[i]
+		return _cross(xs[a], ys[a], xs[i], ys[i], xs[c], ys[c])
+	reflex = _Grid(xs, ys, n)
+	isReflex = [False] * n
+	for i in range(n):
+		if crossAt(i) <= 0:
+			isReflex[i] = True
+			reflex.add(i, xs[i], ys[i], xs[i], ys[i])
+
+	def isEar(a, b, c):
+		ax, ay, bx, by, cx, cy = xs[a], ys[a], xs[b], ys[b], xs[c], ys[c]
+		for r in reflex.find(min(ax, bx, cx), min(ay, by, cy),
+			max(ax, bx, cx), max(ay, by, cy)):
+			if r == a or r == b or r == c:
+				continue
+			px = xs[r]
+			py = ys[r]
+			if _cross(ax, ay, bx, by, px, py) >= 0 \
+				and _cross(bx, by, cx, cy, px, py) >= 0 \
+				and _cross(cx, cy, ax, ay, px, py) >= 0:
+				return False
+		return True
+
+	triangles = []
+	remaining = n
+	ear = 0
+	misses = 0
+	while remaining > 3:
+		a = before[ear]
+		c = after[ear]
+		turn = crossAt(ear)
+		if turn == 0 or (turn > 0 and isEar(a, ear, c)):
+			# A vertex on the line between its neighbours is dropped without
+			# a triangle
+			if turn != 0:
+				triangles.append((a, ear, c))
+			after[a] = c
+			before[c] = a
+			if isReflex[ear]:
+				isReflex[ear] = False
+				reflex.remove(ear, xs[ear], ys[ear], xs[ear], ys[ear])
+			for v in (a, c):
+				if isReflex[v] and crossAt(v) > 0:
+					isReflex[v] = False
+					reflex.remove(v, xs[v], ys[v], xs[v], ys[v])
+			remaining -= 1
+			ear = c
+			misses = 0
+		else:
+			ear = after[ear]
+			misses += 1
+			if misses > remaining:
+				log.warning("No ear found with %d vertices left" % remaining)
+				return None
+	if crossAt(ear) != 0:
+		triangles.append((before[ear], ear, after[ear]))
+	return triangles
+
+
+def mergeConvex(xs, ys, triangles):
+	"""
+	Hertel-Mehlhorn: removes every diagonal between two pieces of a
+	triangulation whose removal leaves both of its ends convex. The result
+	has at most four times as many pieces as the fewest possible.
+	@type xs: [number]
+	@param xs: x-coordinates of the vertices
+	@type ys: [number]
+	@param ys: y-coordinates of the vertices
+	@type triangles: [(int, int, int)]
+	@param triangles: triangulation as returned by triangulate
+	@rtype: [[int]]
+	@return: the indices of the vertices of each convex piece
+	"""
+	pieces = {}
+	owner = {}
+	for k, triangle in enumerate(triangles):
+		pieces[k] = list(triangle)
+		for i in range(3):
+			owner[(triangle[i], triangle[(i + 1) % 3])] = k
+
+	def convexAt(a, b, c):
+		return _cross(xs[a], ys[a], xs[b], ys[b], xs[c], ys[c]) >= 0
+
+	for triangle in triangles:
+		for t in range(3):
+			i = triangle[t]
+			j = triangle[(t + 1) % 3]
+			first = owner.get((i, j))
+			second = owner.get((j, i))
+			if first is None or second is None:
+				# Not a diagonal or already removed
+				continue
+			a = pieces[first]
+			b = pieces[second]
+			# Rotate a to run from j to i, and b from i to j
+			start = a.index(j)
+			a = a[start:] + a[:start]
+			start = b.index(i)
+			b = b[start:] + b[:start]
+			if not convexAt(a[-2], i, b[1]) or not convexAt(b[-2], j, a[1]):
+				continue
+			merged = a + b[1:-1]
+			pieces[first] = merged
+			del pieces[second]
+			del owner[(i, j)]
+			del owner[(j, i)]
+			for k in range(len(b) - 1):
+				owner[(b[k], b[k + 1])] = first
+	return pieces.values()
+
+
+def decompose(points):
+	"""
+	Splits a polygon into convex pieces by triangulating it and then merging
+	the triangles back together as far as possible.
+	@type points: Point[]
+	@param points: the vertices of the polygon, in either order
+	@rtype: Point[][]
+	@return: the vertices of each piece, in the order that Polygon.intersects
+		expects, or None if the outline crosses itself or has no area
+	"""
+	xs, ys = _simplify(points)
+	if len(xs) < 3:
+		return None
+	area = signedArea(xs, ys)
+	if area == 0:
+		return None
+	if area < 0:
+		xs.reverse()
+		ys.reverse()
+	if not isSimple(xs, ys):
+		return None
+	triangles = triangulate(xs, ys)
+	if triangles is None:
+		return None
+	return [[Point(xs[i], ys[i]) for i in piece]
+		for piece in mergeConvex(xs, ys, triangles)]
+
+
+def _checkDecomposition(points, pieces):
+	"""
+	Checks that the pieces are convex and cover the same area as the polygon
+	"""
+	xs = [p.x for p in points]
+	ys = [p.y for p in points]
+	total = 0.0
+	for piece in pieces:
+		assert Polygon(piece).convex()
+		area = signedArea([p.x for p in piece], [p.y for p in piece])
+		assert area > 0
+		total += area
+	assert abs(total - abs(signedArea(xs, ys))) < 1e-6 * max(total, 1.0)
+
+
+def _reflexCount(points):
+	xs, ys = _simplify(points)
+	if signedArea(xs, ys) < 0:
+		xs.reverse()
+		ys.reverse()
+	return len([i for i in range(len(xs)) if _cross(xs[i - 1], ys[i - 1],
+		xs[i], ys[i], xs[(i + 1) % len(xs)], ys[(i + 1) % len(xs)]) < 0])
+
+
+def _star(count, seed):
+	"""
+	@return: a star shaped outline with count vertices
+	"""
+	points = []
+	for i in range(count):
+		angle = 2 * math.pi * i / count
+		radius = 1000 if i % 2 == 0 else 400
+		points.append(Point(radius * math.cos(angle), radius * math.sin(angle)))
+	return points
+
+
+def _blob(count, seed):
+	"""
+	@return: an outline with count vertices at random distances around a
+		center
+	"""
+	rand = random.Random(seed)
+	points = []
+	for i in range(count):
+		angle = 2 * math.pi * i / count
+		radius = rand.randint(200, 1000)
+		points.append(Point(int(radius * math.cos(angle)),
+			int(radius * math.sin(angle))))
+	return points
+
+
+def _comb(count, seed):
+	"""
+	@return: a comb shaped outline on the tile grid with about count vertices
+	"""
+	teeth = max(count // 4, 1)
+	points = [Point(0, 0)]
+	for i in range(teeth):
+		points.append(Point(i * 64 + 32, 0))
+		points.append(Point(i * 64 + 32, 320))
+		points.append(Point(i * 64 + 64, 320))
+		points.append(Point(i * 64 + 64, 0))
+	points.append(Point(teeth * 64 + 32, 0))
+	points.append(Point(teeth * 64 + 32, -64))
+	points.append(Point(0, -64))
+	return points
+
+
+def _spiral(count, seed):
+	"""
+	@return: a spiral shaped band with count vertices
+	"""
+	half = count // 2
+	outer = []
+	inner = []
+	for i in range(half):
+		angle = 6 * math.pi * i / half
+		radius = 100 + 30 * angle
+		outer.append(Point((radius + 40) * math.cos(angle),
+			(radius + 40) * math.sin(angle)))
+		inner.append(Point(radius * math.cos(angle), radius * math.sin(angle)))
+	inner.reverse()
+	return outer + inner
+
+
+# Outlines used to test and time the convex decomposition
+_corpus = [("star", _star), ("blob", _blob), ("comb", _comb),
+	("spiral", _spiral)]
+
+
 def unittest():
 	"""
 	Simple sanity check on the intersects code
@@ -377,11 +926,120 @@ def unittest():
 	p = Polygon([
 		Point(1, 1),
 		Point(3, 1),
-		Point(1, 3),
-		Point(3, 3)
+		Point(3, 3),
+		Point(1, 3)
 	])
 	assert p.intersects(Point(2, 2)) == True
 	assert p.intersects(Point(0, 0)) == False
 
+	# Cached values follow the vertices
+	p = Polygon([Point(0, 0), Point(4, 0), Point(4, 4), Point(0, 4)])
+	assert p.boundingBox() == (0, 0, 4, 4) and p.convex()
+	assert not p.intersects(Point(5, 2))
+	p.adjust(6, 0, 1)
+	assert p.intersects(Point(5, 1)) and p.boundingBox() == (0, 0, 6, 4)
+	p.shift(10, 10)
+	assert p.intersects(Point(15, 11)) and not p.intersects(Point(5, 1))
+	assert p.getCenter().x == 12.5 and p.boundingBox() == (10, 10, 16, 14)
+	p.adjust(12, 12, 2)
+	assert p.concave()
+	grid = [Point(x / 2.0, y / 2.0) for x in range(-4, 40)
+		for y in range(-4, 40)]
+	for q in (Polygon([Point(1, 1), Point(4, 2), Point(2, 4)]),
+		Polygon(_star(30, 0)), Polygon([Point(3, 3)]),
+		Polygon([Point(1, 1), Point(2, 1), Point(3, 1), Point(3, 3),
+			Point(1, 3)]),
+		Polygon([Point(1, 1), Point(1, 3), Point(3, 3), Point(3, 1)])):
+		q.shift(8, 8)
+		assert q.intersectsPoints(grid) == [q.intersects(g) for g in grid]
+
+	# An L shape needs two pieces
+	p = Polygon([Point(0, 0), Point(2, 0), Point(2, 1), Point(1, 1),
+		Point(1, 2), Point(0, 2)])
+	pieces = p.decompose()
+	assert len(pieces) == 2
+	_checkDecomposition(p.getPoints(), [q.getPoints() for q in pieces])
+	for q in pieces:
+		assert q.intersects(Point(0.5, 0.5)) or q.intersects(Point(1.5, 0.5)) \
+			or q.intersects(Point(0.5, 1.5))
+
+	# Convex polygons stay in one piece, whichever way round they are
+	p = Polygon([Point(1, 3), Point(3, 3), Point(3, 1), Point(1, 1)])
+	assert len(p.decompose()) == 1
+
+	# Outlines that cross themselves can't be split
+	p = Polygon([Point(1, 1), Point(3, 1), Point(1, 3), Point(3, 3)])
+	assert p.decompose() is None
+
+	for name, make in _corpus:
+		for count in (8, 30, 101, 1000):
+			for seed in range(3):
+				points = make(count, seed)
+				pieces = decompose(points)
+				assert pieces is not None, name
+				_checkDecomposition(points, pieces)
+				# Hertel-Mehlhorn never needs more than two pieces for each
+				# reflex vertex, plus one
+				assert len(pieces) <= 2 * _reflexCount(points) + 1, name
+
+
+def benchmark(count = 1000):
+	"""
+	Prints the time taken to decompose the test outlines, and to hit-test and
+	drag a handle of a polygon with as many vertices
+	@type count: int
+	@param count: number of vertices in each outline
+	"""
+	polygon = Polygon([Point(1000 * math.cos(2 * math.pi * i / count),
+		1000 * math.sin(2 * math.pi * i / count)) for i in range(count)])
+	polygon.forceCClockwise()
+	rand = random.Random(0)
+	points = [Point(rand.uniform(-1100, 1100), rand.uniform(-1100, 1100))
+		for i in range(10000)]
+	concave = Polygon(_star(count, 0))
+	concave.forceCClockwise()
+	start = time.time()
+	single = [concave.intersects(p) for p in points]
+	middle = time.time()
+	batch = concave.intersectsPoints(points)
+	end = time.time()
+	assert single == batch
+	print("%d points against %d concave vertices: one at a time %.3f s,"
+		" batch %.3f s" % (len(points), count, middle - start, end - middle))
+	start = time.time()
+	single = [polygon.intersects(p) for p in points]
+	middle = time.time()
+	batch = polygon.intersectsPoints(points)
+	end = time.time()
+	assert single == batch
+	print("%d points against %d vertices: one at a time %.3f s, batch %.3f s"
+		% (len(points), count, middle - start, end - middle))
+	start = time.time()
+	for i in range(100):
+		polygon.adjust(1000 + i, 0, 0)
+		polygon.convex()
+		polygon.intersects(points[i])
+	print("drag a handle: %.6f s per step" % ((time.time() - start) / 100))
+
+	for name, make in _corpus:
+		points = make(count, 0)
+		start = time.time()
+		xs, ys = _simplify(points)
+		if signedArea(xs, ys) < 0:
+			xs.reverse()
+			ys.reverse()
+		simple = isSimple(xs, ys)
+		checked = time.time()
+		triangles = triangulate(xs, ys)
+		triangulated = time.time()
+		pieces = mergeConvex(xs, ys, triangles)
+		merged = time.time()
+		print("%-8s %5d vertices %4d reflex: check %.3f s, triangulate %.3f s,"
+			" merge %.3f s, %d pieces" % (name, len(xs), _reflexCount(points),
+			checked - start, triangulated - checked, merged - triangulated,
+			len(pieces)))
+		assert simple
+
 if __name__ == "__main__":
 	unittest()
+	benchmark()
@@ -27,11 +27,21 @@ Contains the TileGrid class
 __docformat__ = "epytext"
 
 import logging
+import time
 import gtk
 import cairo
 import preferences
 import mapcontroller
 import graphics
+import profiler
+
+# EditorTool methods that are measured when profiling is enabled
+TOOL_HANDLERS = ["mouseMotion", "mouseButtonPress", "mouseButtonRelease",
+	"mouseEnter", "mouseLeave", "keyPress", "draw"]
+
+# Zoom factors closer together than this are treated as the same level when
+# stepping through preferences.zoomLevels
+ZOOM_EPSILON = 0.001
 
 class TileGrid(gtk.DrawingArea):
 	"""
@@ -45,13 +55,13 @@ class TileGrid(gtk.DrawingArea):
 
 		self.showGrid = False
 		self.__scaleFactor = 1.0
-		self.__zoomLevel = preferences.zoomNormalIndex
 		self.__tileSize = tileSize
 		self.__tools = []
 		self.__selectedTool = 0
 		self.__width = 0
 		self.__height = 0
 		self.checkerPattern = graphics.getCheckerPattern(tileSize)
+		profiler.instrument(self, ["specialRedraw"], "expose")
 
 		# DrawingArea can't get events of its own for whatever reason.
 		# Sticking it in an EventBox works around this
@@ -90,6 +100,16 @@ class TileGrid(gtk.DrawingArea):
 		return self.eventBox
 
 	def do_expose_event(self, event):
+		if profiler.enabled:
+			start = time.time()
+			self.__expose(event)
+			elapsed = time.time() - start
+			profiler.record("expose", self.__class__.__name__, elapsed)
+			profiler.recordFrame(elapsed)
+		else:
+			self.__expose(event)
+
+	def __expose(self, event):
 		windowContext = self.window.cairo_create()
 		windowContext.rectangle(event.area.x, event.area.y, event.area.width,
 			event.area.height)
@@ -101,6 +121,7 @@ class TileGrid(gtk.DrawingArea):
 			self.__tools[self.__selectedTool].draw(windowContext)
 
 	def addTool(self, tool, toolID):
+		profiler.instrument(tool, TOOL_HANDLERS, "tool")
 		while len(self.__tools) < toolID + 1:
 			self.__tools.append(None)
 		self.__tools[toolID] = tool
@@ -149,35 +170,43 @@ class TileGrid(gtk.DrawingArea):
 			if r:
 				self.queue_draw()
 
-	def __validateZoom(self):
-		self.__zoomLevel = min(max(self.__zoomLevel, 0),
-			len(preferences.zoomLevels) - 1)
-
 	def zoomIn(self):
 		"""
-		Zoom in
+		Zoom in to the next of preferences.zoomLevels
 		"""
-		self.__zoomLevel += 1
-		self.__setZoom()
+		for level in preferences.zoomLevels:
+			if level > self.__scaleFactor + ZOOM_EPSILON:
+				self.setZoom(level)
+				return
 
 	def zoomOut(self):
 		"""
-		Zooms out
+		Zooms out to the next of preferences.zoomLevels
 		"""
-		self.__zoomLevel -= 1
-		self.__setZoom()
+		for level in reversed(preferences.zoomLevels):
+			if level < self.__scaleFactor - ZOOM_EPSILON:
+				self.setZoom(level)
+				return
 
 	def zoomNormal(self):
 		"""
 		Reset the zoom level to 100%
 		"""
-		self.__zoomLevel = preferences.zoomNormalIndex
-		self.__setZoom()
+		self.setZoom(preferences.zoomLevels[preferences.zoomNormalIndex])
 
-	def __setZoom(self):
-		""" Set the zoom level"""
-		self.__validateZoom()
-		self.__scaleFactor = preferences.zoomLevels[self.__zoomLevel]
+	def setZoom(self, factor):
+		"""
+		Sets the zoom level. It does not have to be one of
+		preferences.zoomLevels, but it is kept between the smallest and the
+		largest of them.
+		@type factor: float
+		@param factor: screen pixels for each map pixel
+		"""
+		factor = min(max(factor, preferences.zoomLevels[0]),
+			preferences.zoomLevels[-1])
+		if factor == self.__scaleFactor:
+			return
+		self.__scaleFactor = factor
 		self.queue_draw()
 
 	def getZoom(self):
@@ -27,6 +27,7 @@ Contains classes to represent the tile map.
 __docformat__ = "epytext"
 
 import copy
+import array
 import logging
 
 import mapio
@@ -48,6 +49,14 @@ class TileMap:
 		# Image files used
 		self.images = []
 		self.blocking = []
+		# True if the blocking information has changed since it was last saved
+		self.blockingDirty = True
+		# binaryio.LevelFile that the layers load their chunks from, or None
+		self.levelFile = None
+		# The distinct tiles used by the layers
+		self.tileTable = TileTable()
+		# autotile.Terrain objects declared by the tilesets
+		self.terrains = []
 
 	def resize(self, width, height, xOffset, yOffset):
 		"""
@@ -106,7 +115,8 @@ class TileMap:
 			# window is often greater than that of the map
 			return
 		while z > len(self.layers) - 1:
-			self.layers.append(Layer(self.width, self.height))
+			self.layers.append(Layer(self.width, self.height,
+				self.tileTable))
 		return self.layers[z].addTile(t, x, y)
 
 	def removeTile(self, x, y, z):
@@ -145,11 +155,13 @@ class TileMap:
 		"""
 		if z != -1:
 			while z > len(self.layers) - 1:
-				self.layers.append(Layer(self.width, self.height))
+				self.layers.append(Layer(self.width, self.height,
+					self.tileTable))
 			self.layers[z].name = name
 			self.layers[z].visible = visible
 		else:
-			self.layers.append(Layer(self.width, self.height))
+			self.layers.append(Layer(self.width, self.height,
+				self.tileTable))
 			self.layers[-1].name = name
 			self.layers[-1].visible = visible
 		z = -1
@@ -218,11 +230,535 @@ class TileMap:
 		return m
 
 
+# Width and height of the square blocks that layers store their tiles in
+CHUNK_SIZE = 32
+
+# Highest tile id. Chunks store ids as unsigned 16-bit numbers.
+MAX_TILE_ID = 0xffff
+
+# Contents of a chunk without any tiles
+EMPTY_CHUNK = array.array("H", [0] * (CHUNK_SIZE * CHUNK_SIZE))
+
+
+class TileTable(object):
+	"""
+	Numbers the distinct tiles used in a map. A level only uses a few hundred
+	different combinations of image index and image coordinates, so every
+	placement of the same tile shares one Tile object, and layers only store
+	the small integer id of that object. Id 0 means that there is no tile.
+	Ids never change once they have been given out.
+	"""
+	def __init__(self):
+		# Tiles by id
+		self.tiles = [None]
+		# Dictionary of (ix, iy, index) to id
+		self.__ids = {}
+
+	def __len__(self):
+		"""
+		@rtype: int
+		@return: the number of ids in use, including id 0
+		"""
+		return len(self.tiles)
+
+	def getId(self, tile):
+		"""
+		@type tile: Tile
+		@param tile: a tile. It does not have to come from this table.
+		@rtype: int
+		@return: the id of the tile, or 0 if tile is None
+		"""
+		if tile is None:
+			return 0
+		info = tile.getImageInfo()
+		i = self.__ids.get(info)
+		if i is None:
+			i = len(self.tiles)
+			if i > MAX_TILE_ID:
+				raise ValueError("A map can't use more than %d different"
+					" tiles" % MAX_TILE_ID)
+			self.tiles.append(tile)
+			self.__ids[info] = i
+		return i
+
+	def intern(self, index, ix, iy):
+		"""
+		@type index: int
+		@param index: image index
+		@type ix: int
+		@param ix: image x-coordinate
+		@type iy: int
+		@param iy: image y-coordinate
+		@rtype: Tile
+		@return: the shared tile object for the image information
+		"""
+		i = self.__ids.get((ix, iy, index))
+		if i is None:
+			i = self.getId(Tile(index, ix, iy))
+		return self.tiles[i]
+
+	def entries(self):
+		"""
+		@rtype: [[int, int, int]]
+		@return: the image x-coordinate, y-coordinate and index of every tile,
+			starting with id 1
+		"""
+		return [list(tile.getImageInfo()) for tile in self.tiles[1:]]
+
+
 class Layer:
-	def __init__(self, width, height):
-		self.tiles = [[None for i in range(height)] for j in range(width)]
+	"""
+	The tiles of a layer are stored as tile ids in square chunks of CHUNK_SIZE
+	by CHUNK_SIZE tiles. Chunks that contain no tiles are not stored at all. A
+	layer loaded from a binary level file can be given a chunk source, in which
+	case chunks are only read from the file the first time they are used, and
+	unmodified chunks may be dropped again by the source to limit memory use.
+	"""
+	def __init__(self, width, height, tileTable):
+		"""
+		@type tileTable: TileTable
+		@param tileTable: the tile table of the map that the layer belongs to
+		"""
+		self.width = width
+		self.height = height
 		self.name = "New Layer"
 		self.visible = True
+		# True if the layer has changed since it was last saved
+		self.dirty = True
+		self.__tileTable = tileTable
+		# Dictionary of (chunk x, chunk y) to an array of tile ids, stored row
+		# by row, for the chunks that are in memory
+		self.__chunks = {}
+		# Keys of the chunks that have been modified since they were last
+		# written to the chunk source. These can't be dropped from memory.
+		self.__modified = set()
+		# Object that chunks not in memory are loaded from, or None
+		self.__source = None
+		# Keys of the chunks that can be loaded from the source
+		self.__sourceKeys = set()
+		# Key of the chunk that was most recently used
+		self.__lastKey = None
+		# Tile id to the set of keys of the chunks that contain it, and the
+		# number of tiles with each id in each chunk. Both are built the first
+		# time that they are needed and kept up to date after that.
+		self.__index = None
+		self.__chunkCounts = None
+		# Keys of the chunks that have not been counted yet while the index is
+		# built a few chunks at a time, or None
+		self.__unindexed = None
+
+	def getTileTable(self):
+		"""
+		@rtype: TileTable
+		@return: the table that the tile ids of this layer refer to
+		"""
+		return self.__tileTable
+
+	def attachSource(self, source, keys):
+		"""
+		Makes the layer load its chunks on demand
+		@type source: object
+		@param source: object with loadChunk(layer, key) and touch(layer, key)
+			methods. loadChunk returns the array of tile ids for a chunk.
+		@type keys: set
+		@param keys: the (chunk x, chunk y) keys of the non-empty chunks that
+			the source can load
+		"""
+		self.__source = source
+		self.__sourceKeys = set(keys)
+		self.__lastKey = None
+		self.__index = None
+		self.__chunkCounts = None
+		self.__unindexed = None
+
+	def detachSource(self):
+		"""
+		Loads every chunk that is not yet in memory and then stops using the
+		chunk source
+		"""
+		source = self.__source
+		if source is None:
+			return
+		keys = self.__sourceKeys
+		# Detach first so that the source can't drop the chunks again while
+		# they are loaded
+		self.__source = None
+		self.__sourceKeys = set()
+		for key in keys:
+			if key not in self.__chunks:
+				self.__chunks[key] = source.loadChunk(self, key)
+
+	def getSource(self):
+		"""
+		@return: the chunk source of the layer, or None
+		"""
+		return self.__source
+
+	def chunkKeys(self):
+		"""
+		@rtype: set
+		@return: the keys of every chunk of the layer that may contain tiles,
+			whether or not it is currently in memory
+		"""
+		return self.__sourceKeys.union(self.__chunks)
+
+	def modifiedChunks(self):
+		"""
+		@rtype: set
+		@return: the keys of the chunks that have been modified since they
+			were last written to the chunk source
+		"""
+		return set(self.__modified)
+
+	def markChunksSaved(self):
+		"""
+		Marks all chunks as written to the chunk source so that they can be
+		dropped from memory
+		"""
+		self.__modified = set()
+
+	def residentChunks(self):
+		"""
+		@rtype: [(int, int)]
+		@return: the keys of the chunks that are currently in memory
+		"""
+		return self.__chunks.keys()
+
+	def dropChunk(self, key):
+		"""
+		Removes a chunk from memory. This is only done to chunks that can be
+		loaded from the chunk source again.
+		@type key: (int, int)
+		@param key: the chunk to drop
+		@rtype: bool
+		@return: True if the chunk was dropped
+		"""
+		if (self.__source is None or key in self.__modified
+			or key not in self.__sourceKeys or key not in self.__chunks):
+			return False
+		del self.__chunks[key]
+		if self.__lastKey == key:
+			self.__lastKey = None
+		return True
+
+	def getChunk(self, key):
+		"""
+		@type key: (int, int)
+		@param key: the chunk coordinates
+		@rtype: array.array
+		@return: the tile ids of the chunk, row by row, or None if the chunk
+			is empty. The array must not be modified.
+		"""
+		chunk = self.__chunks.get(key)
+		if chunk is None and key in self.__sourceKeys:
+			chunk = self.__source.loadChunk(self, key)
+			self.__chunks[key] = chunk
+		elif chunk is not None and self.__source is not None \
+			and key != self.__lastKey:
+			self.__source.touch(self, key)
+		self.__lastKey = key
+		return chunk
+
+	def iterTiles(self):
+		"""
+		Iterates over every tile in the layer
+		@return: an iterator of (x, y, Tile)
+		"""
+		tiles = self.__tileTable.tiles
+		for key in sorted(self.chunkKeys()):
+			chunk = self.getChunk(key)
+			if chunk is None:
+				continue
+			left = key[0] * CHUNK_SIZE
+			top = key[1] * CHUNK_SIZE
+			for i, tileId in enumerate(chunk):
+				if tileId != 0:
+					yield (left + (i % CHUNK_SIZE), top + (i // CHUNK_SIZE),
+						tiles[tileId])
+
+	def __inBounds(self, x, y):
+		return x >= 0 and y >= 0 and x < self.width and y < self.height
+
+	def getTileId(self, x, y):
+		"""
+		@rtype: int
+		@return: the id of the tile at (x, y), or 0 if there is none
+		"""
+		if not self.__inBounds(x, y):
+			return 0
+		chunk = self.getChunk((x // CHUNK_SIZE, y // CHUNK_SIZE))
+		if chunk is None:
+			return 0
+		return chunk[(y % CHUNK_SIZE) * CHUNK_SIZE + (x % CHUNK_SIZE)]
+
+	def setTileId(self, x, y, tileId):
+		"""
+		@type tileId: int
+		@param tileId: id from the layer's tile table, or 0 to remove the tile
+		@rtype: int
+		@return: the id of the tile that used to be at (x, y)
+		"""
+		if not self.__inBounds(x, y):
+			return 0
+		key = (x // CHUNK_SIZE, y // CHUNK_SIZE)
+		chunk = self.getChunk(key)
+		if chunk is None:
+			if tileId == 0:
+				return 0
+			chunk = array.array("H", EMPTY_CHUNK)
+			self.__chunks[key] = chunk
+		i = (y % CHUNK_SIZE) * CHUNK_SIZE + (x % CHUNK_SIZE)
+		old = chunk[i]
+		if old != tileId:
+			chunk[i] = tileId
+			self.dirty = True
+			self.__modified.add(key)
+			if self.__index is not None and (self.__unindexed is None
+					or key not in self.__unindexed):
+				self.__moveCount(key, old, tileId)
+		return old
+
+	def getRows(self, top, bottom):
+		"""
+		@type top: int
+		@param top: first row
+		@type bottom: int
+		@param bottom: row after the last one
+		@rtype: [array.array]
+		@return: the tile ids of every tile in each of the rows, left to right
+		"""
+		rows = []
+		top = max(top, 0)
+		bottom = min(bottom, self.height)
+		empty = EMPTY_CHUNK.tostring()
+		columns = range(0, (self.width + CHUNK_SIZE - 1) // CHUNK_SIZE)
+		rowBytes = CHUNK_SIZE * EMPTY_CHUNK.itemsize
+		y = top
+		while y < bottom:
+			cy = y // CHUNK_SIZE
+			data = []
+			for cx in columns:
+				chunk = self.getChunk((cx, cy))
+				data.append(empty if chunk is None else chunk.tostring())
+			end = min(bottom, (cy + 1) * CHUNK_SIZE)
+			for y in range(y, end):
+				start = (y % CHUNK_SIZE) * rowBytes
+				row = array.array("H")
+				row.fromstring("".join([d[start:start + rowBytes]
+					for d in data]))
+				del row[self.width:]
+				rows.append(row)
+			y = end
+		return rows
+
+	def fillRuns(self, runs, pattern, originX, originY):
+		"""
+		Sets the tiles in a number of horizontal runs. This writes whole slices
+		of the chunk arrays, so large areas are filled much faster than with
+		setTileId.
+		@type runs: array.array
+		@param runs: y, first x and last x of each run, one after the other
+		@type pattern: [[int]]
+		@param pattern: rows of tile ids that are repeated over the runs. A
+			pattern of [[tileId]] fills every tile with the same id.
+		@type originX: int
+		@param originX: x-coordinate at which the pattern starts
+		@type originY: int
+		@param originY: y-coordinate at which the pattern starts
+		"""
+		patternWidth = len(pattern[0])
+		rows = [array.array("H", row) for row in pattern]
+		# Key to chunk of every chunk that was written to
+		modified = {}
+		for i in range(0, len(runs), 3):
+			y = runs[i]
+			x1 = max(runs[i + 1], 0)
+			x2 = min(runs[i + 2], self.width - 1)
+			if y < 0 or y >= self.height or x2 < x1:
+				continue
+			row = rows[(y - originY) % len(rows)]
+			shift = (x1 - originX) % patternWidth
+			row = row[shift:] + row[:shift]
+			length = x2 - x1 + 1
+			ids = row * (length // patternWidth + 1)
+			cy = y // CHUNK_SIZE
+			start = (y % CHUNK_SIZE) * CHUNK_SIZE
+			x = x1
+			while x <= x2:
+				cx = x // CHUNK_SIZE
+				end = min(x2 + 1, (cx + 1) * CHUNK_SIZE)
+				key = (cx, cy)
+				chunk = self.getChunk(key)
+				if chunk is None:
+					chunk = array.array("H", EMPTY_CHUNK)
+					self.__chunks[key] = chunk
+				offset = start + x - cx * CHUNK_SIZE
+				chunk[offset:offset + end - x] = ids[x - x1:end - x1]
+				# Marked at once, so that the next getChunk can not drop
+				# the chunk from memory before it has been saved
+				self.dirty = True
+				self.__modified.add(key)
+				modified[key] = chunk
+				x = end
+		if self.__index is not None:
+			for key, chunk in modified.iteritems():
+				self.__countChunk(key, chunk)
+
+	def buildIndex(self, limit = None):
+		"""
+		Builds the index of the tiles used in the layer. It is built in one go
+		the first time that it is needed, but building it a few chunks at a
+		time while the editor is idle makes that first use fast.
+		@type limit: int
+		@param limit: the most chunks to count, or None to count all of the
+			ones that are left
+		@rtype: bool
+		@return: True if there are chunks left to count
+		"""
+		if self.__index is None:
+			self.__index = {}
+			self.__chunkCounts = {}
+			self.__unindexed = self.chunkKeys()
+		elif self.__unindexed is None:
+			return False
+		count = 0
+		while self.__unindexed and (limit is None or count < limit):
+			key = self.__unindexed.pop()
+			chunk = self.getChunk(key)
+			if chunk is not None:
+				self.__countChunk(key, chunk)
+			count += 1
+		if self.__unindexed:
+			return True
+		self.__unindexed = None
+		return False
+
+	def __countChunk(self, key, chunk):
+		"""
+		Counts the tiles of a chunk again and updates the index
+		"""
+		if self.__unindexed is not None:
+			self.__unindexed.discard(key)
+		old = self.__chunkCounts.pop(key, {})
+		counts = {}
+		for tileId in set(chunk):
+			if tileId != 0:
+				counts[tileId] = chunk.count(tileId)
+		for tileId in old:
+			if tileId not in counts:
+				self.__unindex(tileId, key)
+		for tileId in counts:
+			if tileId not in old:
+				self.__index.setdefault(tileId, set()).add(key)
+		if counts:
+			self.__chunkCounts[key] = counts
+
+	def __moveCount(self, key, oldId, newId):
+		"""
+		Updates the index for one tile of a chunk changing from oldId to newId
+		"""
+		counts = self.__chunkCounts.setdefault(key, {})
+		if oldId != 0:
+			counts[oldId] -= 1
+			if counts[oldId] == 0:
+				del counts[oldId]
+				self.__unindex(oldId, key)
+		if newId != 0:
+			counts[newId] = counts.get(newId, 0) + 1
+			if counts[newId] == 1:
+				self.__index.setdefault(newId, set()).add(key)
+		if not counts:
+			del self.__chunkCounts[key]
+
+	def __unindex(self, tileId, key):
+		keys = self.__index[tileId]
+		keys.discard(key)
+		if not keys:
+			del self.__index[tileId]
+
+	def usedTileIds(self):
+		"""
+		@rtype: [int]
+		@return: the ids of the tiles that are used in the layer, in order
+		"""
+		self.buildIndex()
+		return sorted(self.__index)
+
+	def countTile(self, tileId):
+		"""
+		@type tileId: int
+		@param tileId: a tile id other than 0
+		@rtype: int
+		@return: the number of cells of the layer that use the tile
+		"""
+		self.buildIndex()
+		return sum([self.__chunkCounts[key][tileId]
+			for key in self.__index.get(tileId, ())])
+
+	def findTile(self, tileId, left = 0, top = 0, right = None,
+		bottom = None):
+		"""
+		Finds the cells that use a tile. Only the chunks that contain the tile
+		are looked at.
+		@type tileId: int
+		@param tileId: a tile id other than 0
+		@type left: int
+		@param left: left edge of the area to search
+		@type top: int
+		@param top: top edge of the area to search
+		@type right: int
+		@param right: right edge of the area to search, exclusive. Defaults to
+			the width of the layer.
+		@type bottom: int
+		@param bottom: bottom edge of the area to search, exclusive. Defaults
+			to the height of the layer.
+		@rtype: array.array
+		@return: y, first x and last x of each run of cells that use the tile,
+			sorted by y and then x. This is the format that fillRuns takes.
+		"""
+		self.buildIndex()
+		if right is None:
+			right = self.width
+		if bottom is None:
+			bottom = self.height
+		left = max(left, 0)
+		top = max(top, 0)
+		right = min(right, self.width)
+		bottom = min(bottom, self.height)
+		found = []
+		for key in self.__index.get(tileId, ()):
+			x1 = max(left, key[0] * CHUNK_SIZE)
+			y1 = max(top, key[1] * CHUNK_SIZE)
+			x2 = min(right, (key[0] + 1) * CHUNK_SIZE)
+			y2 = min(bottom, (key[1] + 1) * CHUNK_SIZE)
+			if x2 <= x1 or y2 <= y1:
+				continue
+			chunk = self.getChunk(key)
+			for y in range(y1, y2):
+				start = (y % CHUNK_SIZE) * CHUNK_SIZE - key[0] * CHUNK_SIZE
+				row = chunk[start + x1:start + x2]
+				if tileId not in row:
+					continue
+				runStart = None
+				for i, value in enumerate(row):
+					if value == tileId:
+						if runStart is None:
+							runStart = i
+					elif runStart is not None:
+						found.append((y, x1 + runStart, x1 + i - 1))
+						runStart = None
+				if runStart is not None:
+					found.append((y, x1 + runStart, x2 - 1))
+		found.sort()
+
+		# Join runs that were split at chunk edges
+		runs = array.array("i")
+		for y, x1, x2 in found:
+			if len(runs) > 0 and runs[-3] == y and runs[-1] == x1 - 1:
+				runs[-1] = x2
+			else:
+				runs.extend((y, x1, x2))
+		return runs
 
 	def addTile(self, tile, x, y):
 		"""
@@ -238,20 +774,16 @@ class Layer:
 			tile that used to be at the coordinates (x, y), or None if there
 			was no tile there before
 		"""
-		if(x < len(self.tiles) and y < len(self.tiles[x]) and
-			self.tiles[x][y] is not None):
-			r = self.tiles[x][y].getImageInfo()
-			self.tiles[x][y] = tile
-			return r
+		if not self.__inBounds(x, y):
+			return None
+		old = self.setTileId(x, y, self.__tileTable.getId(tile))
+		if old != 0:
+			return self.__tileTable.tiles[old].getImageInfo()
 		else:
-			self.tiles[x][y] = tile
 			return None
 
 	def getTile(self, x, y):
-		if x < len(self.tiles) and y < len(self.tiles[x]):
-			return self.tiles[x][y]
-		else:
-			return None
+		return self.__tileTable.tiles[self.getTileId(x, y)]
 
 	def removeTile(self, x, y):
 		"""
@@ -265,10 +797,9 @@ class Layer:
 			tile that used to be at the coordinates (x, y), or None if there
 			was no tile there before
 		"""
-		if self.tiles[x][y] is not None:
-			r = self.tiles[x][y].getImageInfo()
-			self.tiles[x][y] = None
-			return r
+		old = self.setTileId(x, y, 0)
+		if old != 0:
+			return self.__tileTable.tiles[old].getImageInfo()
 		else:
 			return None
 
@@ -286,17 +817,32 @@ class Layer:
 			log.error("Tried to resize the map to have a zero or negative"+
 			"dimention")
 			return
-		newTiles = [[None for i in range(height)] for j in range(width)]
-		for x, column in enumerate(self.tiles):
-			for y, tile in enumerate(column):
-				newX = x + xOffset
-				newY = y + yOffset
-				if newX < width and newY < height and newX >= 0 and newY >= 0:
-					newTiles[newX][newY] = self.tiles[x][y]
-		self.tiles = newTiles
+		tiles = [(x, y, self.__tileTable.getId(tile))
+			for x, y, tile in self.iterTiles()]
+		# Every chunk is rebuilt, so none of them can come from the source any
+		# more
+		self.__source = None
+		self.__sourceKeys = set()
+		self.__lastKey = None
+		self.__chunks = {}
+		self.__modified = set()
+		self.__index = None
+		self.__chunkCounts = None
+		self.__unindexed = None
+		self.width = width
+		self.height = height
+		for x, y, tileId in tiles:
+			self.setTileId(x + xOffset, y + yOffset, tileId)
+		self.dirty = True
 
 
 class Tile(object):
+	"""
+	Image information of a tile. Tiles are immutable, so the tiles in a map
+	are shared through its TileTable.
+	"""
+	__slots__ = ("__ix", "__iy", "__index")
+
 	def __init__(self, index, ix, iy):
 		"""
 		Brief Description
@@ -317,16 +863,3 @@ class Tile(object):
 		@return: the image x-coordinate, y-coordinate, and index
 		"""
 		return self.__ix, self.__iy, self.__index
-
-	def setImageInfo(self, index, ix, iy):
-		"""
-		@type index: int
-		@param index: image index
-		@type ix: int
-		@param ix: x-coordinate of image
-		@type iy: int
-		@param iy: y-coordinate of image
-		"""
-		self._ix = ix
-		self._iy = iy
-		self._index = index
@@ -0,0 +1,334 @@
+################################################################################
+# Authors: Brian Schott (Sir Alaran)
+# Copyright: Brian Schott (Sir Alaran)
+# Date: Oct 20 2009
+# License:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+"""
+Lookup table from tile ids to the images that are drawn for them
+"""
+
+__docformat__ = "epytext"
+
+import array
+import logging
+import sys
+
+import cairo
+
+import atlas
+import tilemap
+
+log = logging.getLogger("tilerender")
+
+# How much of a tile covers what is under it
+TRANSPARENT = 0
+MIXED = 1
+OPAQUE = 2
+
+
+def classifyTiles(surface, tileSize):
+	"""
+	Looks at the alpha channel of each tile of a tileset
+	@type surface: cairo.ImageSurface
+	@param surface: the tileset, in cairo.FORMAT_ARGB32
+	@type tileSize: int
+	@param tileSize: size of the tiles in pixels
+	@rtype: (int, array.array)
+	@return: the number of tile columns of the tileset and TRANSPARENT, MIXED
+		or OPAQUE for each tile, row by row. Tiles that only partly fit on the
+		image are MIXED.
+	"""
+	surface.flush()
+	width = surface.get_width()
+	height = surface.get_height()
+	stride = surface.get_stride()
+	# Pixels are native-endian 32-bit words with alpha in the top byte
+	if sys.byteorder == "little":
+		alphas = str(surface.get_data())[3::4]
+	else:
+		alphas = str(surface.get_data())[0::4]
+	rowLength = stride // 4
+	columns = (width + tileSize - 1) // tileSize
+	rows = (height + tileSize - 1) // tileSize
+	classes = array.array("B", [MIXED]) * (columns * rows)
+	for ty in range(rows):
+		if (ty + 1) * tileSize > height:
+			continue
+		for tx in range(columns):
+			left = tx * tileSize
+			if left + tileSize > width:
+				continue
+			opaque = True
+			transparent = True
+			for y in range(ty * tileSize, (ty + 1) * tileSize):
+				start = y * rowLength + left
+				row = alphas[start:start + tileSize]
+				if opaque and row.count("\xff") != tileSize:
+					opaque = False
+				if transparent and row.count("\x00") != tileSize:
+					transparent = False
+				if not opaque and not transparent:
+					break
+			if opaque:
+				classes[ty * columns + tx] = OPAQUE
+			elif transparent:
+				classes[ty * columns + tx] = TRANSPARENT
+	return columns, classes
+
+
+class TileRenderTable(object):
+	"""
+	Maps each tile id of a map to the atlas page surface that holds its image
+	and the position of the image on that page. Opened tilesets are packed
+	into a tile atlas, so drawing a tile is a single list lookup and fill, and
+	most tiles come from the same surface.
+	"""
+	def __init__(self, tileTable, tileSize):
+		"""
+		@type tileTable: tilemap.TileTable
+		@param tileTable: the tile table of the map
+		@type tileSize: int
+		@param tileSize: size of the tiles in pixels
+		"""
+		self.__tileTable = tileTable
+		self.__tileSize = tileSize
+		self.__atlas = atlas.TileAtlas()
+		# (page surface, x, y) for each tile id. Id 0 and tiles whose tileset
+		# is not open have None.
+		self.__entries = [None]
+		# TRANSPARENT, MIXED or OPAQUE for each tile id. Tiles that have no
+		# entry are TRANSPARENT, since nothing is drawn for them.
+		self.__opacity = array.array("B", [TRANSPARENT])
+		# Number of columns and the class of each tile for each image index,
+		# worked out once when the tileset is added
+		self.__classes = {}
+
+	def setTileset(self, index, surface):
+		"""
+		Adds the tileset surface for an image index to the atlas
+		@type index: int
+		@param index: image index
+		@type surface: cairo.ImageSurface
+		@param surface: the tileset
+		"""
+		self.__atlas.addImage(index, surface)
+		self.__classes[index] = classifyTiles(surface, self.__tileSize)
+		# Adding an image replaces an atlas page with a copy, so the entries
+		# are all looked up again. There are only as many of them as
+		# there are distinct tiles in the map.
+		tiles = self.__tileTable.tiles
+		for tileId in range(1, len(self.__entries)):
+			self.__entries[tileId] = self.__locate(tiles[tileId])
+			self.__opacity[tileId] = self.__classify(tiles[tileId],
+				self.__entries[tileId])
+
+	def lookup(self):
+		"""
+		@rtype: [(cairo.ImageSurface, int, int)]
+		@return: the atlas page and the position of the image on it for each
+			tile id, or None for tiles that should not be drawn. Covers every
+			id in the tile table.
+		"""
+		tiles = self.__tileTable.tiles
+		for tileId in range(len(self.__entries), len(tiles)):
+			entry = self.__locate(tiles[tileId])
+			self.__entries.append(entry)
+			self.__opacity.append(self.__classify(tiles[tileId], entry))
+		return self.__entries
+
+	def opacity(self):
+		"""
+		@rtype: array.array
+		@return: TRANSPARENT, MIXED or OPAQUE for each tile id. Tiles that are
+			not drawn are TRANSPARENT. Covers every id in the tile table.
+		"""
+		self.lookup()
+		return self.__opacity
+
+	def getPages(self):
+		"""
+		@rtype: [cairo.ImageSurface]
+		@return: the atlas page surfaces
+		"""
+		return [page.surface for page in self.__atlas.pages]
+
+	def getSourceRectangle(self, tileId):
+		"""
+		@type tileId: int
+		@param tileId: a tile id
+		@rtype: (int, int, int, int)
+		@return: the x, y, width and height in pixels of the area of its atlas
+			page that the tile uses, or None if the tile is not in the atlas
+		"""
+		entry = self.lookup()[tileId]
+		if entry is None:
+			return None
+		return entry[1], entry[2], self.__tileSize, self.__tileSize
+
+	def __locate(self, tile):
+		ix, iy, ii = tile.getImageInfo()
+		ts = self.__tileSize
+		return self.__atlas.locate(ii, ix * ts, iy * ts, ts, ts)
+
+	def __classify(self, tile, entry):
+		if entry is None:
+			return TRANSPARENT
+		ix, iy, ii = tile.getImageInfo()
+		if ii not in self.__classes:
+			return MIXED
+		columns, classes = self.__classes[ii]
+		return classes[iy * columns + ix]
+
+
+def gatherChunks(controller, layers, xStart, yStart, xEnd, yEnd,
+		copy = False):
+	"""
+	Collects the chunks that renderTiles needs to draw an area of the map
+	@type controller: mapcontroller.MapController
+	@param controller: the map controller
+	@type layers: [int]
+	@param layers: indices of the layers to draw, bottom to top
+	@type xStart: int
+	@param xStart: first column of tiles
+	@type yStart: int
+	@param yStart: first row of tiles
+	@type xEnd: int
+	@param xEnd: column after the last one
+	@type yEnd: int
+	@param yEnd: row after the last one
+	@type copy: bool
+	@param copy: True to copy the chunk arrays, so that the map can be
+		edited while another thread draws them
+	@rtype: {(int, int): [array.array]}
+	@return: the tile ids of the non-empty chunks of the layers, bottom to
+		top, for each chunk key in the area
+	"""
+	cs = tilemap.CHUNK_SIZE
+	result = {}
+	for cy in range(yStart // cs, (yEnd + cs - 1) // cs):
+		for cx in range(xStart // cs, (xEnd + cs - 1) // cs):
+			chunks = []
+			for z in layers:
+				chunk = controller.getLayerChunk(z, (cx, cy))
+				if chunk is not None:
+					chunks.append(chunk[:] if copy else chunk)
+			if len(chunks) > 0:
+				result[(cx, cy)] = chunks
+	return result
+
+
+def renderTiles(context, chunks, entries, opacity, tileSize, xStart, yStart,
+		xEnd, yEnd, nearest = False):
+	"""
+	Draws the tiles of an area of the map. Nothing under the topmost opaque
+	tile of a cell is drawn, and transparent tiles are not drawn at all.
+	This only reads its arguments, so it can run on any thread as long as
+	nothing else draws to the context. See gatherChunks for xStart, yStart,
+	xEnd and yEnd.
+	@type context: cairo.Context
+	@param context: context with its origin at the top-left corner of the
+		map
+	@type chunks: {(int, int): [array.array]}
+	@param chunks: chunks of the layers to draw, as returned by gatherChunks
+	@type entries: [(cairo.ImageSurface, int, int)]
+	@param entries: TileRenderTable.lookup
+	@type opacity: array.array
+	@param opacity: TileRenderTable.opacity
+	@type tileSize: int
+	@param tileSize: size of the tiles in pixels
+	@type nearest: bool
+	@param nearest: True to draw the tiles without filtering. This is used
+		when zoomed in so that the edges of tiles don't blend with whatever
+		is next to them on the atlas page.
+	"""
+	ts = tileSize
+	cs = tilemap.CHUNK_SIZE
+	for (cx, cy), layers in chunks.iteritems():
+		top = len(layers) - 1
+		left = cx * cs
+		xs = range(max(xStart, left), min(xEnd, left + cs))
+		for y in range(max(yStart, cy * cs), min(yEnd, cy * cs + cs)):
+			row = (y - cy * cs) * cs - left
+			py = y * ts
+			for x in xs:
+				index = row + x
+				# Nothing under the topmost opaque tile can be seen
+				lowest = top
+				while lowest > 0 and opacity[layers[lowest][index]] != OPAQUE:
+					lowest -= 1
+				px = x * ts
+				for chunk in layers[lowest:]:
+					tileId = chunk[index]
+					if opacity[tileId] == TRANSPARENT:
+						continue
+					entry = entries[tileId]
+					context.set_source_surface(entry[0], px - entry[1],
+						py - entry[2])
+					if nearest:
+						context.get_source().set_filter(cairo.FILTER_NEAREST)
+					context.rectangle(px, py, ts, ts)
+					context.fill()
+
+
+def overdraw(controller):
+	"""
+	Counts how many tiles are drawn to render the whole map, with and without
+	leaving out the ones that can not be seen
+	@type controller: mapcontroller.MapController
+	@param controller: controller of an open map
+	@rtype: (int, int)
+	@return: the number of tiles with an image on visible layers, and the
+		number of those that are not transparent or under an opaque tile
+	"""
+	entries = controller.getRenderTable().lookup()
+	opacity = controller.getRenderTable().opacity()
+	info = controller.getLayerInfo()
+	visible = [z for z in range(controller.getNumLayers()) if info[z][1]]
+	cs = tilemap.CHUNK_SIZE
+	total = 0
+	drawn = 0
+	for cy in range((controller.mapHeight() + cs - 1) // cs):
+		for cx in range((controller.mapWidth() + cs - 1) // cs):
+			chunks = [controller.getLayerChunk(z, (cx, cy)) for z in visible]
+			chunks = [chunk for chunk in chunks if chunk is not None]
+			for i in range(cs * cs):
+				covered = False
+				for chunk in reversed(chunks):
+					tileId = chunk[i]
+					if entries[tileId] is None:
+						continue
+					total += 1
+					if covered or opacity[tileId] == TRANSPARENT:
+						continue
+					drawn += 1
+					covered = opacity[tileId] == OPAQUE
+	return total, drawn
+
+
+if __name__ == "__main__":
+	import mapcontroller
+	print("%-40s %10s %10s %8s" % ("level", "tiles", "drawn", "saved"))
+	for fileName in sys.argv[1:]:
+		controller = mapcontroller.MapController()
+		error = controller.open(fileName)
+		if error is not None:
+			print("%-40s %s" % (fileName, error))
+			continue
+		total, drawn = overdraw(controller)
+		print("%-40s %10d %10d %7.1f%%" % (fileName, total, drawn,
+			100.0 * (total - drawn) / max(total, 1)))
@@ -166,9 +166,11 @@ class ShapeMoveAction(UndoAction):
 
 	def undo(self):
 		self.__shape.shift(-self.__dx, -self.__dy)
+		self.getController().notifyWorldModification()
 
 	def redo(self):
 		self.__shape.shift(self.__dx, self.__dy)
+		self.getController().notifyWorldModification()
 
 
 class ShapeDeleteAction(UndoAction):
@@ -203,6 +205,50 @@ class ShapeAddAction(UndoAction):
 		self.getController().addShape(self.__shape)
 
 
+class ShapeGroupAddAction(UndoAction):
+	"""
+	UndoAction for adding many shapes to the map at once
+	"""
+	def __init__(self, controller, shapes):
+		UndoAction.__init__(self, controller)
+		self.__shapes = shapes
+		self.setDescription("add shapes")
+
+	def undo(self):
+		for shape in self.__shapes:
+			self.getController().removeShape(shape)
+
+	def redo(self):
+		for shape in self.__shapes:
+			self.getController().addShape(shape)
+
+
+class ShapeReplaceAction(UndoAction):
+	"""
+	UndoAction for replacing some shapes of the map with others
+	"""
+	def __init__(self, controller, oldShapes, newShapes):
+		UndoAction.__init__(self, controller)
+		self.__oldShapes = oldShapes
+		self.__newShapes = newShapes
+		self.setDescription("replace shapes")
+
+	def undo(self):
+		self.getController().replaceShapes(self.__newShapes, self.__oldShapes)
+
+	def redo(self):
+		self.getController().replaceShapes(self.__oldShapes, self.__newShapes)
+
+
+class ShapeSplitAction(ShapeReplaceAction):
+	"""
+	UndoAction for replacing a concave shape with convex pieces
+	"""
+	def __init__(self, controller, shape, pieces):
+		ShapeReplaceAction.__init__(self, controller, [shape], pieces)
+		self.setDescription("split shape")
+
+
 class ShapeAdjustAction(UndoAction):
 	"""
 	UndoAction for adjusting the geometry of a shape
@@ -233,9 +279,11 @@ class ShapeAdjustAction(UndoAction):
 
 	def undo(self):
 		self.__shape.adjust(self.__oldX, self.__oldY, self.__index)
+		self.getController().notifyWorldModification()
 
 	def redo(self):
 		self.__shape.adjust(self.__newX, self.__newY, self.__index)
+		self.getController().notifyWorldModification()
 
 
 class TileAddAction(UndoAction):
@@ -265,7 +313,10 @@ class TileAddAction(UndoAction):
 			image.
 		"""
 		self.__addedTiles[coords] = newImageCoords
-		self.__oldTiles[coords] = oldImageCoords
+		# A tile that is changed twice is undone to what it was before the
+		# first change
+		if coords not in self.__oldTiles:
+			self.__oldTiles[coords] = oldImageCoords
 
 	def undo(self):
 		for coord, imageCoord in self.__oldTiles.iteritems():
@@ -336,6 +387,119 @@ class TileRemoveAction(UndoAction):
 			z = coord[2]
 			controller.removeTile(x, y, z)
 
+class TileFillAction(UndoAction):
+	"""
+	Action for a flood fill. All of the filled tiles had the same tile before,
+	so the action only keeps the filled runs of tiles and the two tile ids
+	instead of a record for every tile.
+	"""
+	def __init__(self, controller, z, runs, oldId, pattern, originX,
+		originY):
+		"""
+		@type z: int
+		@param z: layer index
+		@type runs: array.array
+		@param runs: y, first x and last x of each filled run of tiles
+		@type oldId: int
+		@param oldId: id of the tiles that were filled over
+		@type pattern: [[int]]
+		@param pattern: rows of tile ids that the runs were filled with
+		@type originX: int
+		@param originX: x-coordinate at which the pattern starts
+		@type originY: int
+		@param originY: y-coordinate at which the pattern starts
+		"""
+		UndoAction.__init__(self, controller)
+		self.setDescription("fill tiles")
+		self.__z = z
+		self.__runs = runs
+		self.__oldId = oldId
+		self.__pattern = pattern
+		self.__originX = originX
+		self.__originY = originY
+
+	def undo(self):
+		self.getController().fillTiles(self.__z, self.__runs,
+			[[self.__oldId]], 0, 0)
+
+	def redo(self):
+		self.getController().fillTiles(self.__z, self.__runs, self.__pattern,
+			self.__originX, self.__originY)
+
+class TileReplaceAction(UndoAction):
+	"""
+	Action for replacing every use of one tile with another tile. Like
+	TileFillAction it only keeps the runs of cells that were changed.
+	"""
+	def __init__(self, controller, uses, oldId, newId):
+		"""
+		@type uses: [(int, array.array)]
+		@param uses: the layer index and the runs of cells that were changed
+			for each layer, as returned by MapController.replaceTileUses
+		@type oldId: int
+		@param oldId: id of the tile that was replaced
+		@type newId: int
+		@param newId: id of the tile that replaced it
+		"""
+		UndoAction.__init__(self, controller)
+		self.setDescription("replace tiles")
+		self.__uses = uses
+		self.__oldId = oldId
+		self.__newId = newId
+
+	def undo(self):
+		for z, runs in self.__uses:
+			self.getController().fillTiles(z, runs, [[self.__oldId]], 0, 0)
+
+	def redo(self):
+		for z, runs in self.__uses:
+			self.getController().fillTiles(z, runs, [[self.__newId]], 0, 0)
+
+
+class RegionAction(UndoAction):
+	"""
+	Action for pasting or cutting a region of the map. The tiles and blocking
+	that were replaced are kept as a clipboard.Region, so the whole region is
+	undone as one bulk edit.
+	"""
+	def __init__(self, controller, region, x, y, removedShapes = [],
+		addedShapes = []):
+		"""
+		@type region: clipboard.Region
+		@param region: the contents to put into the map
+		@type x: int
+		@param x: x-coordinate of the top-left corner, in tiles
+		@type y: int
+		@param y: y-coordinate of the top-left corner, in tiles
+		@type removedShapes: [shapes.Shape]
+		@param removedShapes: shapes to remove from the map
+		@type addedShapes: [shapes.Shape]
+		@param addedShapes: shapes to add to the map
+		"""
+		UndoAction.__init__(self, controller)
+		self.setDescription("paste region")
+		self.__region = region
+		self.__x = x
+		self.__y = y
+		self.__removedShapes = list(removedShapes)
+		self.__addedShapes = list(addedShapes)
+		# What the region replaced, filled in by redo
+		self.__old = None
+
+	def undo(self):
+		controller = self.getController()
+		if self.__old is not None:
+			controller.pasteRegion(self.__old, self.__old.x, self.__old.y)
+		if self.__removedShapes or self.__addedShapes:
+			controller.replaceShapes(self.__addedShapes, self.__removedShapes)
+
+	def redo(self):
+		controller = self.getController()
+		self.__old = controller.pasteRegion(self.__region, self.__x, self.__y)
+		if self.__removedShapes or self.__addedShapes:
+			controller.replaceShapes(self.__removedShapes, self.__addedShapes)
+
+
 class ResizeAction(UndoAction):
 	def __init__(self, controller, newWidth, newHeight, xOffset, yOffset,
 		oldWidth, oldHeight):
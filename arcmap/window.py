@@ -37,6 +37,9 @@ import layers
 import dialogs
 import datafiles
 import undo
+import binaryio
+import overview
+import navigator
 
 programName = "Arctographer"
 
@@ -61,6 +64,8 @@ uiString = """
 			<separator/>
 			<menuitem action="Resize"/>
 			<menuitem action="Background"/>
+			<menuitem action="GenerateCollision"/>
+			<menuitem action="OptimizeShapes"/>
 			<separator/>
 			<menuitem action="Preferences"/>
 		</menu>
@@ -69,10 +74,13 @@ uiString = """
 			<separator/>
 			<menuitem action="ToggleGridMap"/>
 			<menuitem action="ToggleGridPalette"/>
+			<menuitem action="DimLayers"/>
 			<separator/>
 			<menuitem action="ZoomIn"/>
 			<menuitem action="ZoomOut"/>
 			<menuitem action="ZoomNormal"/>
+			<separator/>
+			<menuitem action="Profiler"/>
 		</menu>
 		<menu action="Help">
 			<menuitem action="About"/>
@@ -81,12 +89,15 @@ uiString = """
 	<toolbar name="MapTools">
 		<toolitem action="TileDraw"/>
 		<toolitem action="TileDelete"/>
+		<toolitem action="FloodFill"/>
 		<separator/>
 		<toolitem action="PhysicsSelect"/>
 		<toolitem action="PolygonDraw"/>
 		<toolitem action="CircleDraw"/>
 		<separator/>
 		<toolitem action="BlockDraw"/>
+		<toolitem action="RegionSelect"/>
+		<toolitem action="TileReplace"/>
 	</toolbar>
 	<toolbar name="Layers">
 		<toolitem action="addLayer"/>
@@ -121,6 +132,8 @@ class MainWindow(mapcontroller.MapListener):
 		controller = mapcontroller.MapController()
 		mapcontroller.MapListener.__init__(self, controller)
 		self.mapGrid = None
+		self.overview = overview.Overview(controller)
+		controller.setThumbnailSource(self.overview)
 		self.__createGUI()
 
 		failureReason = controller.open(fileName)
@@ -188,7 +201,13 @@ class MainWindow(mapcontroller.MapListener):
 				"Redo the last change", self.edit_redo),
 			("Background", None, "_Background", "<Control>B",
 				"Change background information for the map",
-				self.edit_background)
+				self.edit_background),
+			("GenerateCollision", None, "_Generate Collision Shapes", None,
+				"Cover the solid parts of the map with physics shapes",
+				self.edit_generateCollision),
+			("OptimizeShapes", None, "_Optimize Physics Shapes", None,
+				"Reduce the number of physics shapes and vertices",
+				self.edit_optimizeShapes)
 		])
 
 		# View menu
@@ -198,7 +217,9 @@ class MainWindow(mapcontroller.MapListener):
 			("ZoomOut", gtk.STOCK_ZOOM_OUT, "Zoom _Out", None, "Zoom Out",
 				self.view_zoomOut),
 			("ZoomNormal", gtk.STOCK_ZOOM_100, "_Normal Size", "<Control>0",
-				"Normal Size", self.view_zoomNormal)
+				"Normal Size", self.view_zoomNormal),
+			("Profiler", None, "P_rofiler", None,
+				"Show the time spent in editor handlers", self.view_profiler)
 		])
 
 		# Help menu
@@ -223,7 +244,10 @@ class MainWindow(mapcontroller.MapListener):
 				"<Control><Shift>G", "Show a grid overlaid on the tile palette",
 				self.view_toggleGridPalette),
 			("ToggleToolbar", None, "Show _Toolbar", None, "Show the toolbar",
-				self.view_toggleToolbar)
+				self.view_toggleToolbar),
+			("DimLayers", None, "_Dim Other Layers", "<Control>D",
+				"Fade the layers other than the selected one",
+				self.view_dimLayers)
 		])
 
 		# Side toolbar
@@ -232,6 +256,8 @@ class MainWindow(mapcontroller.MapListener):
 				editortools.TILE_DRAW_ID),
 			("TileDelete", None, None, "<Contorol><Shift>T", "Remove tiles "+
 				"from the map", editortools.TILE_DELETE_ID),
+			("FloodFill", None, None, "<Control>F", "Fill an area of the map"
+				+ " with tiles", editortools.FLOOD_FILL_ID),
 			("PhysicsSelect", None, None, "<Control>P",
 				"Select and edit shapes", editortools.PHYSICS_SELECT_ID),
 			("PolygonDraw", None, None, "<Control>P", "Draw polygons"
@@ -239,7 +265,11 @@ class MainWindow(mapcontroller.MapListener):
 			("CircleDraw", None, None, "<Control>C", "Draw circles"
 				+ " on the map", editortools.CIRCLE_DRAW_ID),
 			("BlockDraw", None, None, None, "Edit tile blocking information",
-				editortools.BLOCK_DRAW_ID)
+				editortools.BLOCK_DRAW_ID),
+			("RegionSelect", gtk.STOCK_COPY, None, None, "Copy, cut and paste"
+				+ " regions of the map", editortools.REGION_SELECT_ID),
+			("TileReplace", gtk.STOCK_FIND_AND_REPLACE, None, None, "Find and"
+				+ " replace tiles", editortools.TILE_REPLACE_ID)
 			], editortools.TILE_DRAW_ID, self.toolSelect)
 
 		self.uimanager.insert_action_group(actionGroup, 0)
@@ -251,7 +281,7 @@ class MainWindow(mapcontroller.MapListener):
 			"/MenuBar/Edit/Redo", "/MenuBar/Edit/Resize",
 			"/MenuBar/Edit/Background",
 			"/MenuBar/View/ToggleGridMap", "/MenuBar/View/ToggleGridPalette",
-			"/MenuBar/View/ZoomIn",
+			"/MenuBar/View/DimLayers", "/MenuBar/View/ZoomIn",
 			"/MenuBar/View/ZoomOut", "/MenuBar/View/ZoomNormal",
 			"/MainBar/Save", "/MainBar/SaveAs", "/MainBar/ZoomIn",
 			"/MainBar/ZoomOut", "/MainBar/ZoomNormal", "/MainBar/Undo",
@@ -268,7 +298,11 @@ class MainWindow(mapcontroller.MapListener):
 		vPaned = gtk.VPaned()
 		self.paletteManager = tilepalette.PaletteManager(self.getController())
 		vPaned.pack1(self.paletteManager.getWidget(), True, False)
-		vPaned.pack2(self.createTreeView(), True, False)
+		self.navigator = navigator.Navigator(self.overview)
+		lowerBox = gtk.VBox(False, 2)
+		lowerBox.pack_start(self.navigator.getWidget(), False, False, 0)
+		lowerBox.pack_start(self.createTreeView(), True, True, 0)
+		vPaned.pack2(lowerBox, True, False)
 		vPaned.set_size_request(200, -1)
 
 		self.mapBox = gtk.HBox(False, 0)
@@ -329,6 +363,12 @@ class MainWindow(mapcontroller.MapListener):
 		deleteImage.show()
 		deleteButton.set_icon_widget(deleteImage)
 
+		fillButton = self.uimanager.get_widget("/MapTools/FloodFill")
+		fillImage = gtk.image_new_from_file(datafiles.getIconPath(
+			"tileFill.png"))
+		fillImage.show()
+		fillButton.set_icon_widget(fillImage)
+
 		selectButton = self.uimanager.get_widget("/MapTools/PhysicsSelect")
 		selectImage = gtk.image_new_from_file(datafiles.getIconPath(
 			"physicsSelect.png"))
@@ -391,7 +431,8 @@ class MainWindow(mapcontroller.MapListener):
 		filter = gtk.FileFilter()
 		filter.add_pattern("application/json")
 		filter.add_pattern("*.json")
-		filter.set_name("JSON Files")
+		filter.add_pattern("*" + binaryio.EXTENSION)
+		filter.set_name("Level Files")
 		openDialog.add_filter(filter)
 		response = openDialog.run()
 		if response == gtk.RESPONSE_ACCEPT:
@@ -406,7 +447,7 @@ class MainWindow(mapcontroller.MapListener):
 		if self.getController().getFileName() is None:
 			self.promptSave()
 		else:
-			self.getController().save()
+			self.save()
 		self.setTitle()
 
 	def file_saveAs(self, widget, data = None):
@@ -422,8 +463,28 @@ class MainWindow(mapcontroller.MapListener):
 		if response != gtk.STOCK_CANCEL:
 			self.getController().saveWorld = d.physicsCheck.get_active()
 			self.getController().saveBackground = d.parallaxCheck.get_active()
+			self.getController().setSplitConcave(d.splitCheck.get_active())
 		d.destroy()
 
+	def save(self):
+		"""
+		Saves the map, telling the user if it could not be saved
+		@rtype: bool
+		@return: True if the map was saved
+		"""
+		failureReason = self.getController().save()
+		if failureReason is None:
+			return True
+		dialog = gtk.MessageDialog(self.window,
+			gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+			gtk.MESSAGE_ERROR,
+			gtk.BUTTONS_OK,
+			"Error saving the file %s:" % self.getController().getFileName())
+		dialog.format_secondary_text(failureReason)
+		dialog.run()
+		dialog.destroy()
+		return False
+
 	def promptSave(self):
 		"""
 		@rtype: bool
@@ -439,17 +500,25 @@ class MainWindow(mapcontroller.MapListener):
 		jsonFilter.add_pattern("*.json")
 		jsonFilter.set_name("JSON Files")
 
+		binaryFilter = gtk.FileFilter()
+		binaryFilter.add_pattern("*" + binaryio.EXTENSION)
+		binaryFilter.set_name("Binary Levels (for very large maps)")
+
 		saveDialog.add_filter(jsonFilter)
+		saveDialog.add_filter(binaryFilter)
 		response = saveDialog.run()
 		if response == gtk.RESPONSE_ACCEPT:
 			name = saveDialog.get_filename()
-			if not name.endswith(".json"):
-				name = name + ".json"
+			if not name.endswith(".json") and not binaryio.isBinaryName(name):
+				if saveDialog.get_filter() is binaryFilter:
+					name = name + binaryio.EXTENSION
+				else:
+					name = name + ".json"
 			self.getController().setFileName(name)
-			self.getController().save()
 			saveDialog.destroy()
+			saved = self.save()
 			self.setTitle()
-			return True
+			return saved
 		else:
 			saveDialog.destroy()
 			return False
@@ -472,8 +541,7 @@ class MainWindow(mapcontroller.MapListener):
 				if self.getController().getFileName() is None:
 					return self.promptSave()
 				else:
-					self.getController().save()
-					return True
+					return self.save()
 			elif response == gtk.RESPONSE_CLOSE:
 				# Close without saving
 				return True
@@ -545,6 +613,47 @@ class MainWindow(mapcontroller.MapListener):
 
 		d.destroy()
 
+	def edit_generateCollision(self, window, data = None):
+		controller = self.getController()
+		if controller.hasMap() == False:
+			return
+
+		dialog = dialogs.CollisionDialog(self.window,
+			[name for name, visible in controller.getLayerInfo()])
+		response = dialog.run()
+		if response == gtk.RESPONSE_ACCEPT:
+			shapes = controller.generateCollisionShapes(dialog.getLayer())
+			if len(shapes) > 0:
+				action = undo.ShapeGroupAddAction(controller, shapes)
+				controller.addUndoAction(action)
+				for shape in shapes:
+					controller.addShape(shape)
+		dialog.destroy()
+
+	def edit_optimizeShapes(self, window, data = None):
+		controller = self.getController()
+		if controller.hasMap() == False:
+			return
+
+		dialog = dialogs.OptimizeShapesDialog(self.window)
+		response = dialog.run()
+		if response == gtk.RESPONSE_ACCEPT:
+			old, new, report = controller.optimizeShapes(dialog.getTolerance(),
+				dialog.getSnap(), dialog.getMerge())
+			if len(old) > 0 or len(new) > 0:
+				action = undo.ShapeReplaceAction(controller, old, new)
+				controller.addUndoAction(action)
+				controller.replaceShapes(old, new)
+			message = gtk.MessageDialog(self.window,
+				gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+				gtk.MESSAGE_INFO,
+				gtk.BUTTONS_OK,
+				"Physics shapes optimized")
+			message.format_secondary_text(str(report))
+			message.run()
+			message.destroy()
+		dialog.destroy()
+
 	def view_toggleGridMap(self, widget, data = None):
 		"""
 		We installed this function so you could turn the grid on, and off.
@@ -560,6 +669,11 @@ class MainWindow(mapcontroller.MapListener):
 		if self.paletteManager is not None:
 			self.paletteManager.toggleGrid()
 
+	def view_dimLayers(self, widget, data = None):
+		if self.getController().hasMap() == False:
+			return
+		self.mapGrid.setDimOthers(widget.get_active())
+
 	def view_toggleToolbar(self, widget, data = None):
 		toolbar = self.uimanager.get_widget("/MainBar")
 		if widget.get_active():
@@ -586,6 +700,11 @@ class MainWindow(mapcontroller.MapListener):
 		self.mapGrid.zoomNormal()
 		self.setTitle()
 
+	def view_profiler(self, widget, data = None):
+		dialog = dialogs.ProfilerDialog(self.window)
+		dialog.run()
+		dialog.destroy()
+
 	def help_about(self, window, data = None):
 		"""
 		The answer to the age-old question "Who's responsible for this mess?"
@@ -646,6 +765,7 @@ along with """ + programName + ". If not, see <http://www.gnu.org/licenses/>.")
 	def listenFileClosed(self):
 		self.__setWidgetsInsensitive()
 		self.setTitle()
+		self.navigator.setMapGrid(None)
 		self.mapBox.remove(self.mapGrid.getWidget())
 		self.setTitle()
 
@@ -660,8 +780,12 @@ along with """ + programName + ". If not, see <http://www.gnu.org/licenses/>.")
 		self.uimanager.get_action("/MenuBar/Edit/Redo").set_sensitive(
 			False)
 
-		self.mapGrid = mapgrid.MapGrid(self.getController(), self.statusBar)
+		self.mapGrid = mapgrid.MapGrid(self.getController(), self.statusBar,
+			self.overview)
+		self.mapGrid.setDimOthers(self.uimanager.get_widget(
+			"/MenuBar/View/DimLayers").get_active())
 		self.mapBox.pack_end(self.mapGrid.getWidget())
+		self.navigator.setMapGrid(self.mapGrid)
 		self.setTitle()
 
 	def listenUndoRedo(self):
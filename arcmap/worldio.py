@@ -173,6 +173,14 @@ class WorldWriter(object):
 		d = {"shapes": [], "gravityX": self.__world.gravityX,
 			"gravityY": self.__world.gravityY}
 		for shape in self.__world.getShapes():
+			if self.__world.splitConcave and hasattr(shape, "concave") \
+					and shape.concave():
+				pieces = shape.decompose()
+				if pieces is not None:
+					for piece in pieces:
+						d["shapes"].append(self.__writeShape(piece))
+					continue
+				log.warning("Writing a polygon that crosses itself")
 			d["shapes"].append(self.__writeShape(shape))
 		return d
 
@@ -0,0 +1,410 @@
+################################################################################
+# Authors: Brian Schott (Sir Alaran)
+# Copyright: Brian Schott (Sir Alaran)
+# Date: Oct 20 2009
+# License:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+"""
+Reduces the number of shapes and vertices in a physics world
+"""
+
+__docformat__ = "epytext"
+
+import math
+import logging
+
+import shapes
+
+log = logging.getLogger("worldoptimize")
+
+
+class Report(object):
+	"""
+	Shape and vertex counts from before and after an optimization. Only the
+	vertices of polygons are counted.
+	"""
+	def __init__(self):
+		self.shapesBefore = 0
+		self.shapesAfter = 0
+		self.verticesBefore = 0
+		self.verticesAfter = 0
+
+	def __str__(self):
+		return "Shapes: %d -> %d\nVertices: %d -> %d" % (self.shapesBefore,
+			self.shapesAfter, self.verticesBefore, self.verticesAfter)
+
+
+def _turn(a, b, c):
+	"""
+	@return: the cross product of the vectors from a to b and from b to c.
+		It is positive if the path turns clockwise on the screen at b.
+	"""
+	return (b[0] - a[0]) * (c[1] - b[1]) - (b[1] - a[1]) * (c[0] - b[0])
+
+
+def _area(points):
+	return shapes.signedArea([p[0] for p in points], [p[1] for p in points])
+
+
+def _dropRepeated(points):
+	"""
+	@return: the points without points that are the same as the one before
+		them
+	"""
+	result = [p for i, p in enumerate(points) if p != points[i - 1]]
+	if not result and points:
+		result = points[:1]
+	return result
+
+
+def _dropCollinear(points):
+	"""
+	@return: the points without points that lie on the line through their
+		neighbours
+	"""
+	points = _dropRepeated(points)
+	changed = True
+	while changed and len(points) >= 3:
+		changed = False
+		for i in range(len(points)):
+			if _turn(points[i - 1], points[i], points[(i + 1) % len(points)]) \
+				== 0:
+				del points[i]
+				changed = True
+				break
+	return points
+
+
+def _snap(points, interval):
+	"""
+	@return: the points moved to the nearest multiple of interval
+	"""
+	return [(round(x / float(interval)) * interval,
+		round(y / float(interval)) * interval) for x, y in points]
+
+
+def _weld(outlines, tolerance):
+	"""
+	Moves every vertex that is within tolerance of a vertex that came before
+	it onto that vertex, so that shapes that nearly touch share their
+	vertices exactly
+	@type outlines: [[(float, float)]]
+	@param outlines: the vertices of each polygon
+	@type tolerance: float
+	@param tolerance: greatest distance between vertices that are welded
+	@rtype: [[(float, float)]]
+	@return: the welded vertices of each polygon
+	"""
+	if tolerance <= 0:
+		return outlines
+	cells = {}
+	welded = []
+	for outline in outlines:
+		result = []
+		for x, y in outline:
+			cx = int(math.floor(x / tolerance))
+			cy = int(math.floor(y / tolerance))
+			found = None
+			for nx in (cx - 1, cx, cx + 1):
+				for ny in (cy - 1, cy, cy + 1):
+					for px, py in cells.get((nx, ny), ()):
+						if (px - x) ** 2 + (py - y) ** 2 <= tolerance ** 2:
+							found = (px, py)
+							break
+					if found is not None:
+						break
+				if found is not None:
+					break
+			if found is None:
+				found = (x, y)
+				cells.setdefault((cx, cy), []).append(found)
+			result.append(found)
+		welded.append(result)
+	return welded
+
+
+def _segmentDistance(p, a, b):
+	"""
+	@return: the distance from p to the segment from a to b
+	"""
+	dx = b[0] - a[0]
+	dy = b[1] - a[1]
+	length = dx * dx + dy * dy
+	if length == 0:
+		t = 0.0
+	else:
+		t = max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy)
+			/ float(length)))
+	x = a[0] + t * dx - p[0]
+	y = a[1] + t * dy - p[1]
+	return math.sqrt(x * x + y * y)
+
+
+def _simplifyChain(points, first, last, tolerance, keep):
+	"""
+	Ramer-Douglas-Peucker: marks the points between first and last that are
+	needed to stay within tolerance of the original chain
+	"""
+	stack = [(first, last)]
+	while stack:
+		first, last = stack.pop()
+		farthest = None
+		distance = tolerance
+		for i in range(first + 1, last):
+			d = _segmentDistance(points[i % len(points)],
+				points[first % len(points)], points[last % len(points)])
+			if d > distance:
+				farthest = i
+				distance = d
+		if farthest is not None:
+			keep[farthest % len(points)] = True
+			stack.append((first, farthest))
+			stack.append((farthest, last))
+
+
+def simplify(points, tolerance):
+	"""
+	Removes the vertices of a closed outline that are closer than tolerance
+	to the outline without them
+	@type points: [(float, float)]
+	@param points: the vertices of the outline
+	@type tolerance: float
+	@param tolerance: greatest distance that the outline may move
+	@rtype: [(float, float)]
+	@return: the vertices that are kept
+	"""
+	points = _dropRepeated(points)
+	if len(points) <= 3:
+		return points
+	# Split the outline at the first vertex and the vertex farthest from it
+	far = max(range(len(points)), key=lambda i: (points[i][0] - points[0][0])
+		** 2 + (points[i][1] - points[0][1]) ** 2)
+	keep = [False] * len(points)
+	keep[0] = keep[far] = True
+	_simplifyChain(points, 0, far, tolerance, keep)
+	_simplifyChain(points, far, len(points), tolerance, keep)
+	return _dropCollinear([p for p, k in zip(points, keep) if k])
+
+
+def _valid(points, convex):
+	"""
+	@return: True if the outline can replace one that was convex or not
+	"""
+	if len(points) < 3 or _area(points) <= 0:
+		return False
+	polygon = shapes.Polygon([shapes.Point(x, y) for x, y in points])
+	if convex:
+		return polygon.convex()
+	return shapes.isSimple([p[0] for p in points], [p[1] for p in points])
+
+
+def _properties(shape):
+	return (shape.friction, shape.restitution, shape.damage)
+
+
+class _Merger(object):
+	"""
+	Joins convex outlines that share an edge and have the same properties as
+	long as the result is still convex
+	"""
+	def __init__(self, outlines, properties):
+		"""
+		@type outlines: {int: [(float, float)]}
+		@param outlines: the vertices of each convex outline. Outlines that
+			are merged into another are removed.
+		@type properties: {int: (float, float, float)}
+		@param properties: the physical properties of each outline
+		"""
+		self.outlines = outlines
+		self.properties = properties
+		# Directed edge to the outline that has it
+		self.owner = {}
+		for key in outlines:
+			self.claim(key)
+
+	def claim(self, key):
+		outline = self.outlines[key]
+		for i in range(len(outline)):
+			self.owner[(outline[i - 1], outline[i])] = key
+
+	def release(self, key):
+		outline = self.outlines[key]
+		for i in range(len(outline)):
+			edge = (outline[i - 1], outline[i])
+			if self.owner.get(edge) == key:
+				del self.owner[edge]
+
+	def merge(self):
+		# Merges that leave both ends of the shared edge straight keep the
+		# outlines simple and are done first. Joining across vertical edges
+		# before the others turns rows of boxes into strips that can then be
+		# stacked, instead of getting stuck with a mix of both.
+		for strict, vertical in ((True, True), (True, False),
+			(False, False)):
+			while self.mergePass(strict, vertical):
+				pass
+		for key in self.outlines:
+			self.outlines[key] = _dropCollinear(self.outlines[key])
+
+	def mergePass(self, strict, vertical):
+		"""
+		Tries to merge every pair of outlines that share an edge once
+		@type strict: bool
+		@param strict: True to only merge outlines if their edges on either
+			side of the shared edge continue in a straight line
+		@type vertical: bool
+		@param vertical: True to only merge outlines across vertical edges
+		@rtype: bool
+		@return: True if any outlines were merged
+		"""
+		changed = False
+		for (i, j), first in self.owner.items():
+			second = self.owner.get((j, i))
+			if (vertical and i[0] != j[0]) \
+				or self.owner.get((i, j)) != first or second is None \
+				or second == first \
+				or self.properties[first] != self.properties[second]:
+				continue
+			a = self.outlines[first]
+			b = self.outlines[second]
+			# Vertices on straight edges are kept until the end so that the
+			# edges still match the edges of other neighbours. Because of
+			# that the two outlines can share a chain of several edges.
+			n = len(a)
+			shared = [self.owner.get((a[(k + 1) % n], a[k])) == second
+				for k in range(n)]
+			start = a.index(i)
+			while shared[start - 1]:
+				start -= 1
+			end = start % n
+			while shared[end]:
+				end = (end + 1) % n
+			# a from the end of the chain around to its start, then b from
+			# the start of the chain around to its end
+			tail = a[end]
+			head = a[start]
+			a = a[end:] + a[:end]
+			a = a[:a.index(head) + 1]
+			k = b.index(head)
+			b = b[k:] + b[:k]
+			b = b[:b.index(tail) + 1]
+			if len(a) < 2 or len(b) < 2:
+				continue
+			turns = (_turn(a[-2], head, b[1]), _turn(b[-2], tail, a[1]))
+			if min(turns) < 0 or (strict and max(turns) != 0):
+				continue
+			self.release(first)
+			self.release(second)
+			self.outlines[first] = a + b[1:-1]
+			del self.outlines[second]
+			self.claim(first)
+			changed = True
+		return changed
+
+
+def optimize(shapeList, tolerance = 1.0, snapInterval = None,
+	mergeShapes = True):
+	"""
+	Welds, simplifies, snaps and merges the polygons of a world. Shapes that
+	would become invalid are left as they are.
+	@type shapeList: [shapes.Shape]
+	@param shapeList: the shapes of the world. They are not modified.
+	@type tolerance: float
+	@param tolerance: greatest distance in pixels that vertices are moved by
+		welding and simplifying
+	@type snapInterval: int
+	@param snapInterval: spacing in pixels of the grid that vertices are
+		snapped to, or None to not snap them. The shape tools use half of the
+		tile size.
+	@type mergeShapes: bool
+	@param mergeShapes: True to join neighbouring convex shapes
+	@rtype: ([shapes.Shape], Report)
+	@return: the shapes that the world should have afterwards and the counts
+		of shapes and vertices. Shapes that did not change are returned as
+		they are.
+	"""
+	report = Report()
+	report.shapesBefore = len(shapeList)
+	polygons = []
+	originals = []
+	for shape in shapeList:
+		if hasattr(shape, "getRadius"):
+			continue
+		points = [(float(p.x), float(p.y)) for p in shape.getPoints()]
+		report.verticesBefore += len(points)
+		polygons.append(shape)
+		originals.append(points)
+
+	outlines = originals
+	if snapInterval is not None:
+		outlines = [_snap(points, snapInterval) for points in outlines]
+	outlines = _weld(outlines, tolerance)
+
+	result = {}
+	convexKeys = set()
+	for key, shape in enumerate(polygons):
+		convex = shape.convex()
+		points = outlines[key]
+		if _area(points) < 0:
+			points = list(reversed(points))
+		simplified = simplify(points, tolerance)
+		if _valid(simplified, convex):
+			points = simplified
+		else:
+			points = _dropCollinear(points)
+			if not _valid(points, convex):
+				log.info("Leaving a polygon that can't be simplified alone")
+				points = None
+		result[key] = points
+		# Simplifying can make a concave outline convex
+		if points is not None and shapes.Polygon([shapes.Point(x, y)
+			for x, y in points]).convex():
+			convexKeys.add(key)
+
+	if mergeShapes:
+		convexOutlines = dict([(key, result[key]) for key in convexKeys])
+		_Merger(convexOutlines, dict([(key, _properties(polygons[key]))
+			for key in convexKeys])).merge()
+		for key in convexKeys:
+			result[key] = convexOutlines.get(key, False)
+
+	newShapes = []
+	polygonKeys = dict([(id(shape), key) for key, shape in enumerate(polygons)])
+	for shape in shapeList:
+		key = polygonKeys.get(id(shape))
+		if key is None:
+			newShapes.append(shape)
+			continue
+		points = result[key]
+		if points is False:
+			# Merged into another shape
+			continue
+		if points is None or points == originals[key]:
+			newShapes.append(shape)
+			continue
+		polygon = shapes.Polygon([shapes.Point(x, y) for x, y in points])
+		polygon.friction = shape.friction
+		polygon.restitution = shape.restitution
+		polygon.damage = shape.damage
+		newShapes.append(polygon)
+
+	report.shapesAfter = len(newShapes)
+	for shape in newShapes:
+		if not hasattr(shape, "getRadius"):
+			report.verticesAfter += len(shape.getPoints())
+	log.info(str(report))
+	return newShapes, report
@@ -31,9 +31,11 @@ if sys.hexversion < 0x020600f0:
 
 import pygtk
 import gtk
+import gobject
 
 import arcmap.window
 import arcmap.preferences
+import arcmap.profiler
 
 def setLogging(l, f):
 	logging.basicConfig(level=l, format="%(levelname)5s %(name)8s %(lineno)4d: %(message)s",
@@ -47,7 +49,8 @@ Options:
     -d, --debug=level       Set debug logging level
                             Can be debug, info, warn, error or
                             critical
-    -lf, --logfile=file     Set log file""".format(sys.argv[0]))
+    -lf, --logfile=file     Set log file
+    -p, --profile           Record the time spent in editor handlers""".format(sys.argv[0]))
 
 def getDebugLevel(string):
 	d = {
@@ -65,8 +68,8 @@ def getDebugLevel(string):
 def main():
 	# Setup the logging first
 	try:
-		options, arguments = getopt.getopt(sys.argv[1:], "hd:l:",
-			["help", "debug=", "logfile="])
+		options, arguments = getopt.getopt(sys.argv[1:], "hd:l:p",
+			["help", "debug=", "logfile=", "profile"])
 	except getopt.GetoptError, err:
 		print(str(err))
 		printUsage()
@@ -75,6 +78,7 @@ def main():
 	logFile = None
 	fileName = None
 	debugLevel = logging.NOTSET
+	profile = False
 
 	for o, a in options:
 		if o in ("-h", "--help"):
@@ -84,14 +88,22 @@ def main():
 			debugLevel = getDebugLevel(a)
 		elif o in ("-l", "--logfile"):
 			logFile = a
+		elif o in ("-p", "--profile"):
+			profile = True
 		else:
 			print("unhandled option")
 			return
 
 	setLogging(debugLevel, logFile)
+	if profile:
+		arcmap.profiler.enable()
 
-	if len(sys.argv) > 1:
-		fileName = sys.argv[1]
+	if len(arguments) > 0:
+		fileName = arguments[0]
+
+	# The map is rendered on worker threads that pass their results back
+	# through gobject.idle_add
+	gobject.threads_init()
 
 	arcmap.preferences.load()
 	w = arcmap.window.MainWindow(fileName)